@@ -6,16 +6,16 @@ to handle blocking code (the POSTs to to the slack endpoints).
 
 It is meant to be configured as a slack bot that responds to mentions.
 
-It requires ledge, requests, and glom in order to be run.
+It requires ledge in order to be run.
 """
+
 import json
 
 import environ
-import requests
-from glom import glom
 
 from ledge import HandlerImplementation
-from ledge.helpers import content_to_json
+from ledge.helpers import lazy_json
+from ledge.helpers.http import blocking_client
 from ledge.helpers.slack import verify_slack_request
 
 
@@ -29,7 +29,7 @@ def parse_api_response(resp):
 
     Raise if there were any issues.
 
-    :param requests.Response resp: A response from the slack API
+    :param ledge.helpers.http.Response resp: A response from the slack API
     :rtype: None
     """
     # If this goes off something went really wrong - the Slack API should respond
@@ -49,20 +49,19 @@ def say_something(channel, msg, oauth_token):
     :param str msg: The message to the send to the channel
     :rtype: None
     """
-    # Slack is picky about including the encoding on the Content-Type header
-    resp = requests.post(
+    # Slack is picky about including the encoding on the Content-Type header.
+    # The shared client reuses its connection to slack between messages.
+    resp = blocking_client().post(
         "https://slack.com/api/chat.postMessage?charset=utf8",
         json={"channel": channel, "text": msg},
         headers={
             "Content-Type": "application/json; charset=utf-8",
             "Authorization": "Bearer {}".format(oauth_token),
         },
-        timeout=10,
     )
     parse_api_response(resp)
 
 
-
 class SlackySubConfig:  # pylint: disable=too-few-public-methods
     """Slack Responder subconfig."""
 
@@ -79,32 +78,26 @@ class Slacky(HandlerImplementation):
         """
         Handle requests if they...
 
+        - Contain the required json keys (checked first, as it's cheap)
         - Are verifiably from slack
-        - Deserialize from JSON
-        - Contain the required json keys
         """
-        if not verify_slack_request(
-            request,
-            content,
-            self.config.slack_url_verification_responder.signing_secret,
-        ):
-            return False
-
         try:
-            request_json = content_to_json(content)
+            if not lazy_json(content, request=request).get("event.channel"):
+                return False
         except json.JSONDecodeError:
             return False
 
-        if not request_json.get("event"):
-            return False
-        if not request_json["event"].get("channel"):
-            return False
-        return True
+        return verify_slack_request(
+            request,
+            content,
+            self.config.slack_url_verification_responder.signing_secret,
+        )
 
     def handle(self, request, content):
-        request_json = content_to_json(content)
-        channel = glom(request_json, "event.channel")
+        channel = lazy_json(content, request=request).get("event.channel")
         msg = "Hello World!"
         say_something(
-            channel, msg, self.config.slacky.oauth_token,
+            channel,
+            msg,
+            self.config.slacky.oauth_token,
         )
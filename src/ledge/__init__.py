@@ -1,11 +1,21 @@
 """ledge: A pluggable webhook catcher."""
 
-# flake8: noqa
-
 __author__ = "Brian Balsamo"
 __email__ = "Brian@BrianBalsamo.com"
 __version__ = "0.4.0"
 
+from ._lazy_imports import lazy_getattr
+
+# Nothing else (notably, not the reactor) is imported until it's used, so
+# plugins can import ledge cheaply and `start` can select the reactor.
+_ATTRIBUTES = {
+    "HandlerImplementation": "._bases",
+    "ResponderImplementation": "._bases",
+    "Body": "._body",
+    "start": "._cmds",
+    "Match": "._dispatch",
+}
+
+__all__ = list(_ATTRIBUTES)
 
-from ._bases import HandlerImplementation, ResponderImplementation
-from ._cmds import start
+__getattr__ = lazy_getattr(__name__, _ATTRIBUTES)
@@ -0,0 +1,111 @@
+"""Admission control for incoming requests."""
+
+import threading
+import time
+
+
+class AdmissionController:
+    """
+    Decide whether ledge has the capacity to accept another request.
+
+    Requests are rejected when accepting them would exceed the configured
+    maximum number of outstanding handler jobs, or the maximum number of
+    bytes of content held by outstanding requests.
+
+    If a latency target is configured the controller also sheds load
+    CoDel-style: once every handler job started over the course of an
+    interval has waited longer than the target in the queue, new requests
+    are rejected until a job starts within the target or the queue drains.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        max_jobs=None,
+        max_bytes=None,
+        target=None,
+        interval=0.1,
+        clock=time.monotonic,
+    ):
+        """
+        Set the limits.
+
+        :param int max_jobs: The maximum number of outstanding handler jobs.
+        :param int max_bytes: The maximum number of bytes of content held by
+            outstanding requests.
+        :param float target: The acceptable queueing delay, in seconds.
+        :param float interval: How long (in seconds) the queueing delay must
+            stay above target before load is shed.
+        :param callable clock: Returns the current time, in seconds.
+        """
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.target = target
+        self.interval = interval
+        self.clock = clock
+        self.queued_jobs = 0
+        self.inflight_bytes = 0
+        self.dropping = False
+        self._first_above = None
+        self._lock = threading.Lock()
+
+    def admit(self, size):
+        """
+        Check whether a request with the given content size can be accepted.
+
+        :param int size: The length of the request content.
+
+        :rtype: bool
+        """
+        if self.dropping:
+            return False
+        if self.max_jobs is not None and self.queued_jobs >= self.max_jobs:
+            return False
+        if self.max_bytes is not None and self.inflight_bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def request_started(self, size, jobs):
+        """
+        Account for an accepted request and its handler jobs.
+
+        :param int size: The length of the request content.
+        :param int jobs: The number of handler jobs scheduled for it.
+        """
+        self.inflight_bytes += size
+        self.queued_jobs += jobs
+
+    def job_finished(self):
+        """Account for a finished handler job."""
+        self.queued_jobs -= 1
+        if self.queued_jobs <= 0:
+            with self._lock:
+                self.dropping = False
+                self._first_above = None
+
+    def request_finished(self, size):
+        """
+        Account for a request whose handler jobs have all finished.
+
+        :param int size: The length of the request content.
+        """
+        self.inflight_bytes -= size
+
+    def record_sojourn(self, sojourn):
+        """
+        Record how long a handler job waited before it started.
+
+        Safe to call from any thread.
+
+        :param float sojourn: The queueing delay, in seconds.
+        """
+        if self.target is None:
+            return
+        now = self.clock()
+        with self._lock:
+            if sojourn < self.target:
+                self._first_above = None
+                self.dropping = False
+            elif self._first_above is None:
+                self._first_above = now + self.interval
+            elif now >= self._first_above:
+                self.dropping = True
@@ -1,36 +1,428 @@
 """Ledge application logic."""
 
-from twisted.internet import reactor, task
+import inspect
+
+from twisted.internet import defer, reactor, task
+
+from ._admission import AdmissionController
+from ._async import as_deferred, maybe_deferred
+from ._config import thread_pool_config_name
+from ._context import get_context, mark_after
+from ._dedup import DedupCache, key_extractor
+from ._dispatch import DispatchIndex
+from ._metrics import Metrics
+from ._process_pool import abandon_shared_pool
+from ._threadpools import HandlerThreadPool
+from ._utils import inject_logger
+from ._wal import WriteAheadLog
+
+
+def _respond(request, content, responder):
+    """Call the responder's `respond` method, marking when it's done."""
+    context = get_context(request)
+    if context is None:
+        return maybe_deferred(responder.respond(request, content))
+    context.mark("respond_started", responder.name)
+    result = maybe_deferred(responder.respond(request, content))
+    if isinstance(result, defer.Deferred):
+        return result.addBoth(mark_after, context, "respond_finished", responder.name)
+    context.mark("respond_finished", responder.name)
+    return result
+
+
+#: The settings which, if changed by a reload, mean state is created anew.
+_ADMISSION_SETTINGS = (
+    "max_queued_handler_jobs",
+    "max_inflight_bytes",
+    "shed_latency_target",
+    "shed_interval",
+)
+_DEDUP_SETTINGS = ("idempotency_key", "dedup_ttl", "dedup_max_entries")
 
 
 class Ledge:
     """The application itself."""
 
-    def __init__(self, config, init_handlers=True, init_responders=True):
+    def __init__(self, config, init_handlers=True, init_responders=True, previous=None):
         """
         Attach the config to the instance.
 
         If the corresponding kwargs are passed call init_handlers and
         init_responders.
+
+        If a previous (running) instance this one replaces is passed, its
+        metrics are carried over, as are its admission control, write-ahead
+        log and remembered idempotency keys, if their settings are unchanged.
+        Otherwise they're created anew (or dropped, if no longer enabled).
         """
         self.config = config
         self._responders = []
         self._handlers = []
+        # Responses and handler jobs which haven't finished, see drain. Maps
+        # their deferreds to (what they are, the request id)
+        self._pending = {}
+        # Requests which have been admitted, but not yet handled
+        self._admitted = set()
+        self._init_state(config, previous)
+        self.metrics.thread_pool_stats = self.thread_pool_stats
+        if self.dedup is not None:
+            self._idempotency_key = key_extractor(config.idempotency_key)
 
         if init_handlers:
             self.init_handlers()
         if init_responders:
             self.init_responders()
 
+    def _init_state(self, config, previous=None):
+        """Create the state which outlives the plugins, or carry it over."""
+
+        def _unchanged(settings):
+            return previous is not None and all(
+                getattr(config, name) == getattr(previous.config, name)
+                for name in settings
+            )
+
+        if _unchanged(_ADMISSION_SETTINGS):
+            self.admission = previous.admission
+        else:
+            self.admission = AdmissionController(
+                max_jobs=config.max_queued_handler_jobs,
+                max_bytes=config.max_inflight_bytes,
+                target=config.shed_latency_target,
+                interval=config.shed_interval,
+            )
+
+        self.wal = None
+        if _unchanged(("wal_dir",)):
+            # Opening the directory again would replay the live entries, so
+            # only the segment size can change
+            self.wal = previous.wal
+            if self.wal is not None:
+                self.wal.segment_size = config.wal_segment_size
+        elif config.wal_dir is not None:
+            self.wal = WriteAheadLog(
+                config.wal_dir, segment_size=config.wal_segment_size
+            )
+
+        self.metrics = Metrics() if previous is None else previous.metrics
+
+        self.dedup = None
+        if _unchanged(_DEDUP_SETTINGS):
+            self.dedup = previous.dedup
+        elif config.idempotency_key is not None:
+            self.dedup = DedupCache(config.dedup_ttl, config.dedup_max_entries)
+            if config.dedup_snapshot is not None:
+                self.dedup.load(config.dedup_snapshot)
+
+    @property
+    def _handlers(self):
+        """The initialized handlers, in their configured order."""
+        return self._handler_index.plugins
+
+    @_handlers.setter
+    def _handlers(self, handlers):
+        """Set the handlers, recompiling the dispatch index."""
+        self._handler_index = DispatchIndex(handlers)
+
+    @property
+    def _responders(self):
+        """The initialized responders, in their configured order."""
+        return self._responder_index.plugins
+
+    @_responders.setter
+    def _responders(self, responders):
+        """Set the responders, recompiling the dispatch index."""
+        self._responder_index = DispatchIndex(responders)
+
     def init_handlers(self):
-        """Initialize the handlers specified in the config."""
-        for impl in self.config.handlers:
-            self._handlers.append(impl(self.config))
+        """
+        Initialize the handlers specified in the config.
+
+        Gives each threaded handler its own thread pool, and compiles their
+        match specifications into a dispatch index.
+        """
+        handlers = [impl(self.config) for impl in self.config.handlers]
+        for handler in handlers:
+            pool_config = getattr(
+                self.config, thread_pool_config_name(type(handler)), None
+            )
+            if handler.uses_thread_pool() and pool_config is not None:
+                handler.thread_pool = HandlerThreadPool(
+                    f"ledge-{handler.name}",
+                    min_threads=pool_config.min_threads,
+                    max_threads=pool_config.max_threads,
+                    max_jobs=pool_config.max_jobs,
+                )
+        self._handlers = self._handlers + handlers
+
+    def thread_pool_stats(self):
+        """
+        Describe the state of each handler's thread pool.
+
+        :rtype: dict
+        :returns: Handler names mapped to :meth:`HandlerThreadPool.stats`.
+        """
+        return {
+            handler.name: handler.thread_pool.stats()
+            for handler in self._handlers
+            if isinstance(getattr(handler, "thread_pool", None), HandlerThreadPool)
+        }
 
     def init_responders(self):
-        """Initialize the responders specified in the config."""
-        for impl in self.config.responders:
-            self._responders.append(impl(self.config))
+        """
+        Initialize the responders specified in the config.
+
+        Compiles their match specifications into a dispatch index.
+        """
+        self._responders = self._responders + [
+            impl(self.config) for impl in self.config.responders
+        ]
+
+    def could_match(self, method, path):
+        """
+        Check whether any plugin could be interested in a request.
+
+        :param bytes method: The request method.
+        :param bytes path: The request path.
+
+        :rtype: bool
+        """
+        indexes = (self._handler_index, self._responder_index)
+        return any(index.could_match(method, path) for index in indexes)
+
+    def admit(self, request, content):  # pylint: disable=unused-argument
+        """
+        Check whether there is capacity to accept the request.
+
+        :param twisted.web.http.Request request: The incoming request.
+        :param bytes content: The content of the request.
+
+        :rtype: bool
+        :returns: False if the request should be rejected to shed load.
+        """
+        if not self.admission.admit(len(content)):
+            return False
+        self._admitted.add(request)
+        return True
+
+    def _observe(self, context, event, plugin, timestamp):
+        """Feed handler queueing delays to the admission controller."""
+        if event == "handler_started":
+            queued = context.timings.get(("handler_queued", plugin))
+            if queued is not None:
+                self.admission.record_sojourn(timestamp - queued)
+
+    def idempotency_key(self, request, content):
+        """
+        Extract the request's idempotency key, if requests are deduplicated.
+
+        See the LEDGE_IDEMPOTENCY_KEY configuration.
+
+        :param twisted.web.http.Request request: The incoming request.
+        :param bytes content: The content of the request.
+
+        :rtype: str
+        :returns: The key, or None if the request has none.
+        """
+        if self.dedup is None:
+            return None
+        return self._idempotency_key(request, content)
+
+    def _forget_if_failed(self, key, handler_ds):
+        """Forget a request's key if its handlers fail, so retries run them."""
+        pending = [d for d in handler_ds if isinstance(d, defer.Deferred)]
+
+        def _forget(results):
+            if not all(success for success, _ in results):
+                self.dedup.forget(key)
+
+        defer.DeferredList(pending).addCallback(_forget)
+
+    def save_dedup_snapshot(self):
+        """Save the remembered idempotency keys, if configured to."""
+        if self.dedup is not None and self.config.dedup_snapshot is not None:
+            self.dedup.save(self.config.dedup_snapshot)
+
+    def _track_pending(self, request, labelled):
+        """
+        Remember deferreds until they fire, so the app can be drained.
+
+        :param request: The request the deferreds are working on.
+        :param labelled: (what it is, deferred) pairs, eg: the handler name.
+        """
+        context = get_context(request)
+        request_id = None if context is None else context.request_id
+        for label, pending in labelled:
+            if isinstance(pending, defer.Deferred) and not pending.called:
+                self._pending[pending] = (label, request_id)
+                pending.addBoth(self._settled, pending)
+
+    def _settled(self, result, pending):
+        """Forget a deferred which has fired, passing its result through."""
+        self._pending.pop(pending, None)
+        return result
+
+    def _settle(self, waited=0):
+        """Wait until nothing is pending, counting the deferreds waited for."""
+        if self._admitted:
+            # Admitted requests are handled on the reactor's next iteration
+            return task.deferLater(reactor, 0, self._settle, waited)
+        if not self._pending:
+            return defer.succeed(waited)
+        pending = list(self._pending)
+        return defer.DeferredList(pending).addCallback(
+            lambda _: self._settle(waited + len(pending))
+        )
+
+    def drain(self):
+        """
+        Wait for the outstanding responses and handler jobs to finish.
+
+        Used once the instance has been replaced (see :func:`ledge._cmds.reload`)
+        or ledge is shutting down (see :func:`ledge._cmds.shutdown`), so no new
+        requests are arriving. Buffered batches are run straight away, and the
+        handlers' thread pools are stopped once everything has finished.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires with the number of deferreds waited
+            for, once they've all fired.
+        """
+        for handler in self._handlers:
+            if getattr(handler, "batcher", None) is not None:
+                handler.batcher.flush()
+
+        def _stop_thread_pools(waited):
+            for handler in self._handlers:
+                if isinstance(getattr(handler, "thread_pool", None), HandlerThreadPool):
+                    handler.thread_pool.stop()
+            return waited
+
+        return self._settle().addCallback(_stop_thread_pools)
+
+    def abandon(self):
+        """
+        Give up on the outstanding handler jobs, so shutdown doesn't wait.
+
+        The handlers' thread pools are left running (their daemon threads
+        are abandoned on exit), and the process pool's workers are stopped.
+        """
+        for handler in self._handlers:
+            if isinstance(getattr(handler, "thread_pool", None), HandlerThreadPool):
+                handler.thread_pool.abandon()
+        abandon_shared_pool()
+
+    def outstanding(self):
+        """
+        Describe the responses and handler jobs which haven't finished.
+
+        :rtype: List[Tuple[str, str]]
+        :returns: (what it is, request id) pairs. What it is is "response",
+            or "handler " followed by the handler's name.
+        """
+        return list(self._pending.values())
+
+    def _handler_finished(self, result):
+        """Account for a finished handler job, passing its result through."""
+        self.admission.job_finished()
+        return result
+
+    def _track_handlers(self, content, handler_ds):
+        """Account for the outstanding handler jobs of a request."""
+        pending = [d for d in handler_ds if isinstance(d, defer.Deferred)]
+        if not pending:
+            return
+        size = len(content)
+        self.admission.request_started(size, len(pending))
+        for handler_deferred in pending:
+            handler_deferred.addBoth(self._handler_finished)
+        defer.DeferredList(pending).addCallback(
+            lambda _: self.admission.request_finished(size)
+        )
+
+    def _complete_entry(self, durable_d, handler_ds):
+        """Mark a log entry done once it's durable and its handlers finished."""
+        pending = [d for d in handler_ds if isinstance(d, defer.Deferred)]
+
+        def _mark_done_when_handled(entry_id):
+            defer.DeferredList(pending).addCallback(
+                lambda _: self.wal.mark_done(entry_id)
+            )
+            return entry_id
+
+        durable_d.addCallback(_mark_done_when_handled)
+
+    def _handle_when_durable(self, durable_d, request, content):
+        """
+        Schedule the handlers once the request is durably logged.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires once the handlers have finished, or
+            fails if any of them did, or if the request couldn't be logged.
+        """
+        handled_d = defer.Deferred()
+
+        def _schedule(entry_id):
+            handler_ds = self.schedule_handlers(request, content)
+            self._track_handlers(content, handler_ds)
+            self._complete_entry(defer.succeed(entry_id), handler_ds)
+            pending = [d for d in handler_ds if isinstance(d, defer.Deferred)]
+            defer.gatherResults(pending, consumeErrors=True).chainDeferred(handled_d)
+            return entry_id
+
+        def _not_logged(failure):
+            handled_d.errback(failure)
+            return failure
+
+        durable_d.addCallbacks(_schedule, _not_logged)
+        return handled_d
+
+    def replay(self):
+        """
+        Schedule the handlers for requests recovered from the write-ahead log.
+
+        These are requests which were accepted, but whose handlers hadn't all
+        finished when ledge stopped. Responders aren't involved.
+
+        :rtype: List[`twisted.internet.defer.Deferred`]
+        :returns: A list of deferreds representing the eventual handler results.
+        """
+        if self.wal is None:
+            return []
+        results = []
+        while self.wal.recovered:
+            entry_id, request, content = self.wal.recovered.pop(0)
+            inject_logger(request)
+            request.logger.msg("Replaying request from the write-ahead log.")
+            handler_ds = self.schedule_handlers(request, content)
+            self._track_handlers(content, handler_ds)
+            self._complete_entry(defer.succeed(entry_id), handler_ds)
+            results.extend(handler_ds)
+        return results
+
+    @staticmethod
+    def _log_summary(request, context, response_d, handler_ds):
+        """Log the request's timings, once everything it started has settled."""
+        pending = [
+            d for d in [response_d, *handler_ds] if isinstance(d, defer.Deferred)
+        ]
+        notify_finish = getattr(request, "notifyFinish", None)
+        finished_d = None if notify_finish is None else notify_finish()
+        if isinstance(finished_d, defer.Deferred):
+            finished_d.addCallbacks(
+                lambda _: context.mark("response_finished"),
+                lambda _: context.mark("response_abandoned"),
+            )
+            pending.append(finished_d)
+        defer.DeferredList(pending).addCallback(
+            lambda _: request.logger.msg("Request complete.", **context.summary())
+        )
+
+    def _unavailable(self, request):
+        """Reject a request which can't be logged, see LEDGE_WAL_DIR."""
+        request.logger.msg("Write-ahead log failed - rejecting request.")
+        request.setResponseCode(503)
+        request.setHeader("Retry-After", str(self.config.retry_after))
+        request.finish()
 
     def _default_response(self, request):  # pylint: disable=no-self-use
         """Return an empty response, with status code 200."""
@@ -41,9 +433,9 @@ class Ledge:
         """
         Schedule the response to the request.
 
-        This method iterates through all the assigned responders, if one
-        reports that it handles the request that responder will send the
-        response.
+        This method iterates through the assigned responders which may match
+        the request (see :class:`ledge.Match`), if one reports that it handles
+        the request that responder will send the response.
 
         If no responders are interested in the request self._default_response
         will be called.
@@ -51,6 +443,7 @@ class Ledge:
         All functions are called via reactor.callLater so we can move on
         to dealing with the handlers. However eventually all the response
         functions will run in the reactor thread (so they shouldn't block).
+        Responder `handles` and `respond` methods may be coroutines.
 
         :param twisted.web.http.Request request: The incoming request.
         :param bytes content: The content of the request.
@@ -58,19 +451,63 @@ class Ledge:
         :rtype: `twisted.internet.defer.Deferred`
         :returns: A deferred representing the eventual response to the request.
         """
-        for responder in self._responders:
-            if responder.handles(request, content):
-                request.logger.msg(f"Responder {responder.name} handles this request.")
-                return task.deferLater(reactor, 0, responder.respond, request, content)
+        return self._select_responder(
+            request, content, self._responder_index.candidates(request, content)
+        )
+
+    def _select_responder(self, request, content, candidates):
+        """Schedule the first of the candidates which handles the request."""
+        context = get_context(request)
+        for position, responder in enumerate(candidates):
+            if context is not None:
+                context.mark("handles_started", responder.name)
+            handles = responder.handles(request, content)
+            if inspect.isawaitable(handles):
+                # Wait for the coroutine to decide before moving on
+                remaining = position + 1
+                return as_deferred(handles).addCallback(
+                    self._responder_decided,
+                    request,
+                    content,
+                    responder,
+                    candidates[remaining:],
+                )
+            if context is not None:
+                context.mark("handles_finished", responder.name)
+            if handles:
+                return self._schedule_respond(request, content, responder)
         request.logger.msg("No responders detected for request. Using default.")
+        if context is not None:
+            context.mark("responder_scheduled")
         return task.deferLater(reactor, 0, self._default_response, request)
 
+    def _responder_decided(  # pylint: disable=too-many-arguments
+        self, handles, request, content, responder, remaining
+    ):
+        """Continue responder selection, once a coroutine `handles` returns."""
+        context = get_context(request)
+        if context is not None:
+            context.mark("handles_finished", responder.name)
+        if handles:
+            return self._schedule_respond(request, content, responder)
+        return self._select_responder(request, content, remaining)
+
+    @staticmethod
+    def _schedule_respond(request, content, responder):
+        """Schedule the responder's `respond` method."""
+        request.logger.msg(f"Responder {responder.name} handles this request.")
+        context = get_context(request)
+        if context is not None:
+            context.mark("responder_scheduled", responder.name)
+        return task.deferLater(reactor, 0, _respond, request, content, responder)
+
     def schedule_handlers(self, request, content):
         """
         Schedule the appropriate handlers to run.
 
-        These can run in either the reactor thread or their own thread, depending
-        on the plugin class.
+        Only handlers which may match the request (see :class:`ledge.Match`)
+        are considered. These can run in either the reactor thread or their
+        own thread, depending on the plugin class.
 
         :param twisted.web.http.Request request: The incoming request.
         :param bytes content: The content of the request.
@@ -78,16 +515,21 @@ class Ledge:
         :rtype: List[`twisted.internet.defer.Deferred]
         :returns: A list of deferreds representing the eventual handler results.
         """
-        results = []
-        for handler in self._handlers:
+        results, labels = [], []
+        for handler in self._handler_index.candidates(request, content):
             # Handler.process returns a deferred
             results.append(handler.process(request, content))
+            labels.append(f"handler {handler.name}")
+        self._track_pending(request, zip(labels, results))
         return results
 
     def handle_request(self, request, content):
         """
         Schedule a response + schedule the handlers.
 
+        Requests redelivering one already accepted (see
+        :meth:`idempotency_key`) are responded to, but not handled again.
+
         :param twisted.web.http.Request request: The incoming request.
         :param bytes content: The content of the request.
 
@@ -98,7 +540,34 @@ class Ledge:
           the eventual response to the request, and the second element being a list
           of deferreds representing the eventual results of all handlers.
         """
-        return (
-            self.schedule_response(request, content),
-            self.schedule_handlers(request, content),
-        )
+        self._admitted.discard(request)
+        context = get_context(request)
+        if context is not None:
+            context.observers.append(self._observe)
+            context.observers.append(self.metrics.observe_event)
+        if self.wal is not None and self.wal.error is not None:
+            # Requests can't be accepted if they can't be logged
+            return self._unavailable(request), []
+        key = self.idempotency_key(request, content)
+        if key is not None and self.dedup.seen(key):
+            request.logger.msg("Duplicate delivery - skipping handlers.")
+            response_d, handler_ds = self.schedule_response(request, content), []
+        elif self.wal is None:
+            response_d = self.schedule_response(request, content)
+            handler_ds = self.schedule_handlers(request, content)
+            self._track_handlers(content, handler_ds)
+        else:
+            # Don't act on, or acknowledge, the request until it's durably
+            # logged, so a 503 always means it can be retried safely.
+            durable_d = self.wal.append(request, content)
+            handler_ds = [self._handle_when_durable(durable_d, request, content)]
+            response_d = durable_d.addCallbacks(
+                lambda _: self.schedule_response(request, content),
+                lambda _: self._unavailable(request),
+            )
+        self._track_pending(request, [("response", response_d)])
+        if key is not None:
+            self._forget_if_failed(key, handler_ds)
+        if context is not None:
+            self._log_summary(request, context, response_d, handler_ds)
+        return response_d, handler_ds
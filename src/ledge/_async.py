@@ -0,0 +1,85 @@
+"""Support for plugins implemented with `async def`."""
+
+import asyncio
+import inspect
+import os
+import sys
+
+from twisted.internet import defer
+from twisted.internet.error import ReactorAlreadyInstalledError
+
+#: The reactors which can be selected via LEDGE_REACTOR.
+REACTORS = ("default", "asyncio")
+
+
+def install_reactor(name=None):
+    """
+    Install the named reactor, if no reactor has been installed yet.
+
+    This must happen before `twisted.internet.reactor` is first imported.
+
+    :param str name: One of :data:`REACTORS`, defaults to the value of the
+        LEDGE_REACTOR environmental variable.
+
+    :raises ReactorAlreadyInstalledError: If a different reactor than the
+        one named has already been installed (the default reactor is
+        satisfied by any).
+    """
+    if name is None:
+        name = os.environ.get("LEDGE_REACTOR", "default")
+    if name not in REACTORS:
+        raise ValueError(f"Unknown reactor {name!r}, expected one of {REACTORS}")
+    if name != "asyncio":
+        return
+    installed = sys.modules.get("twisted.internet.reactor")
+    if installed is not None:
+        if not _running_on_asyncio():
+            raise ReactorAlreadyInstalledError(
+                f"Can't install the asyncio reactor, {type(installed).__name__} "
+                "was installed first (by twisted.internet.reactor being "
+                "imported before the reactor was selected)"
+            )
+    else:
+        from twisted.internet import (  # pylint: disable=import-outside-toplevel
+            asyncioreactor,
+        )
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        asyncioreactor.install(loop)
+
+
+def _running_on_asyncio():
+    """Return True if the installed reactor runs an asyncio event loop."""
+    from twisted.internet import (  # pylint: disable=import-outside-toplevel
+        asyncioreactor,
+        reactor,
+    )
+
+    return isinstance(reactor, asyncioreactor.AsyncioSelectorReactor)
+
+
+def as_deferred(awaitable):
+    """
+    Run a coroutine (or other awaitable), returning a Deferred of its result.
+
+    On the asyncio reactor the coroutine runs as an asyncio task, so it may
+    await asyncio code (use `Deferred.asFuture` to await Deferreds). On any
+    other reactor it is driven by Twisted, and may await Deferreds.
+
+    :rtype: `twisted.internet.defer.Deferred`
+    """
+    if _running_on_asyncio():
+        return defer.Deferred.fromFuture(asyncio.ensure_future(awaitable))
+    return defer.ensureDeferred(awaitable)
+
+
+def maybe_deferred(result):
+    """
+    Wrap awaitable results as Deferreds, pass anything else through.
+
+    Returning the wrapped result from a Deferred callback chains it.
+    """
+    if inspect.isawaitable(result):
+        return as_deferred(result)
+    return result
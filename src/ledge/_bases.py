@@ -1,9 +1,20 @@
 """Base classes for plugin implementations."""
+
+import inspect
+from functools import partial
 from typing import Optional
+from weakref import WeakKeyDictionary
 
 import environ
-from twisted.internet import reactor, task, threads
-
+from twisted.internet import defer, task, threads
+
+from ledge._async import as_deferred
+from ledge._batching import Batcher
+from ledge._config import config_snapshot
+from ledge._context import get_context, mark_after
+from ledge._dispatch import Match
+from ledge._process_pool import run_batch_in_pool, run_in_pool
+from ledge._threadpools import HandlerThreadPool
 from ledge._utils import make_name_safe
 
 unset_names = {
@@ -13,6 +24,103 @@ unset_names = {
 }
 
 
+# Handler -> DeferredSemaphore, limiting its concurrent coroutines
+_concurrency_limits: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def _run_handle(handler, context, request, content):
+    """Mark the handler as started, then call it."""
+    if context is not None:
+        context.mark("handler_started", handler.name)
+    return handler.handle(request, content)
+
+
+def _run_coroutine_handle(handler, context, request, content):
+    """Run a coroutine handler, respecting its concurrency limit."""
+    limit = getattr(handler, "MAX_CONCURRENCY", None)
+    if limit is None:
+        return as_deferred(_run_handle(handler, context, request, content))
+    if handler not in _concurrency_limits:
+        _concurrency_limits[handler] = defer.DeferredSemaphore(limit)
+    return _concurrency_limits[handler].run(
+        lambda: as_deferred(_run_handle(handler, context, request, content))
+    )
+
+
+def _run_handle_batch(handler, events):
+    """Mark the handler as started for each event, then call it."""
+    for event in events:
+        context = get_context(event.request)
+        if context is not None:
+            context.mark("handler_started", handler.name)
+    return handler.handle_batch(events)
+
+
+def _schedule_batch(handler, events):
+    """Run a batch of events, the same way the handler would run one."""
+    if inspect.iscoroutinefunction(handler.handle_batch):
+        return as_deferred(_run_handle_batch(handler, events))
+    if hasattr(handler, "THREAD_SAFE") and (not handler.THREAD_SAFE):
+        return _run_handle_batch(handler, events)
+    if getattr(handler, "EXECUTION_MODE", None) == handler.EXECUTION_PROCESS:
+        return run_batch_in_pool(handler, events)
+    thread_pool = getattr(handler, "thread_pool", None)
+    if isinstance(thread_pool, HandlerThreadPool):
+        return thread_pool.submit(_run_handle_batch, handler, events)
+    return threads.deferToThread(_run_handle_batch, handler, events)
+
+
+def _handles_decided(handles, handler, request, content):
+    """Mark the end of the handler's `handles` call, then act on it."""
+    context = get_context(request)
+    if context is not None:
+        context.mark("handles_finished", handler.name)
+    return _handle_if_handles(handles, handler, request, content)
+
+
+def _handle_if_handles(handles, handler, request, content):
+    """Schedule the handler's `handle` method, if it handles the request."""
+    if not handles:
+        request.logger.msg(f"Handler {handler.name} doesn't handle this request.")
+        return None
+    request.logger.msg(f"Handler {handler.name} handles this request.")
+    context = get_context(request)
+    if context is not None:
+        context.mark("handler_queued", handler.name)
+    result = _schedule_handle(handler, context, request, content)
+    if context is not None and isinstance(result, defer.Deferred):
+        result.addBoth(mark_after, context, "handler_finished", handler.name)
+    return result
+
+
+def _schedule_handle(handler, context, request, content):
+    """Schedule the handler's `handle` method, as the handler requires."""
+    # Imported here so importing ledge (eg: to subclass the plugin
+    # interfaces) doesn't install the default reactor
+    from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+    batcher = getattr(handler, "batcher", None)
+    if isinstance(batcher, Batcher):
+        return batcher.add(request, content)
+    if inspect.iscoroutinefunction(handler.handle):
+        return task.deferLater(
+            reactor, 0, _run_coroutine_handle, handler, context, request, content
+        )
+    if hasattr(handler, "THREAD_SAFE") and (not handler.THREAD_SAFE):
+        return task.deferLater(
+            reactor, 0, _run_handle, handler, context, request, content
+        )
+    if getattr(handler, "EXECUTION_MODE", None) == handler.EXECUTION_PROCESS:
+        # The worker process can't mark when it starts, this is the closest
+        if context is not None:
+            context.mark("handler_started", handler.name)
+        return run_in_pool(handler, request, content)
+    thread_pool = getattr(handler, "thread_pool", None)
+    if isinstance(thread_pool, HandlerThreadPool):
+        return thread_pool.submit(_run_handle, handler, context, request, content)
+    return threads.deferToThread(_run_handle, handler, context, request, content)
+
+
 class _Configurable:
     """
     Interface for classes that can provide subconfigs.
@@ -30,7 +138,7 @@ class _Configurable:
     #: if you need to pass a subconfig up to the ledge configuration.
     #: It is expected to be a class that can be provided to
     #: :func:`environ.config`
-    subconfig = None  # type: Optional[type]
+    subconfig: Optional[type] = None
 
     def __init__(self):
         """Check cls.name is set."""
@@ -70,6 +178,40 @@ class HandlerImplementation(_Configurable):
     #: the reactor thread (blocking it).
     THREAD_SAFE = True
 
+    #: How the handler is run, if it is thread safe. Either
+    #: :attr:`EXECUTION_THREAD` (the default) or :attr:`EXECUTION_PROCESS`.
+    #: In a process the handler (which must be picklable) receives a
+    #: :class:`ledge._process_pool.RequestSnapshot` rather than the request,
+    #: and the request content as bytes.
+    EXECUTION_MODE = "thread"
+
+    #: Run the handler in the reactor's thread pool.
+    EXECUTION_THREAD = "thread"
+
+    #: Run the handler in a process pool, for CPU bound work.
+    EXECUTION_PROCESS = "process"
+
+    #: The maximum number of concurrent calls to `handle`, if it is a
+    #: coroutine function (`async def`). If None there is no limit.
+    MAX_CONCURRENCY: Optional[int] = None
+
+    #: Threaded handlers run in a thread pool of their own, so a slow
+    #: handler can't starve the others. These are the defaults for its
+    #: minimum and maximum size, and the maximum number of jobs which may be
+    #: queued or running in it (None for no limit). They can be overridden
+    #: via the handler's thread pool subconfig.
+    THREAD_POOL_MIN = 0
+    THREAD_POOL_MAX = 10
+    MAX_QUEUED_JOBS: Optional[int] = None
+
+    #: If set, requests are buffered and passed to `handle_batch` in
+    #: batches of at most this many, rather than to `handle` one at a time.
+    BATCH_SIZE: Optional[int] = None
+
+    #: The maximum time, in seconds, a request is buffered for before its
+    #: (possibly incomplete) batch is handled, if batching.
+    BATCH_INTERVAL = 1.0
+
     #: The handler's name. Used for logging and naming the subconfig.
     #: Override this in your plugin implementation. Leaving it set to the
     #: default will raise an error on init-ing your implementation.
@@ -81,13 +223,52 @@ class HandlerImplementation(_Configurable):
     #: if you need to pass a subconfig up to the ledge configuration.
     #: It is expected to be a class that can be provided to
     #: :func:`environ.config`
-    subconfig = None  # type: Optional[type]
+    subconfig: Optional[type] = None
+
+    #: An optional :class:`ledge.Match` describing the requests this plugin
+    #: is interested in. Requests which can't match are never passed to the
+    #: plugin, and if it is set `handles` need not be implemented.
+    match: Optional[Match] = None
 
     def __init__(self, config):
         """Attach the config to the instance."""
         self.config = config
+        #: The handler's dedicated thread pool, assigned by ledge.
+        self.thread_pool = None
+        #: The handler's :class:`ledge._batching.Batcher`, if it batches.
+        self.batcher = None
+        if self.BATCH_SIZE is not None:
+            self.batcher = Batcher(
+                partial(_schedule_batch, self), self.BATCH_SIZE, self.BATCH_INTERVAL
+            )
         super().__init__()
 
+    def __getstate__(self):
+        """
+        Leave the handler's scheduling machinery behind, when pickled.
+
+        The config is replaced with a picklable snapshot of it.
+        """
+        state = dict(self.__dict__)
+        state["config"] = config_snapshot(self.config)
+        state["thread_pool"] = None
+        state["batcher"] = None
+        return state
+
+    @classmethod
+    def uses_thread_pool(cls):
+        """
+        Let ledge know if the handler runs in a thread pool.
+
+        :rtype: bool
+        """
+        method = cls.handle if cls.BATCH_SIZE is None else cls.handle_batch
+        return (
+            cls.THREAD_SAFE
+            and cls.EXECUTION_MODE == cls.EXECUTION_THREAD
+            and not inspect.iscoroutinefunction(method)
+        )
+
     def handles(self, request, content):
         """
         Implement this in your subclass.
@@ -95,6 +276,12 @@ class HandlerImplementation(_Configurable):
         It should return a bool, True if this implementation should
         handle the request, otherwise False.
 
+        If `self.match` is set this is only called for requests which match
+        it, and the default implementation returns True.
+
+        This may be a coroutine function (`async def`), in which case it is
+        run in the reactor thread.
+
         :param twisted.web.http.Request request: The incoming request.
         :param bytes content: The content of the incoming request.
 
@@ -102,6 +289,8 @@ class HandlerImplementation(_Configurable):
         :returns: Whether or not this implementation should handle the
             provided request.
         """
+        if self.match is not None:
+            return True
         raise NotImplementedError
 
     def handle(self, request, content):
@@ -109,13 +298,37 @@ class HandlerImplementation(_Configurable):
         Implement this in your subclass.
 
         Note that this method will be run its own thread, unless
-        self.THREAD_SAFE is false-y.
+        self.THREAD_SAFE is false-y, or in a worker process if
+        self.EXECUTION_MODE is :attr:`EXECUTION_PROCESS`.
+
+        If this is a coroutine function (`async def`) it is run in the
+        reactor thread, at most self.MAX_CONCURRENCY at a time.
 
         :param twisted.web.http.Request request: The incoming request.
         :param bytes content: The content of the incoming request.
         """
         raise NotImplementedError
 
+    def handle_batch(self, events):
+        """
+        Implement this in your subclass, if self.BATCH_SIZE is set.
+
+        It is run the same way `handle` would be, with a batch of requests
+        which were buffered until either self.BATCH_SIZE of them arrived or
+        self.BATCH_INTERVAL passed. Buffered requests are also handled when
+        ledge shuts down.
+
+        :param list events: A :class:`ledge._batching.BatchEvent` for each
+            request, whose `request` and `content` attributes are the
+            arguments `handle` would have received.
+
+        :returns: None if every request was handled successfully, otherwise
+            a list with a result for each request, in order, where
+            exceptions mark the requests which failed. If this raises every
+            request in the batch fails.
+        """
+        raise NotImplementedError
+
     def process(self, request, content):
         """
         Process the request.
@@ -131,13 +344,15 @@ class HandlerImplementation(_Configurable):
         :param bytes content: The content of the incoming request.
         """
         request.logger.msg(f"Handler {self.name} processing request.")
-        if self.handles(request, content):
-            request.logger.msg(f"Handler {self.name} handles this request.")
-            if hasattr(self, "THREAD_SAFE") and (not self.THREAD_SAFE):
-                return task.deferLater(reactor, 0, self.handle, request, content)
-            return threads.deferToThread(self.handle, request, content)
-        request.logger.msg(f"Handler {self.name} doesn't handle this request.")
-        return None
+        context = get_context(request)
+        if context is not None:
+            context.mark("handles_started", self.name)
+        handles = self.handles(request, content)
+        if inspect.isawaitable(handles):
+            return as_deferred(handles).addCallback(
+                _handles_decided, self, request, content
+            )
+        return _handles_decided(handles, self, request, content)
 
 
 class ResponderImplementation(_Configurable):
@@ -154,7 +369,12 @@ class ResponderImplementation(_Configurable):
     #: if you need to pass a subconfig up to the ledge configuration.
     #: It is expected to be a class that can be provided to
     #: :func:`environ.config`
-    subconfig = None  # type: Optional[type]
+    subconfig: Optional[type] = None
+
+    #: An optional :class:`ledge.Match` describing the requests this plugin
+    #: is interested in. Requests which can't match are never passed to the
+    #: plugin, and if it is set `handles` need not be implemented.
+    match: Optional[Match] = None
 
     def __init__(self, config):
         """Attach the config to the instance."""
@@ -168,6 +388,12 @@ class ResponderImplementation(_Configurable):
         It should return a bool, True if this implementation should
         handle the request, otherwise False.
 
+        If `self.match` is set this is only called for requests which match
+        it, and the default implementation returns True.
+
+        This may be a coroutine function (`async def`), in which case it is
+        run in the reactor thread.
+
         :param twisted.web.http.Request request: The incoming request.
         :param bytes content: The content of the incoming request.
 
@@ -175,6 +401,8 @@ class ResponderImplementation(_Configurable):
         :returns: Whether or not this implementation should handle the
             provided request.
         """
+        if self.match is not None:
+            return True
         raise NotImplementedError
 
     def respond(self, request, content):
@@ -182,7 +410,7 @@ class ResponderImplementation(_Configurable):
         Implement this in your subclass.
 
         Note that this method will be run in the reactor thread, so it
-        should not block.
+        should not block. It may be a coroutine function (`async def`).
 
         At some point the implementation _must_ call `request.finish()`
 
@@ -0,0 +1,121 @@
+"""Buffer handler work into batches."""
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+
+
+class BatchEvent:  # pylint: disable=too-few-public-methods
+    """
+    A request buffered for a batching handler.
+
+    Lists of these are passed to `HandlerImplementation.handle_batch`.
+    """
+
+    def __init__(self, request, content):
+        """
+        Store the request and its content.
+
+        :param twisted.web.http.Request request: The incoming request.
+        :param bytes content: The content of the incoming request.
+        """
+        self.request = request
+        self.content = content
+
+    def __repr__(self):
+        """Represent the event."""
+        return f"<BatchEvent {self.request!r}>"
+
+
+class Batcher:
+    """
+    Collect events, running them as a batch once a size or time window closes.
+
+    A batch is run as soon as it reaches its maximum size, or once its
+    oldest event has waited (roughly) the maximum interval. Any buffered
+    events are run before the reactor shuts down.
+    """
+
+    def __init__(self, run, size, interval):
+        """
+        Configure the batcher.
+
+        :param callable run: Called with a list of :class:`BatchEvent` to run
+            a batch, returning a (Deferred of) None if every event succeeded
+            or a list with a result or exception for each event.
+        :param int size: The maximum number of events in a batch.
+        :param float interval: The maximum time, in seconds, an event is
+            buffered for.
+        """
+        self.run = run
+        self.size = size
+        self.interval = interval
+        self._pending = []
+        self._loop = task.LoopingCall(self.flush)
+        self._shutdown_registered = False
+
+    def add(self, request, content):
+        """
+        Buffer an event for the next batch.
+
+        :param twisted.web.http.Request request: The incoming request.
+        :param bytes content: The content of the incoming request.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires with the event's result once its
+            batch has run, or errbacks with the event's failure.
+        """
+        result = defer.Deferred()
+        self._pending.append((BatchEvent(request, content), result))
+        if len(self._pending) >= self.size:
+            self.flush()
+        elif not self._loop.running:
+            if not self._shutdown_registered:
+                # pylint: disable=import-outside-toplevel
+                from twisted.internet import reactor
+
+                reactor.addSystemEventTrigger("before", "shutdown", self.shutdown)
+                self._shutdown_registered = True
+            self._loop.start(self.interval, now=False)
+        return result
+
+    def flush(self):
+        """
+        Run the buffered events as a batch.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires once the batch has run.
+        """
+        pending, self._pending = self._pending, []
+        if self._loop.running:
+            self._loop.stop()
+        if not pending:
+            return defer.succeed(None)
+        events = [event for event, _ in pending]
+        results = [result for _, result in pending]
+        return defer.maybeDeferred(self.run, events).addBoth(self._deliver, results)
+
+    @staticmethod
+    def _deliver(outcome, results):
+        """Fire each event's deferred with its part of the batch's outcome."""
+        if isinstance(outcome, Failure):
+            for result in results:
+                result.errback(outcome)
+            return None
+        if outcome is None:
+            outcome = [None] * len(results)
+        if len(outcome) != len(results):
+            error = ValueError(
+                f"handle_batch returned {len(outcome)} results "
+                f"for {len(results)} events."
+            )
+            outcome = [error] * len(results)
+        for result, item in zip(results, outcome):
+            if isinstance(item, (Exception, Failure)):
+                result.errback(item)
+            else:
+                result.callback(item)
+        return None
+
+    def shutdown(self):
+        """Run any buffered events, before the reactor shuts down."""
+        return self.flush()
@@ -0,0 +1,112 @@
+"""Read-only request content which doesn't have to live in memory."""
+
+import io
+import mmap
+import os
+
+#: The default size of the chunks yielded by :meth:`Body.chunks`.
+CHUNK_SIZE = 64 * 1024
+
+
+class Body:
+    """
+    Read-only request content.
+
+    Depending on its size the content is either held in memory, or is a
+    memory mapped view of the temporary file Twisted spooled it to. Either
+    way it is exposed as a read-only `memoryview`, so it is never copied
+    unless a plugin asks for a copy (eg: via `bytes(body)`).
+
+    Plugins receive these in place of `bytes` when LEDGE_BODY_MODE is
+    "buffer".
+    """
+
+    def __init__(self, view, mapping=None):
+        """
+        Wrap a buffer.
+
+        :param memoryview view: The (read-only) content.
+        :param mmap.mmap mapping: The memory mapping backing the view, if any.
+        """
+        self.view = view
+        self._mapping = mapping
+
+    @classmethod
+    def from_file(cls, content):
+        """
+        Wrap the content of a file without copying it, where possible.
+
+        In memory files are referenced directly (the caller must stop using
+        the file afterwards), real files are memory mapped.
+
+        :param content: A binary file object, positioned anywhere.
+
+        :rtype: Body
+        """
+        if isinstance(content, io.BytesIO):
+            return cls(content.getbuffer().toreadonly())
+        content.seek(0, os.SEEK_END)
+        size = content.tell()
+        content.seek(0)
+        if size:
+            try:
+                mapping = mmap.mmap(content.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                pass
+            else:
+                return cls(memoryview(mapping), mapping=mapping)
+        return cls(memoryview(content.read()).toreadonly())
+
+    def __len__(self):
+        """Return the length of the content, in bytes."""
+        return self.view.nbytes
+
+    def __bytes__(self):
+        """Return a copy of the content."""
+        return self.view.tobytes()
+
+    def __buffer__(self, flags):  # pragma: no cover (Python 3.12+)
+        """Expose the content via the buffer protocol."""
+        return self.view
+
+    def __getitem__(self, key):
+        """Return a view of part of the content."""
+        return self.view[key]
+
+    def __eq__(self, other):
+        """Compare the content with a bytes-like object."""
+        if isinstance(other, Body):
+            other = other.view
+        try:
+            return self.view == other
+        except TypeError:
+            return NotImplemented
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        """Represent the body, without its content."""
+        kind = "mapped" if self._mapping is not None else "in memory"
+        return f"<Body {len(self)} bytes, {kind}>"
+
+    def decode(self, encoding="utf-8", errors="strict"):
+        """Decode the content into a str."""
+        return str(self.view, encoding, errors)
+
+    def chunks(self, size=CHUNK_SIZE):
+        """
+        Iterate over the content in chunks.
+
+        :param int size: The maximum chunk size, in bytes.
+
+        :returns: An iterator of read-only memoryviews.
+        """
+        for start in range(0, len(self), size):
+            end = start + size
+            yield self.view[start:end]
+
+    def close(self):
+        """Release the content. The body must not be used afterwards."""
+        self.view.release()
+        if self._mapping is not None:
+            self._mapping.close()
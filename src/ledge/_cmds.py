@@ -4,16 +4,120 @@ Commands for controlling the ledge server.
 Meant to be entrypoint targets.
 """
 
+import atexit
+import signal
 import sys
 
 import environ
 import structlog
-from twisted.internet import reactor
-from twisted.python.log import startLogging
 
-from ._app import Ledge
-from ._config import get_config, get_merged_conf_object
-from ._web import configure_site
+from ._async import install_reactor
+from ._config import (
+    apply_env_file,
+    get_config,
+    get_merged_conf_object,
+    reload_plugin_modules,
+)
+from ._json import use_backend as use_json_backend
+from ._logging import configure_logging, twisted_observer
+from ._utils import use_request_ids
+from ._workers import Supervisor
+
+
+def reload(root):
+    """
+    Replace the app a site serves with a freshly configured one.
+
+    The configuration is read again (after applying the reload env file, if
+    one is configured) and the plugins' modules are re-imported, then the
+    new app is swapped in. Requests already being handled are left to the
+    old app, which is drained in the background. If anything goes wrong
+    the old app is kept.
+
+    :param ledge._web.WebRoot root: The root resource of the site.
+
+    :rtype: `twisted.internet.defer.Deferred`
+    :returns: A deferred which fires with the number of deferreds waited for
+        once the old app is drained, or None if the reload failed.
+    """
+    from ._app import Ledge  # pylint: disable=import-outside-toplevel
+
+    log = structlog.getLogger()
+    old = root.app
+    try:
+        if old.config.reload_env_file is not None:
+            apply_env_file(old.config.reload_env_file)
+        reload_plugin_modules(old.config)
+        app = Ledge(get_config(), previous=old)
+    except Exception as exc:  # pylint: disable=broad-except
+        log.msg("Reload failed, keeping the running configuration.", error=repr(exc))
+        return None
+    root.app = app
+    log.msg("Reloaded configuration.")
+    if app.wal is not None and app.wal is not old.wal:
+        app.replay()
+
+    def _drained(count):
+        log.msg(f"Drained the previous app ({count} outstanding).")
+        if old.wal is not None and old.wal is not app.wal:
+            old.wal.close()
+        return count
+
+    return old.drain().addCallback(_drained)
+
+
+def _close_wal(root):
+    """Close the write-ahead log of the app a site serves, if it has one."""
+    if root.app.wal is not None:
+        root.app.wal.close()
+
+
+def shutdown(root, timeout):
+    """
+    Stop accepting requests, and let those already accepted finish.
+
+    The site stops listening, and requests arriving on open connections are
+    refused with 503. The app is then drained (see :meth:`Ledge.drain`) for
+    up to `timeout` seconds, after which anything still unfinished is logged
+    and abandoned: the handlers' threads are left behind, and the process
+    pool's workers are stopped, so shutting down doesn't wait for them.
+
+    Meant to run before the reactor shuts down, which waits for it.
+
+    :param ledge._web.WebRoot root: The root resource of the site.
+    :param float timeout: How long to wait, in seconds.
+
+    :rtype: `twisted.internet.defer.Deferred`
+    :returns: A deferred which fires once the app is drained, or the time is up.
+    """
+    from twisted.internet import defer  # pylint: disable=import-outside-toplevel
+    from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+    log = structlog.getLogger()
+    root.draining = True
+    for port in root.ports:
+        port.stopListening()
+    app = root.app
+    log.msg(f"Shutting down, waiting up to {timeout}s for requests to finish.")
+    finished = defer.Deferred()
+
+    def _finish(_=None):
+        if not finished.called:
+            finished.callback(None)
+
+    deadline = reactor.callLater(timeout, _finish)
+    app.drain().addBoth(_finish)
+
+    def _report(_):
+        if deadline.active():
+            deadline.cancel()
+        outstanding = app.outstanding()
+        for what, request_id in outstanding:
+            log.msg(f"Abandoning unfinished {what}.", request_id=request_id)
+        if outstanding:
+            app.abandon()
+
+    return finished.addCallback(_report)
 
 
 def start():
@@ -32,30 +136,83 @@ def start():
         print(help_str)
         sys.exit(0)
 
+    # Select the reactor, before anything imports it
+    install_reactor(config.reactor)
+    # pylint: disable=import-outside-toplevel
+    from twisted.internet import reactor
+    from twisted.logger import globalLogBeginner
+    from twisted.python.log import startLogging
+
+    from ._app import Ledge
+    from ._process_pool import shutdown_shared_pool
+    from ._watchdog import Watchdog
+    from ._web import configure_site
+    from .helpers.http import configure as configure_http
+
     # Configure Logging
-    structlog.configure(
-        processors=[
-            structlog.processors.StackInfoRenderer(),
-            structlog.twisted.EventAdapter(),
-        ],
-        context_class=dict,
-        logger_factory=structlog.twisted.LoggerFactory(),
-        wrapper_class=structlog.twisted.BoundLogger,
-        cache_logger_on_first_use=True,
-    )
+    log_writer = configure_logging(config)
+    if log_writer is not None:
+        atexit.register(log_writer.close)
+    use_request_ids(config.request_ids)
 
-    # Start logging
-    startLogging(sys.stderr)
+    # Select the JSON library helpers use
+    use_json_backend(config.json_backend)
+
+    # Configure the helpers' outbound HTTP clients (which are made on demand)
+    configure_http(pool_size=config.http_pool_size, timeout=config.http_timeout)
+
+    # Start logging, Twisted's own messages included
+    if log_writer is None:
+        startLogging(sys.stderr)
+    else:
+        globalLogBeginner.beginLoggingTo([twisted_observer(log_writer)])
+
+    # Supervise worker processes, rather than serving requests, if requested
+    if config.workers > 1 and config.listen_fd is None:
+        sys.exit(Supervisor(config).run())
 
     # Init ledge
     app = Ledge(config)
 
     # Configure twisted
-    configure_site(app, port=config.port)
+    root = configure_site(
+        app, port=config.port, listen_fd=config.listen_fd, listen=config.listen
+    )
+
+    # Reload the configuration and plugins on SIGHUP, keeping the socket open
+    signal.signal(signal.SIGHUP, lambda *args: reactor.callFromThread(reload, root))
 
     # Configure threadpool if requested
     if config.thread_pool_size is not None:
         reactor.suggestThreadPoolSize(config.thread_pool_size)
 
+    # Let accepted requests finish before shutting down, within reason
+    reactor.addSystemEventTrigger(
+        "before", "shutdown", shutdown, root, config.shutdown_timeout
+    )
+
+    # Stop the handler process pool (if it was used) once they have
+    reactor.addSystemEventTrigger("during", "shutdown", shutdown_shared_pool)
+
+    # Replay requests left incomplete by a previous run, if we're logging them,
+    # and close the log (of whichever app is serving by then) on shutdown
+    if app.wal is not None:
+        reactor.callWhenRunning(app.replay)
+    reactor.addSystemEventTrigger("after", "shutdown", _close_wal, root)
+
+    # Measure the reactor's lag
+    app.metrics.monitor_reactor()
+
+    # Log the reactor stalling, and what stalled it
+    if config.stall_threshold > 0:
+        watchdog = Watchdog(app.metrics, config.stall_threshold)
+        reactor.callWhenRunning(watchdog.start)
+        reactor.addSystemEventTrigger("during", "shutdown", watchdog.stop)
+
+    # Remember recently seen idempotency keys across restarts, if configured
+    reactor.addSystemEventTrigger(
+        "after", "shutdown", lambda: root.app.save_dedup_snapshot()
+    )
+
     # Start it up!
     reactor.run()
@@ -1,13 +1,26 @@
 """Ledge's config classes and helper functions."""
 
 import importlib
+import os
+import sys
+from functools import lru_cache
 from itertools import chain
+from types import SimpleNamespace
 
+import attr
 import environ
 
+from ._threadpools import thread_pool_subconfig
+from ._utils import make_name_safe
 
+
+@lru_cache(maxsize=None)
 def _cls_from_import_path(module_path):
-    """Given the import path to a class return that class."""
+    """
+    Given the import path to a class return that class.
+
+    Resolutions are cached, as the configuration is built more than once.
+    """
     path_split = module_path.split(".")
     module_name = path_split[:-1]
     cls_name = path_split[-1]
@@ -25,6 +38,11 @@ def _classes_from_comma_delimited_import_paths(a_str):
     return [_cls_from_import_path(name) for name in module_names if name]
 
 
+def _comma_delimited(a_str):
+    """Split a comma delimited str, ignoring empty items."""
+    return [item for item in a_str.split(",") if item]
+
+
 def _none_or_int(a_str):
     """
     Allow None, otherwise value must be an int.
@@ -36,6 +54,17 @@ def _none_or_int(a_str):
     return int(a_str)
 
 
+def _none_or_float(a_str):
+    """
+    Allow None, otherwise value must be a float.
+
+    (Optional float value)
+    """
+    if a_str is None:
+        return None
+    return float(a_str)
+
+
 class Configuration:  # pylint: disable=too-few-public-methods
     """Application configuration from environmental variables."""
 
@@ -44,6 +73,38 @@ class Configuration:  # pylint: disable=too-few-public-methods
         default=50000,  # 50 Mb
         help="The maximum request content size to accept, in bytes.",
     )
+    body_mode = environ.var(
+        default="bytes",
+        help="How request content is passed to plugins. Either 'bytes', "
+        "'buffer' to pass a read-only ledge.Body which is memory mapped from "
+        "a temporary file when the content is large, rather than copied, or "
+        "'memoryview' to pass the read-only memoryview such a body wraps.",
+    )
+    body_spool_threshold = environ.var(
+        converter=int,
+        default=100000,
+        help="The content length, in bytes, beyond which request content is "
+        "spooled to a temporary file rather than held in memory.",
+    )
+    decode_content = environ.bool_var(
+        default=False,
+        help="Decompress gzip and deflate encoded request content, so plugins "
+        "receive the decoded content. The decoded content is subject to "
+        "max_content_length too.",
+    )
+    max_compression_ratio = environ.var(
+        converter=_none_or_float,
+        default=100.0,
+        help="The maximum ratio of decoded to encoded content size, when "
+        "decoding content. Content beyond it is rejected as a "
+        "decompression bomb.",
+    )
+    reject_unmatched = environ.bool_var(
+        default=False,
+        help="Reject POST requests which no plugin's match could match with a "
+        "404, before reading their content. Only useful if every plugin "
+        "declares a match.",
+    )
     responders = environ.var(
         converter=_classes_from_comma_delimited_import_paths,
         default="",
@@ -54,15 +115,229 @@ class Configuration:  # pylint: disable=too-few-public-methods
         default="",
         help="The full import paths to classes which implement the handler interface",
     )
+    json_backend = environ.var(
+        default="stdlib",
+        help="The JSON library helpers use. One of 'stdlib', 'auto' (the "
+        "fastest installed), 'orjson', 'simdjson' or 'ujson'. Falls back to "
+        "'stdlib' if the named library isn't installed. The others' output "
+        "differs from the stdlib's, see the docs.",
+    )
+    http_pool_size = environ.var(
+        converter=int,
+        default=10,
+        help="The maximum number of idle keep-alive connections the shared "
+        "clients of ledge.helpers.http keep open to each host.",
+    )
+    http_timeout = environ.var(
+        converter=float,
+        default=10.0,
+        help="The timeout, in seconds, of the shared clients of "
+        "ledge.helpers.http, for connecting and for reading responses.",
+    )
+    log_format = environ.var(
+        default="twisted",
+        help="How logs are written. Either 'twisted', through Twisted's logging, "
+        "or 'json', rendered as JSON lines and written to stderr in batches "
+        "by a dedicated thread.",
+    )
+    log_queue_size = environ.var(
+        converter=int,
+        default=10000,
+        help="The maximum number of JSON log lines waiting to be written. "
+        "Lines beyond it are dropped.",
+    )
+    log_sample_rates = environ.var(
+        default="",
+        help="Comma delimited prefix=fraction pairs. Of the events whose name "
+        "starts with the prefix only that fraction are logged, eg: "
+        "'Handler=0.01'.",
+    )
+    log_rate_limits = environ.var(
+        default="",
+        help="Comma delimited prefix=number pairs. At most that number of "
+        "events whose name starts with the prefix are logged per second.",
+    )
+    request_ids = environ.var(
+        default="uuid",
+        help="How request ids are generated. Either 'uuid', or 'monotonic' "
+        "for cheaper process-unique increasing ids.",
+    )
+    metrics_path = environ.var(
+        default="/metrics",
+        help="The path metrics are served on, in the Prometheus text format.",
+    )
+    metrics_port = environ.var(
+        converter=_none_or_int,
+        default=None,
+        help="A port to serve metrics on (on any path), separately from "
+        "requests. If not supplied they're served on the metrics path of the "
+        "main port.",
+    )
+    stall_threshold = environ.var(
+        converter=float,
+        default=1.0,
+        help="How long, in seconds, the reactor may be blocked (eg: by a plugin "
+        "which isn't thread safe) before the stall is logged, with the reactor "
+        "thread's stack and the plugin and request responsible. 0 disables it.",
+    )
+    shutdown_timeout = environ.var(
+        converter=float,
+        default=30.0,
+        help="How long, in seconds, to wait on shutdown for the responses and "
+        "handler jobs of requests already accepted to finish. New requests are "
+        "refused (with 503) meanwhile, and anything unfinished is logged.",
+    )
+    reload_env_file = environ.var(
+        default=None,
+        help="A file of KEY=VALUE lines, applied to the environment before the "
+        "configuration is re-read when ledge is sent SIGHUP. So plugin "
+        "settings (eg: LEDGE_HANDLERS) can change without a restart.",
+    )
+    reactor = environ.var(
+        default="default",
+        help="The Twisted reactor to run on, either 'default' or 'asyncio'. "
+        "On the asyncio reactor plugin coroutines run as asyncio tasks.",
+    )
     port = environ.var(
         converter=int, default=8080, help="The port for the ledge server to listen on."
     )
+    listen = environ.var(
+        converter=_comma_delimited,
+        default="",
+        help="Comma delimited Twisted endpoint descriptions to listen on, instead "
+        "of the port. Eg: 'unix:/run/ledge.sock', 'tcp6:8080', "
+        "'ssl:8443:privateKey=key.pem' (offering HTTP/2 via ALPN if the h2 "
+        "package is installed) or 'systemd:domain=INET:index=0' to accept "
+        "connections on a socket passed by systemd. Not used with workers.",
+    )
+    workers = environ.var(
+        converter=int,
+        default=1,
+        help="The number of worker processes to run. If greater than 1 ledge "
+        "supervises that many processes, all accepting connections on the "
+        "same port, and restarts them if they exit.",
+    )
+    listen_fd = environ.var(
+        converter=_none_or_int,
+        default=None,
+        help="An inherited file descriptor of a listening socket to accept "
+        "connections on, instead of binding the port. Set by ledge for its "
+        "worker processes.",
+    )
     thread_pool_size = environ.var(
         converter=_none_or_int,
         default=None,
-        help="The size of the threadpool ledge will use to run handlers. If not "
-        "supplied the default from Twisted will be used.",
+        help="The size of the reactor's shared threadpool (eg: used for name "
+        "resolution). Threaded handlers each run in a pool of their own, see "
+        "their thread pool subconfigs. If not supplied the default from Twisted "
+        "will be used.",
+    )
+    process_pool_size = environ.var(
+        converter=_none_or_int,
+        default=None,
+        help="The number of worker processes used to run handlers whose "
+        "execution mode is 'process'. If not supplied the number of CPUs "
+        "will be used.",
+    )
+    process_pool_max_tasks = environ.var(
+        converter=_none_or_int,
+        default=None,
+        help="The number of handler jobs each of the process pool's worker "
+        "processes runs before it is replaced (before Python 3.11 they are all "
+        "replaced once the pool has run this many). If not supplied they are "
+        "never replaced.",
+    )
+    max_queued_handler_jobs = environ.var(
+        converter=_none_or_int,
+        default=None,
+        help="The maximum number of handler jobs which may be queued or running "
+        "at once. Requests received beyond it are rejected. If not supplied "
+        "there is no limit.",
+    )
+    max_inflight_bytes = environ.var(
+        converter=_none_or_int,
+        default=None,
+        help="The maximum number of bytes of request content which may be held "
+        "by requests with handler jobs outstanding. Requests received beyond it "
+        "are rejected. If not supplied there is no limit.",
+    )
+    shed_latency_target = environ.var(
+        converter=_none_or_float,
+        default=None,
+        help="The acceptable time, in seconds, for a handler job to wait in the "
+        "queue. If jobs wait longer than this for the entirety of "
+        "shed_interval requests are rejected until the queue recovers. If not "
+        "supplied load is not shed based on latency.",
+    )
+    shed_interval = environ.var(
+        converter=float,
+        default=0.1,
+        help="How long, in seconds, the handler queueing delay must remain above "
+        "shed_latency_target before requests are rejected.",
+    )
+    shed_status_code = environ.var(
+        converter=int,
+        default=503,
+        help="The status code to reply to rejected requests with (eg: 429 or 503).",
+    )
+    retry_after = environ.var(
+        converter=int,
+        default=5,
+        help="The value, in seconds, of the Retry-After header sent with "
+        "rejected requests.",
+    )
+    wal_dir = environ.var(
+        default=None,
+        help="A directory to keep a write-ahead log of accepted requests in. "
+        "Requests whose handlers hadn't all finished when ledge stopped are "
+        "replayed to the handlers on startup. If not supplied no log is kept.",
+    )
+    wal_segment_size = environ.var(
+        converter=int,
+        default=64 * 1024 * 1024,  # 64 Mb
+        help="The size, in bytes, beyond which a new write-ahead log segment "
+        "is started.",
+    )
+    idempotency_key = environ.var(
+        default=None,
+        help="Where to find the idempotency key of redelivered requests, as a "
+        "comma delimited list of header:<name> or json:<dotted.field> "
+        "(eg: 'header:X-GitHub-Delivery,json:event_id'). Duplicates are "
+        "responded to normally, but aren't passed to the handlers. If not "
+        "supplied requests aren't deduplicated.",
     )
+    dedup_ttl = environ.var(
+        converter=float,
+        default=3600.0,
+        help="How long, in seconds, idempotency keys are remembered for.",
+    )
+    dedup_max_entries = environ.var(
+        converter=int,
+        default=100000,
+        help="The maximum number of idempotency keys remembered.",
+    )
+    dedup_snapshot = environ.var(
+        default=None,
+        help="A file to save the remembered idempotency keys to on shutdown, "
+        "and load them from on startup. If not supplied they're only kept "
+        "in memory.",
+    )
+
+
+def thread_pool_config_name(handler_cls):
+    """Return the name of a handler's thread pool subconfig."""
+    return f"{make_name_safe(handler_cls.name)}_thread_pool"
+
+
+# The names of the plugin subconfig groups added to Configuration, so they're
+# removed if the plugins are no longer configured
+_PLUGIN_GROUPS = set()
+
+
+def _add_plugin_group(name, group_cls):
+    """Add a plugin's subconfig group to Configuration."""
+    setattr(Configuration, name, environ.group(group_cls))
+    _PLUGIN_GROUPS.add(name)
 
 
 def get_merged_conf_object():
@@ -73,17 +348,79 @@ def get_merged_conf_object():
     (eg, its attrs will be the return value of environ.var, not the
     configured values).
     """
-    # Bootstrap a config we can read the modules for the subconfigs from
-    bootstrap_config = environ.to_config(environ.config(Configuration, prefix="LEDGE"))
+    # Read the plugins, which provide the subconfigs, without resolving (and
+    # validating) the rest of the environment twice
+    handlers = _classes_from_comma_delimited_import_paths(
+        os.environ.get("LEDGE_HANDLERS", "")
+    )
+    responders = _classes_from_comma_delimited_import_paths(
+        os.environ.get("LEDGE_RESPONDERS", "")
+    )
 
     # Frankenstein our real config together
-    for kls in chain(bootstrap_config.handlers, bootstrap_config.responders):
+    while _PLUGIN_GROUPS:
+        delattr(Configuration, _PLUGIN_GROUPS.pop())
+    for kls in chain(handlers, responders):
         if kls.provides_subconfig():
-            subconfig_name, subconfig = kls.provide_subconfig()
-            setattr(Configuration, subconfig_name, environ.group(subconfig))
+            _add_plugin_group(*kls.provide_subconfig())
+    for kls in handlers:
+        if kls.uses_thread_pool():
+            _add_plugin_group(thread_pool_config_name(kls), thread_pool_subconfig(kls))
     return environ.config(Configuration, prefix="LEDGE", frozen=True)
 
 
 def get_config():
     """Return a populated configuration object."""
     return environ.to_config(get_merged_conf_object())
+
+
+def apply_env_file(path):
+    """
+    Set environmental variables from a file of KEY=VALUE lines.
+
+    Blank lines, and lines starting with #, are ignored.
+
+    :param str path: The path to the file.
+    """
+    with open(path, encoding="utf-8") as env_file:
+        for line in env_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, _, value = line.partition("=")
+            os.environ[key.strip()] = value.strip()
+
+
+def reload_plugin_modules(config):
+    """
+    Re-import the modules the configured plugins were imported from.
+
+    So new plugin code is picked up by the next :func:`get_config`. Only the
+    plugins' own modules are re-imported, not modules they import.
+
+    :param config: The configuration the plugins were loaded by.
+    """
+    _cls_from_import_path.cache_clear()
+    modules = {kls.__module__ for kls in chain(config.handlers, config.responders)}
+    for name in sorted(modules):
+        importlib.reload(sys.modules[name])
+
+
+def config_snapshot(config):
+    """
+    Return a picklable copy of a configuration.
+
+    The configuration classes built by `environ.config` can't be pickled,
+    so their values are copied into (nested) `types.SimpleNamespace`. Other
+    objects are returned as they are.
+
+    :param config: The configuration, or one of its groups.
+    """
+    if not attr.has(type(config)):
+        return config
+    return SimpleNamespace(
+        **{
+            field.name: config_snapshot(getattr(config, field.name))
+            for field in attr.fields(type(config))
+        }
+    )
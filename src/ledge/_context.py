@@ -0,0 +1,144 @@
+"""Request-scoped state shared between ledge and its plugins."""
+
+import threading
+import time
+
+
+class RequestContext:
+    """
+    Per-request memoization of work plugins would otherwise repeat.
+
+    An instance is attached to every incoming request as
+    `request.ledge_context` (see :func:`ledge._utils.inject_logger`).
+    Helpers such as :func:`ledge.helpers.content_to_json` and
+    :func:`ledge.helpers.get_headers` use it so that a body is decoded once
+    per request rather than once per plugin.
+
+    It also records when lifecycle events (eg: a handler being queued or
+    started) happen, notifying any observers as they do. A summary of these
+    is logged once the request is complete.
+
+    Handlers may run in their own threads, so all access is guarded by a lock.
+    """
+
+    def __init__(self, request_id=None):
+        """
+        Initialize the (empty) memo and timings.
+
+        :param str request_id: The id ledge assigned to the request.
+        """
+        self.request_id = request_id
+        self._lock = threading.Lock()
+        self._memo = {}
+        #: Lifecycle events, keyed on (event, plugin name), mapped to the
+        #: :func:`time.monotonic` timestamp they occurred at.
+        self.timings = {}
+        #: Callables which are called with (context, event, plugin, timestamp)
+        #: whenever an event is marked. They may be called from any thread.
+        self.observers = []
+
+    def mark(self, event, plugin=None):
+        """
+        Record that a lifecycle event happened now.
+
+        :param str event: The event name, eg: "handler_started"
+        :param str plugin: The name of the plugin the event pertains to, if any.
+
+        :rtype: float
+        :returns: The timestamp recorded for the event.
+        """
+        timestamp = time.monotonic()
+        self.timings[(event, plugin)] = timestamp
+        for observer in self.observers:
+            observer(self, event, plugin, timestamp)
+        return timestamp
+
+    def summary(self):
+        """
+        Summarize the request's lifecycle, for logging.
+
+        :rtype: dict
+        :returns: `timings_ms`, the time (in milliseconds) each event
+            happened after the request was received, keyed on the event name
+            or "event:plugin". Then `handler_queued_ms` and
+            `handler_running_ms`, how long each handler waited to start and
+            ran for.
+        """
+        timings = dict(self.timings)
+        if not timings:
+            return {}
+        received = timings.get(("received", None), min(timings.values()))
+
+        def _ms(start, end):
+            return round((end - start) * 1000, 3)
+
+        offsets = {
+            event if plugin is None else f"{event}:{plugin}": _ms(received, timestamp)
+            for (event, plugin), timestamp in sorted(
+                timings.items(), key=lambda item: item[1]
+            )
+        }
+        queued = {}
+        running = {}
+        for (event, plugin), started in timings.items():
+            if event != "handler_started":
+                continue
+            if ("handler_queued", plugin) in timings:
+                queued[plugin] = _ms(timings[("handler_queued", plugin)], started)
+            if ("handler_finished", plugin) in timings:
+                running[plugin] = _ms(started, timings[("handler_finished", plugin)])
+        return {
+            "timings_ms": offsets,
+            "handler_queued_ms": queued,
+            "handler_running_ms": running,
+        }
+
+    def memoize(self, key, func, *args, **kwargs):
+        """
+        Return `func(*args, **kwargs)`, computing it at most once per key.
+
+        Exceptions raised by `func` are memoized as well, and re-raised on
+        every subsequent call with the same key.
+
+        :param key: A hashable key identifying the computation.
+        :param callable func: The function to call on a cache miss.
+
+        :returns: The (possibly cached) return value of `func`.
+        """
+        try:
+            failed, value = self._memo[key]
+        except KeyError:
+            with self._lock:
+                if key not in self._memo:
+                    try:
+                        self._memo[key] = (False, func(*args, **kwargs))
+                    except Exception as exc:  # pylint: disable=broad-except
+                        self._memo[key] = (True, exc)
+                failed, value = self._memo[key]
+        if failed:
+            raise value
+        return value
+
+
+def mark_after(result, context, event, plugin=None):
+    """
+    Mark an event on a context, passing a result through.
+
+    For use as a Deferred callback, to mark when something finished.
+    """
+    context.mark(event, plugin)
+    return result
+
+
+def get_context(request):
+    """
+    Return the :class:`RequestContext` attached to a request, if any.
+
+    :param twisted.web.http.Request request: The request.
+
+    :rtype: Optional[RequestContext]
+    """
+    context = getattr(request, "ledge_context", None)
+    if isinstance(context, RequestContext):
+        return context
+    return None
@@ -0,0 +1,93 @@
+"""Incremental decoding of compressed request content."""
+
+import zlib
+
+#: The content encodings which can be decoded, mapped to their zlib `wbits`.
+ENCODINGS = {
+    b"gzip": 16 + zlib.MAX_WBITS,
+    b"x-gzip": 16 + zlib.MAX_WBITS,
+    b"deflate": zlib.MAX_WBITS,
+}
+
+
+class ContentTooLarge(ValueError):
+    """Raised when decoded content exceeds its size or ratio limit."""
+
+
+class MalformedContent(ValueError):
+    """Raised when content can't be decoded."""
+
+
+class ContentDecoder:
+    """
+    Decompress content as it arrives.
+
+    Output is never produced beyond the size limit, so decompression bombs
+    are rejected having only cost a little more than the limit.
+    """
+
+    def __init__(self, encoding, max_length, max_ratio=None):
+        """
+        Prepare to decode content.
+
+        :param bytes encoding: One of :data:`ENCODINGS`.
+        :param int max_length: The maximum decoded size, in bytes.
+        :param float max_ratio: The maximum ratio of decoded to encoded size.
+            If None there is no limit.
+        """
+        self.encoding = encoding
+        self.max_length = max_length
+        self.max_ratio = max_ratio
+        #: The number of encoded bytes received.
+        self.consumed = 0
+        #: The number of decoded bytes produced.
+        self.produced = 0
+        self._decompressor = zlib.decompressobj(ENCODINGS[encoding])
+
+    def _decompress(self, data):
+        """Decompress data, producing no more than one byte over the limit."""
+        limit = self.max_length - self.produced + 1
+        try:
+            return self._decompressor.decompress(data, limit)
+        except zlib.error:
+            if self.encoding != b"deflate" or self.consumed != len(data):
+                raise
+            # Some senders use raw deflate streams, without the zlib wrapper
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompressor.decompress(data, limit)
+
+    def decode(self, data):
+        """
+        Decode a chunk of content.
+
+        :param bytes data: The encoded chunk.
+
+        :rtype: bytes
+        :returns: The decoded data available so far.
+        :raises ContentTooLarge: If a limit was exceeded.
+        :raises MalformedContent: If the data isn't validly encoded.
+        """
+        self.consumed += len(data)
+        try:
+            decoded = self._decompress(data)
+        except zlib.error as exc:
+            raise MalformedContent(str(exc)) from exc
+        self.produced += len(decoded)
+        if self.produced > self.max_length:
+            raise ContentTooLarge(f"Decoded content exceeds {self.max_length} bytes.")
+        if self.max_ratio is not None and self.produced > (
+            self.consumed * self.max_ratio
+        ):
+            raise ContentTooLarge(
+                f"Decoded content exceeds {self.max_ratio} times its encoded size."
+            )
+        return decoded
+
+    def finish(self):
+        """
+        Check the content was complete.
+
+        :raises MalformedContent: If the encoded stream was truncated.
+        """
+        if not self._decompressor.eof:
+            raise MalformedContent("Encoded content was truncated.")
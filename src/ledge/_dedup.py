@@ -0,0 +1,164 @@
+"""Recognize redelivered requests, by their idempotency key."""
+
+import json
+import os
+import time
+from collections import OrderedDict
+
+from ledge.helpers import lazy_json
+
+#: The sources an idempotency key may be extracted from.
+KEY_SOURCES = ("header", "json")
+
+
+def _header_key(name):
+    """Build an extractor for a header's value."""
+    name = name.encode("utf-8")
+
+    def extract(request, content):  # pylint: disable=unused-argument
+        value = request.getHeader(name)
+        return None if value is None else value.decode("utf-8", "replace")
+
+    return extract
+
+
+def _json_key(path):
+    """Build an extractor for a (dotted) field of the JSON content."""
+
+    def extract(request, content):
+        try:
+            value = lazy_json(content, request=request).get(path)
+        except (ValueError, UnicodeError):
+            return None
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        return str(value)
+
+    return extract
+
+
+def key_extractor(spec):
+    """
+    Build a function which extracts a request's idempotency key.
+
+    The spec is a comma delimited list of `source:name` pairs, eg:
+    "header:X-GitHub-Delivery,json:event_id". Sources are tried in order,
+    and the first one present on a request provides its key. JSON fields may
+    be nested, eg: "json:event.id".
+
+    :param str spec: The key spec.
+
+    :rtype: callable
+    :returns: A function which takes the request and its content, returning
+        its key (a str) or None if it has none.
+    """
+    extractors = []
+    for part in spec.split(","):
+        if not part:
+            continue
+        source, _, name = part.partition(":")
+        if source not in KEY_SOURCES or not name:
+            raise ValueError(
+                f"Invalid idempotency key {part!r}, expected one of "
+                f"{', '.join(s + ':<name>' for s in KEY_SOURCES)}"
+            )
+        build = _header_key if source == "header" else _json_key
+        extractors.append((part, build(name)))
+
+    def extract(request, content):
+        for part, extractor in extractors:
+            value = extractor(request, content)
+            if value is not None:
+                return f"{part}={value}"
+        return None
+
+    return extract
+
+
+class DedupCache:
+    """
+    A TTL bounded LRU of the idempotency keys seen recently.
+
+    Keys expire after `ttl` seconds, and the least recently seen keys are
+    evicted once there are more than `max_entries`.
+    """
+
+    def __init__(self, ttl, max_entries, clock=time.time):
+        """
+        Create the (empty) cache.
+
+        :param float ttl: How long a key is remembered, in seconds.
+        :param int max_entries: The maximum number of keys remembered.
+        :param callable clock: Returns the current (wall clock) time. Expiry
+            times are stored in snapshots, so it must be comparable between
+            processes.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        # Key -> expiry time, least recently seen first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        """Return the number of keys remembered."""
+        return len(self._entries)
+
+    def _expire(self, now):
+        """Drop expired keys, and any beyond the maximum number."""
+        while self._entries:
+            key, expiry = next(iter(self._entries.items()))
+            if expiry > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+    def seen(self, key):
+        """
+        Check whether a key has been seen, remembering it either way.
+
+        :param str key: The idempotency key.
+
+        :rtype: bool
+        :returns: True if the key was seen (and hasn't expired).
+        """
+        now = self.clock()
+        expiry = self._entries.pop(key, None)
+        self._entries[key] = now + self.ttl
+        self._expire(now)
+        return expiry is not None and expiry > now
+
+    def forget(self, key):
+        """
+        Forget a key, so its next delivery isn't considered a duplicate.
+
+        :param str key: The idempotency key.
+        """
+        self._entries.pop(key, None)
+
+    def save(self, path):
+        """
+        Write the unexpired keys to a snapshot file.
+
+        :param str path: The path of the snapshot, which is replaced
+            atomically.
+        """
+        self._expire(self.clock())
+        partial = f"{path}.tmp"
+        with open(partial, "w", encoding="utf-8") as snapshot:
+            json.dump(list(self._entries.items()), snapshot)
+        os.replace(partial, path)
+
+    def load(self, path):
+        """
+        Remember the unexpired keys from a snapshot file, if it exists.
+
+        :param str path: The path of the snapshot.
+        """
+        try:
+            with open(path, encoding="utf-8") as snapshot:
+                entries = json.load(snapshot)
+        except FileNotFoundError:
+            return
+        for key, expiry in entries:
+            self._entries.pop(key, None)
+            self._entries[key] = expiry
+        self._expire(self.clock())
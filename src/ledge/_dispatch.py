@@ -0,0 +1,150 @@
+"""Declarative request matching and the dispatch index built from it."""
+
+import heapq
+import json
+
+from ledge.helpers import lazy_json
+
+_MISSING = object()
+
+
+def _to_bytes(value):
+    """Encode a str to bytes, leave bytes alone."""
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+
+class Match:
+    """
+    A declarative description of the requests a plugin is interested in.
+
+    Assign an instance to a plugin's `match` attribute. Every provided
+    criterion must hold for a request to match, criteria left as `None`
+    match anything.
+
+    Requests that can't match are never passed to the plugin, so matching
+    is cheap even with many plugins loaded. The plugin's `handles` method is
+    still called on requests that do match, to allow for any further checks.
+    """
+
+    def __init__(self, path=None, method=None, headers=None, json_fields=None):
+        """
+        Compile the provided criteria.
+
+        :param str path: The exact request path, eg: "/slack"
+        :param str method: The request method, eg: "POST"
+        :param dict headers: Header names mapped to their expected values.
+        :param dict json_fields: Top level keys of the JSON request content
+            mapped to their expected values.
+        """
+        self.path = None if path is None else _to_bytes(path)
+        self.method = None if method is None else _to_bytes(method).upper()
+        self.headers = {
+            _to_bytes(k).lower(): _to_bytes(v) for k, v in (headers or {}).items()
+        }
+        self.json_fields = dict(json_fields or {})
+
+    @property
+    def key(self):
+        """The (method, path) key this match is indexed under."""
+        return (self.method, self.path)
+
+    def matches_details(self, request, content):
+        """
+        Check the criteria which aren't covered by the index key.
+
+        :param twisted.web.http.Request request: The incoming request.
+        :param bytes content: The content of the incoming request.
+
+        :rtype: bool
+        """
+        for name, value in self.headers.items():
+            if request.getHeader(name) != value:
+                return False
+        if self.json_fields:
+            # Only the matched fields are parsed, so mismatches are cheap
+            request_json = lazy_json(content, request=request)
+            try:
+                for key, value in self.json_fields.items():
+                    if request_json.get([key], _MISSING) != value:
+                        return False
+            except (json.JSONDecodeError, UnicodeError):
+                return False
+        return True
+
+    def __repr__(self):
+        """Represent the match criteria."""
+        return (
+            f"Match(path={self.path!r}, method={self.method!r}, "
+            f"headers={self.headers!r}, json_fields={self.json_fields!r})"
+        )
+
+
+class DispatchIndex:
+    """
+    An index of plugins, keyed on the request method and path they match.
+
+    Plugins without a :class:`Match` are considered candidates for every
+    request. The configured ordering of the plugins is preserved.
+    """
+
+    def __init__(self, plugins):
+        """
+        Build the index.
+
+        :param list plugins: The plugin instances, in their configured order.
+        """
+        self.plugins = plugins
+        self._fallback = []
+        self._index = {}
+        for position, plugin in enumerate(plugins):
+            match = getattr(plugin, "match", None)
+            if isinstance(match, Match):
+                self._index.setdefault(match.key, []).append((position, plugin))
+            else:
+                self._fallback.append((position, plugin))
+
+    def could_match(self, method, path):
+        """
+        Check whether any plugin could be interested in a request.
+
+        Only the method and path are considered, so this can be checked
+        before the request content has been read.
+
+        :param bytes method: The request method.
+        :param bytes path: The request path.
+
+        :rtype: bool
+        """
+        if self._fallback:
+            return True
+        return any(
+            key in self._index
+            for key in ((method, path), (method, None), (None, path), (None, None))
+        )
+
+    def candidates(self, request, content):
+        """
+        Return the plugins which may be interested in the request.
+
+        :param twisted.web.http.Request request: The incoming request.
+        :param bytes content: The content of the incoming request.
+
+        :rtype: List
+        :returns: The plugins, in their configured order.
+        """
+        if not self._index:
+            return [plugin for _, plugin in self._fallback]
+        method, path = request.method, request.path
+        buckets = [self._fallback]
+        for key in ((method, path), (method, None), (None, path), (None, None)):
+            bucket = self._index.get(key)
+            if bucket:
+                buckets.append(bucket)
+        return [
+            plugin
+            for _, plugin in heapq.merge(*buckets, key=lambda entry: entry[0])
+            if not isinstance(getattr(plugin, "match", None), Match)
+            or plugin.match.matches_details(request, content)
+        ]
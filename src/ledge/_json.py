@@ -0,0 +1,130 @@
+"""The JSON backend used by the helpers, selected once at startup."""
+
+import importlib
+import json
+
+#: The JSON backends which can be selected via LEDGE_JSON_BACKEND, "auto"
+#: selects the first of the others which is installed. The stdlib is the
+#: default, as the others' output differs (see docs/starting_ledge.rst).
+BACKENDS = ("auto", "orjson", "simdjson", "ujson", "stdlib")
+
+_UTF8 = ("utf-8", "utf8")
+
+
+def _stdlib_loads(data):
+    """Parse UTF-8 bytes-like data with the stdlib."""
+    return json.loads(str(data, "utf-8"))
+
+
+def _stdlib_dumps(obj):
+    """Serialize to UTF-8 bytes with the stdlib."""
+    return json.dumps(obj).encode("utf-8")
+
+
+def _orjson(module):
+    """Wrap orjson, which parses any bytes-like object directly."""
+    return module.loads, module.dumps
+
+
+def _simdjson(module):
+    """Wrap pysimdjson, which parses bytes directly."""
+    return lambda data: module.loads(bytes(data)), _stdlib_dumps
+
+
+def _ujson(module):
+    """Wrap ujson, which parses bytes directly."""
+
+    def dumps(obj):
+        # Escaped like the stdlib does
+        return module.dumps(obj, escape_forward_slashes=False).encode("utf-8")
+
+    return lambda data: module.loads(bytes(data)), dumps
+
+
+_WRAPPERS = {"orjson": _orjson, "simdjson": _simdjson, "ujson": _ujson}
+
+_backend = "stdlib"
+_loads = _stdlib_loads
+_dumps = _stdlib_dumps
+
+
+def use_backend(name="stdlib"):
+    """
+    Select the JSON backend.
+
+    :param str name: One of :data:`BACKENDS`. If the named backend isn't
+        installed the stdlib is used instead.
+
+    :rtype: str
+    :returns: The name of the backend actually selected.
+    """
+    global _backend, _loads, _dumps  # pylint: disable=global-statement
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend {name!r}, expected one of {BACKENDS}")
+    candidates = list(_WRAPPERS) if name == "auto" else [name]
+    _backend, _loads, _dumps = "stdlib", _stdlib_loads, _stdlib_dumps
+    for candidate in candidates:
+        if candidate == "stdlib":
+            break
+        try:
+            module = importlib.import_module(candidate)
+        except ImportError:
+            continue
+        _loads, _dumps = _WRAPPERS[candidate](module)
+        _backend = candidate
+        break
+    return _backend
+
+
+def backend():
+    """Return the name of the selected JSON backend."""
+    return _backend
+
+
+def loads(data, encoding="utf-8"):
+    """
+    Parse JSON from a bytes-like object.
+
+    Unless the stdlib backend is selected the data isn't decoded to a str
+    first. Data the selected backend can't parse is parsed by the stdlib.
+
+    :param data: bytes, a memoryview or another bytes-like object.
+    :param str encoding: The encoding of the data.
+
+    :raises json.JSONDecodeError: If the data isn't valid JSON, whichever
+        backend is selected.
+    :raises UnicodeError: If the data can't be decoded.
+    """
+    if encoding.lower() not in _UTF8:
+        return json.loads(str(data, encoding))
+    try:
+        return _loads(data)
+    except (json.JSONDecodeError, UnicodeError):
+        raise
+    except (ValueError, RuntimeError):
+        # Parsed again by the stdlib, which raises JSONDecodeError if the data
+        # is invalid, and handles what the backend can't (eg: pysimdjson
+        # rejects integers beyond 64 bits)
+        return _stdlib_loads(data)
+
+
+def dumps(obj, encoding="utf-8"):
+    """
+    Serialize an object to JSON bytes.
+
+    Objects the selected backend can't serialize (eg: dicts with keys which
+    aren't strs, or integers beyond 64 bits) are serialized by the stdlib.
+
+    :param obj: A JSON serializable object.
+    :param str encoding: The encoding of the result.
+
+    :rtype: bytes
+    """
+    if encoding.lower() not in _UTF8:
+        return json.dumps(obj).encode(encoding)
+    try:
+        return _dumps(obj)
+    except (TypeError, OverflowError):
+        if _dumps is _stdlib_dumps:
+            raise
+        return _stdlib_dumps(obj)
@@ -0,0 +1,32 @@
+"""Import the parts of a package on first use, rather than with the package."""
+
+import importlib
+import importlib.util
+
+
+def lazy_getattr(package, attributes):
+    """
+    Build a module level `__getattr__` (see PEP 562) for a package.
+
+    The returned function imports the package's public attributes, and its
+    submodules, the first time they're accessed. So importing the package
+    (eg: to subclass `ledge.HandlerImplementation`) doesn't import the
+    rest of it.
+
+    :param str package: The name of the package.
+    :param dict attributes: Attribute names mapped to the (relative) name of
+        the module which defines them.
+
+    :rtype: callable
+    """
+
+    def __getattr__(name):
+        if name in attributes:
+            # Not cached on the package, so reloaded modules are picked up
+            return getattr(importlib.import_module(attributes[name], package), name)
+        qualified_name = f"{package}.{name}"
+        if not name.startswith("__") and importlib.util.find_spec(qualified_name):
+            return importlib.import_module(qualified_name)
+        raise AttributeError(f"module {package!r} has no attribute {name!r}")
+
+    return __getattr__
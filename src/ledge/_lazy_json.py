@@ -0,0 +1,256 @@
+"""Read fields of JSON content without parsing all of it."""
+
+import json
+import re
+import threading
+
+from ledge import _json
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_SCALAR = re.compile(
+    rb"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|true|false|null"
+)
+# The characters which matter when skipping over an object or array
+_STRUCTURAL = re.compile(rb'[\]\[{}"]')
+
+
+def _container_pattern(depth):
+    """
+    Build a pattern matching an object or array, nested up to depth deep.
+
+    This lets the regex engine skip over most values in one go. It's
+    written so there's only one way to match any input, so failing to match
+    (eg: more deeply nested values) never backtracks exponentially.
+    """
+    plain = rb'[^\]\[{}"]*'
+    members = plain + rb"(?:" + _STRING.pattern + plain + rb")*"
+    for _ in range(depth):
+        members = (
+            plain
+            + rb"(?:(?:"
+            + _STRING.pattern
+            + rb"|[{\[]"
+            + members
+            + rb"[\]}])"
+            + plain
+            + rb")*"
+        )
+    return re.compile(rb"[{\[]" + members + rb"[\]}]", re.DOTALL)
+
+
+_CONTAINER = _container_pattern(8)
+
+_QUOTE, _COMMA, _COLON = ord('"'), ord(","), ord(":")
+_OPENERS = (ord("{"), ord("["))
+_CLOSERS = (ord("}"), ord("]"))
+_OPEN_OBJECT, _OPEN_ARRAY = _OPENERS
+
+_MISSING = object()
+
+
+class _Scan:  # pylint: disable=too-few-public-methods
+    """How far an object or array has been scanned."""
+
+    def __init__(self, position):
+        """Start scanning at the position, just after the opening bracket."""
+        # The next offset to scan from, None once the closing bracket is found
+        self.position = position
+        # Keys (or indexes) -> (start, end) offsets of their values
+        self.members = {}
+        self.count = 0
+
+
+class LazyJSON:
+    """
+    A read-only view of JSON content, which only parses what's asked for.
+
+    Fields are found by scanning the content from its start, skipping over
+    the values of other fields without parsing them, and stopping as soon
+    as the field is found. Where fields were found (or skipped over) is
+    remembered, so later lookups resume the scan rather than repeating it.
+    The whole document is only parsed if :meth:`load` is called.
+
+    The content is only checked for validity as far as it's scanned, so
+    lookups may succeed on content :meth:`load` would reject. If an object
+    has duplicate keys lookups find the first, whereas :meth:`load` keeps
+    the last.
+    """
+
+    def __init__(self, content, encoding="utf-8", load=None):
+        """
+        Wrap the content, without scanning it.
+
+        :param content: bytes, a memoryview or a :class:`ledge.Body`.
+        :param str encoding: The encoding of the content.
+        :param callable load: Called to parse the whole content, defaults to
+            parsing it with the configured JSON backend.
+        """
+        buffer = getattr(content, "view", content)
+        if encoding.lower() not in ("utf-8", "utf8"):
+            buffer = str(buffer, encoding).encode("utf-8")
+        self._buffer = memoryview(buffer).cast("B")
+        self._load = load or (lambda: _json.loads(self._buffer))
+        self._loaded = _MISSING
+        # Object/array start offsets -> their _Scan
+        self._scans = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _error(message, offset):
+        """Raise the error the stdlib would for malformed JSON."""
+        raise json.JSONDecodeError(message, "", offset)
+
+    def _byte(self, offset):
+        """Return the byte at the offset, or None past the end."""
+        return self._buffer[offset] if offset < len(self._buffer) else None
+
+    def _skip_whitespace(self, offset):
+        """Return the offset of the next non-whitespace byte."""
+        return _WHITESPACE.match(self._buffer, offset).end()
+
+    def _string_end(self, start):
+        """Return the offset just past the string starting at start."""
+        match = _STRING.match(self._buffer, start)
+        if match is None:
+            self._error("Unterminated string", start)
+        return match.end()
+
+    def _value_end(self, start):
+        """Return the offset just past the value starting at start."""
+        first = self._byte(start)
+        if first == _QUOTE:
+            return self._string_end(start)
+        if first in _OPENERS:
+            match = _CONTAINER.match(self._buffer, start)
+            if match is not None:
+                return match.end()
+            # It's nested too deeply for the pattern, or is malformed
+            depth, offset = 0, start
+            while True:
+                match = _STRUCTURAL.search(self._buffer, offset)
+                if match is None:
+                    self._error("Unterminated object or array", start)
+                char = self._buffer[match.start()]
+                if char == _QUOTE:
+                    offset = self._string_end(match.start())
+                    continue
+                depth += 1 if char in _OPENERS else -1
+                offset = match.end()
+                if depth == 0:
+                    return offset
+        match = _SCALAR.match(self._buffer, start)
+        if match is None:
+            self._error("Expecting value", start)
+        return match.end()
+
+    def _decode_key(self, start, end):
+        """Decode the string between the offsets, including its quotes."""
+        raw = bytes(self._buffer[start:end])
+        if b"\\" in raw:
+            return json.loads(str(raw, "utf-8"))
+        return str(raw[1:-1], "utf-8")
+
+    def _next_member(self, start, scan):
+        """Scan the next member of the object or array starting at start."""
+        offset = self._skip_whitespace(scan.position)
+        if self._byte(offset) in _CLOSERS:
+            scan.position = None
+            return
+        if scan.count:
+            if self._byte(offset) != _COMMA:
+                self._error("Expecting ',' delimiter", offset)
+            offset = self._skip_whitespace(offset + 1)
+        if self._buffer[start] == _OPEN_OBJECT:
+            if self._byte(offset) != _QUOTE:
+                self._error("Expecting property name enclosed in double quotes", offset)
+            key_end = self._string_end(offset)
+            key = self._decode_key(offset, key_end)
+            offset = self._skip_whitespace(key_end)
+            if self._byte(offset) != _COLON:
+                self._error("Expecting ':' delimiter", offset)
+            offset = self._skip_whitespace(offset + 1)
+        else:
+            key = scan.count
+        end = self._value_end(offset)
+        scan.members.setdefault(key, (offset, end))
+        scan.count += 1
+        scan.position = end
+
+    def _member(self, start, key):
+        """Return the (start, end) offsets of a member's value, or None."""
+        scan = self._scans.get(start)
+        if scan is None:
+            scan = self._scans[start] = _Scan(start + 1)
+        while key not in scan.members and scan.position is not None:
+            self._next_member(start, scan)
+        return scan.members.get(key)
+
+    def _locate(self, keys):
+        """Return the (start, end) offsets of the value at the keys, or None."""
+        start = self._skip_whitespace(0)
+        span = None
+        for key in keys:
+            kind = self._byte(start)
+            if kind == _OPEN_OBJECT:
+                span = self._member(start, key)
+            elif kind == _OPEN_ARRAY and key.isdigit():
+                span = self._member(start, int(key))
+            else:
+                return None
+            if span is None:
+                return None
+            start = span[0]
+        return span or (start, self._value_end(start))
+
+    @staticmethod
+    def _keys(path):
+        """Split a dotted path into its keys."""
+        return path.split(".") if isinstance(path, str) else [str(k) for k in path]
+
+    def get(self, path, default=None):
+        """
+        Return the value at a path, parsing only that value.
+
+        :param path: A dotted path (eg: "event.channel"), or a sequence of
+            keys if the keys themselves contain dots. Array elements are
+            selected by their index, eg: "items.0.id".
+        :param default: Returned if there's no value at the path.
+
+        :raises json.JSONDecodeError: If the content scanned to find the
+            value is malformed.
+        """
+        keys = self._keys(path)
+        if self._loaded is not _MISSING:
+            value = self._loaded
+            for key in keys:
+                if isinstance(value, list) and key.isdigit() and int(key) < len(value):
+                    value = value[int(key)]
+                elif isinstance(value, dict) and key in value:
+                    value = value[key]
+                else:
+                    return default
+            return value
+        with self._lock:
+            span = self._locate(keys)
+        if span is None:
+            return default
+        start, end = span
+        return _json.loads(self._buffer[start:end])
+
+    def __contains__(self, path):
+        """Return whether there's a value at a path, without parsing it."""
+        if self._loaded is not _MISSING:
+            return self.get(path, _MISSING) is not _MISSING
+        with self._lock:
+            return self._locate(self._keys(path)) is not None
+
+    def load(self):
+        """
+        Parse (once) and return the whole document.
+
+        :raises json.JSONDecodeError: If the content isn't valid JSON.
+        """
+        if self._loaded is _MISSING:
+            self._loaded = self._load()
+        return self._loaded
@@ -0,0 +1,250 @@
+"""A logging pipeline which keeps log formatting and I/O off the hot path."""
+
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+import structlog
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover (orjson is optional)
+    orjson = None  # pylint: disable=invalid-name
+
+#: The log formats which can be selected via LEDGE_LOG_FORMAT.
+LOG_FORMATS = ("twisted", "json")
+
+
+def _parse_prefixes(a_str):
+    """Parse comma delimited prefix=number pairs into a dict."""
+    prefixes = {}
+    for part in (a_str or "").split(","):
+        if not part:
+            continue
+        prefix, _, value = part.rpartition("=")
+        prefixes[prefix] = float(value)
+    return prefixes
+
+
+class Sampler:
+    """
+    A structlog processor which samples or rate limits events.
+
+    Events are matched on the longest configured prefix of their name
+    (`event`), so events whose names are formatted with (eg) plugin names
+    can be limited together.
+    """
+
+    def __init__(self, sample_rates=None, rate_limits=None, clock=time.monotonic):
+        """
+        Configure the sampler.
+
+        :param dict sample_rates: Event name prefixes mapped to the fraction
+            of their events to keep.
+        :param dict rate_limits: Event name prefixes mapped to the maximum
+            number of their events to keep per second.
+        :param callable clock: Returns the current time, in seconds.
+        """
+        self.sample_rates = dict(sample_rates or {})
+        self.rate_limits = dict(rate_limits or {})
+        self.clock = clock
+        # Prefix -> [window start, events kept in the window]
+        self._windows = {}
+        # Events are logged from handlers' threads, as well as the reactor's
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    @staticmethod
+    def _match(prefixes, event):
+        """Return the longest of the prefixes the event starts with."""
+        matched = None
+        for prefix in prefixes:
+            if event.startswith(prefix) and (
+                matched is None or len(prefix) > len(matched)
+            ):
+                matched = prefix
+        return matched
+
+    def _over_limit(self, prefix):
+        """Count an event against its prefix's limit, in this second."""
+        with self._lock:
+            now = self.clock()
+            window = self._windows.get(prefix)
+            if window is None or now - window[0] >= 1:
+                window = self._windows[prefix] = [now, 0]
+            window[1] += 1
+            return window[1] > self.rate_limits[prefix]
+
+    def __call__(self, logger, method_name, event_dict):
+        """Drop the event if it isn't sampled, or is over its rate limit."""
+        event = str(event_dict.get("event", ""))
+        prefix = self._match(self.sample_rates, event)
+        if prefix is not None and self._random.random() >= self.sample_rates[prefix]:
+            raise structlog.DropEvent
+        prefix = self._match(self.rate_limits, event)
+        if prefix is not None and self._over_limit(prefix):
+            raise structlog.DropEvent
+        return event_dict
+
+
+def render_json(logger, method_name, event_dict):  # pylint: disable=unused-argument
+    """
+    Render an event as a line of JSON, using orjson if it's available.
+
+    Values which aren't JSON serializable are rendered with `repr`.
+
+    :rtype: bytes
+    """
+    if orjson is not None:
+        # pylint: disable=no-member
+        return orjson.dumps(event_dict, default=repr, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(event_dict, default=repr) + "\n").encode("utf-8")
+
+
+class BatchedWriter:
+    """
+    Write lines to a stream from a dedicated thread, in batches.
+
+    Lines are queued without blocking, up to a bound, and lines which don't
+    fit are counted and dropped rather than slowing the caller.
+    """
+
+    def __init__(self, stream=None, max_queued=10000, batch_size=500):
+        """
+        Start the writer thread.
+
+        :param stream: A binary stream to write to, defaults to stderr.
+        :param int max_queued: The maximum number of lines queued.
+        :param int batch_size: The maximum number of lines written at once.
+        """
+        self.stream = sys.stderr.buffer if stream is None else stream
+        self.batch_size = batch_size
+        #: The number of lines dropped because the queue was full.
+        self.dropped = 0
+        self._queue = queue.Queue(max_queued)
+        self._thread = threading.Thread(
+            target=self._run, name="ledge-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, line):
+        """
+        Queue a line to be written.
+
+        :param bytes line: The line, including its newline.
+        """
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        """Write queued lines until the writer is closed."""
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            lines = [line for line in batch if line is not None]
+            if lines:
+                self.stream.write(b"".join(lines))
+                self.stream.flush()
+            if closing:
+                return
+
+    def close(self):
+        """Write any queued lines, then stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+class WriterLogger:  # pylint: disable=too-few-public-methods
+    """A structlog logger which hands rendered events to a writer."""
+
+    def __init__(self, writer):
+        """Attach the writer."""
+        self._writer = writer
+
+    def msg(self, message):
+        """Queue a rendered event."""
+        self._writer.write(message)
+
+    err = info = warning = error = debug = msg
+
+
+def twisted_observer(writer):
+    """
+    Make a Twisted log observer which writes events as JSON, via a writer.
+
+    So Twisted's own log messages (and unhandled errors) are logged in the
+    same format as ledge's, without blocking the reactor thread on I/O.
+
+    :param BatchedWriter writer: The writer.
+
+    :rtype: callable
+    """
+    # pylint: disable=import-outside-toplevel
+    from twisted.logger import formatEvent
+
+    def _observe(event):
+        event_dict = {
+            "event": formatEvent(event),
+            "timestamp": event.get("log_time"),
+            "level": getattr(event.get("log_level"), "name", None),
+            "namespace": event.get("log_namespace"),
+        }
+        failure = event.get("log_failure")
+        if failure is not None:
+            event_dict["exception"] = failure.getTraceback()
+        writer.write(render_json(None, "msg", event_dict))
+
+    return _observe
+
+
+def configure_logging(config):
+    """
+    Configure structlog as the configuration asks.
+
+    :param config: The ledge configuration.
+
+    :rtype: BatchedWriter
+    :returns: The writer, if logging as JSON (so it may be closed on
+        shutdown), otherwise None.
+    """
+    sampler = Sampler(
+        sample_rates=_parse_prefixes(config.log_sample_rates),
+        rate_limits=_parse_prefixes(config.log_rate_limits),
+    )
+    if config.log_format == "json":
+        writer = BatchedWriter(max_queued=config.log_queue_size)
+        structlog.configure(
+            processors=[
+                sampler,
+                structlog.processors.TimeStamper(),
+                structlog.processors.StackInfoRenderer(),
+                render_json,
+            ],
+            context_class=dict,
+            logger_factory=lambda *args: WriterLogger(writer),
+            wrapper_class=structlog.BoundLogger,
+            cache_logger_on_first_use=True,
+        )
+        return writer
+    structlog.configure(
+        processors=[
+            sampler,
+            structlog.processors.StackInfoRenderer(),
+            structlog.twisted.EventAdapter(),
+        ],
+        context_class=dict,
+        logger_factory=structlog.twisted.LoggerFactory(),
+        wrapper_class=structlog.twisted.BoundLogger,
+        cache_logger_on_first_use=True,
+    )
+    return None
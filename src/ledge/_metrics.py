@@ -0,0 +1,331 @@
+"""Metrics describing what ledge is doing, in the Prometheus text format."""
+
+import time
+from bisect import bisect_left
+
+from twisted.internet import reactor, task
+from twisted.python.threadpool import ThreadPool
+
+#: Histogram buckets (in seconds) for durations.
+DURATION_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+#: Histogram buckets (in bytes) for request content sizes.
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+#: The content type of rendered metrics.
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+# Lifecycle event prefixes which are timed, mapped to the method they time
+_TIMED_PHASES = {"handles": "handles", "handler": "handle", "respond": "respond"}
+
+
+def _escape(value):
+    """Escape a label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    """Format label names and values, eg: {plugin="foo",le="0.1"}."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    """Format a sample value."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class of the metric types."""
+
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        """
+        Describe the metric.
+
+        :param str name: The metric name.
+        :param str help_text: A description of the metric.
+        :param tuple labelnames: The names of the metric's labels.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value) tuples."""
+        raise NotImplementedError
+
+    def render(self):
+        """Render the metric in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} "
+                f"{_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """A value which only increases."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        """Create the counter, with no samples."""
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, labels=(), amount=1):
+        """
+        Increment the counter.
+
+        :param tuple labels: The label values.
+        :param int amount: The amount to increment it by.
+        """
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """Return the counter's value."""
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        """Yield the value of each set of labels."""
+        for labels, value in sorted(self._values.items()):
+            yield "", labels, (), value
+
+
+class Gauge(_Metric):
+    """A value which may go up or down."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), collect=None):
+        """
+        Create the gauge.
+
+        :param callable collect: If provided it's called on rendering, and
+            should return a dict of label values to the gauge's values.
+        """
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+        self._collect = collect
+
+    def set(self, value, labels=()):
+        """
+        Set the gauge.
+
+        :param float value: The gauge's value.
+        :param tuple labels: The label values.
+        """
+        self._values[labels] = value
+
+    def samples(self):
+        """Yield the value of each set of labels."""
+        values = self._values if self._collect is None else self._collect()
+        for labels, value in sorted(values.items()):
+            yield "", labels, (), value
+
+
+class Histogram(_Metric):
+    """Counts of observations, in buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DURATION_BUCKETS):
+        """
+        Create the histogram, with no observations.
+
+        :param tuple buckets: The (sorted) upper bounds of the buckets.
+        """
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # Labels -> [per bucket (not cumulative) counts, sum]
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        """
+        Record an observation.
+
+        :param float value: The observed value.
+        :param tuple labels: The label values.
+        """
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * len(self.buckets), 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, labels=()):
+        """Return the number of observations."""
+        entry = self._values.get(labels)
+        return 0 if entry is None else sum(entry[0])
+
+    def samples(self):
+        """Yield the cumulative bucket counts, sum and count of each label set."""
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", labels, (("le", _format_value(bound)),), cumulative
+            yield "_sum", labels, (), total
+            yield "_count", labels, (), cumulative
+
+
+class Metrics:
+    """
+    The metrics ledge keeps.
+
+    They are only updated from the reactor thread, so need no locking and
+    are cheap enough to keep on permanently.
+    """
+
+    def __init__(self, thread_pool_stats=None, clock=reactor):
+        """
+        Create the metrics.
+
+        :param callable thread_pool_stats: Returns pool names mapped to their
+            stats (see :meth:`ledge._app.Ledge.thread_pool_stats`).
+        :param clock: The reactor, used to measure its lag.
+        """
+        #: Returns the stats of the thread pools to report on.
+        self.thread_pool_stats = thread_pool_stats or dict
+        self._clock = clock
+        self._expected = None
+        #: When (by `time.monotonic`) the reactor last ran the periodic call
+        #: measuring its lag, and how often it should run it.
+        self.last_beat = None
+        self.beat_interval = None
+        self.plugin_seconds = Histogram(
+            "ledge_plugin_seconds",
+            "Time spent in plugin methods.",
+            ("plugin", "method"),
+        )
+        self.requests = Counter(
+            "ledge_requests_total", "Requests finished, by status code.", ("code",)
+        )
+        self.content_bytes = Histogram(
+            "ledge_request_content_bytes",
+            "The size of accepted request content.",
+            buckets=SIZE_BUCKETS,
+        )
+        self.reactor_lag = Histogram(
+            "ledge_reactor_lag_seconds",
+            "How late the reactor ran a periodic call.",
+        )
+        self.reactor_stalls = Counter(
+            "ledge_reactor_stalls_total",
+            "Times the reactor was caught stalled, see LEDGE_STALL_THRESHOLD.",
+        )
+        self.thread_pool_queued = Gauge(
+            "ledge_thread_pool_queued",
+            "Jobs waiting for a thread.",
+            ("pool",),
+            collect=lambda: self._pool_stat("queued"),
+        )
+        self.thread_pool_working = Gauge(
+            "ledge_thread_pool_working",
+            "Threads running a job.",
+            ("pool",),
+            collect=lambda: self._pool_stat("working"),
+        )
+        self.thread_pool_threads = Gauge(
+            "ledge_thread_pool_threads",
+            "Threads started.",
+            ("pool",),
+            collect=lambda: self._pool_stat("threads"),
+        )
+
+    def _pool_stat(self, stat):
+        """Collect one of the thread pool stats, for every pool."""
+        values = {
+            (name,): stats[stat] for name, stats in self.thread_pool_stats().items()
+        }
+        # The reactor's own pool runs handlers without a dedicated pool
+        pool = getattr(self._clock, "threadpool", None)
+        if isinstance(pool, ThreadPool):
+            stats = {
+                "queued": pool.q.qsize(),
+                "working": len(pool.working),
+                "threads": len(pool.threads),
+            }
+            values[("reactor",)] = stats[stat]
+        return values
+
+    def observe_event(self, context, event, plugin, timestamp):
+        """
+        Time plugin methods, as their lifecycle events are marked.
+
+        This is a :class:`ledge._context.RequestContext` observer.
+        """
+        phase, _, edge = event.rpartition("_")
+        if edge != "finished" or phase not in _TIMED_PHASES:
+            return
+        started = context.timings.get((f"{phase}_started", plugin))
+        if started is not None:
+            self.plugin_seconds.observe(
+                timestamp - started, (plugin, _TIMED_PHASES[phase])
+            )
+
+    def _measure_lag(self, interval):
+        """Record how late this call is."""
+        now = self._clock.seconds()
+        if self._expected is not None:
+            self.reactor_lag.observe(max(0.0, now - self._expected))
+        self._expected = now + interval
+        self.last_beat = time.monotonic()
+        self.beat_interval = interval
+
+    def monitor_reactor(self, interval=0.5):
+        """
+        Start measuring the reactor's lag.
+
+        :param float interval: How often to measure it, in seconds.
+
+        :rtype: `twisted.internet.task.LoopingCall`
+        """
+        loop = task.LoopingCall(self._measure_lag, interval)
+        loop.clock = self._clock
+        loop.start(interval)
+        return loop
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text format.
+
+        :rtype: bytes
+        """
+        metrics = (
+            self.requests,
+            self.content_bytes,
+            self.plugin_seconds,
+            self.reactor_lag,
+            self.reactor_stalls,
+            self.thread_pool_queued,
+            self.thread_pool_working,
+            self.thread_pool_threads,
+        )
+        return ("\n".join(metric.render() for metric in metrics) + "\n").encode("utf-8")
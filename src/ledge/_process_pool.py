@@ -0,0 +1,294 @@
+"""Run handlers in a pool of worker processes."""
+
+import multiprocessing
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
+
+import structlog
+from twisted.internet import defer
+
+from ._batching import BatchEvent
+from ._config import config_snapshot
+from ._context import get_context
+from ._logging import configure_logging
+
+# Workers aren't forked from the (multi-threaded) reactor process, as the
+# threads (eg: the log writer) wouldn't be running in them
+_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+#: Whether workers can be replaced individually, see ProcessPool.max_tasks.
+_MAX_TASKS_PER_CHILD = sys.version_info >= (3, 11)
+
+
+class RequestSnapshot:
+    """
+    A picklable snapshot of a request.
+
+    Handlers run in a process pool receive this in place of the
+    `twisted.web.http.Request`, which can't leave the reactor process.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, method, uri, path, headers, request_id=None
+    ):
+        """
+        Store the request attributes.
+
+        :param bytes method: The request method.
+        :param bytes uri: The request URI (path and query string).
+        :param bytes path: The request path.
+        :param dict headers: Lowercased header names (bytes) mapped to a list
+            of their values (bytes).
+        :param str request_id: The id ledge assigned to the request.
+        """
+        self.method = method
+        self.uri = uri
+        self.path = path
+        self.headers = headers
+        self.request_id = request_id
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        Snapshot a request.
+
+        :param twisted.web.http.Request request: The request.
+
+        :rtype: RequestSnapshot
+        """
+        context = get_context(request)
+        return cls(
+            request.method,
+            request.uri,
+            request.path,
+            {
+                name.lower(): list(values)
+                for name, values in request.requestHeaders.getAllRawHeaders()
+            },
+            request_id=None if context is None else context.request_id,
+        )
+
+    @property
+    def logger(self):
+        """A logger bound to the request id, in the worker process."""
+        return structlog.getLogger().new(request_id=self.request_id)
+
+    def getHeader(self, key):  # pylint: disable=invalid-name
+        """Return the last value of the named header, or None."""
+        if isinstance(key, str):
+            key = key.encode("latin-1")
+        values = self.headers.get(key.lower())
+        if not values:
+            return None
+        return values[-1]
+
+    def getAllHeaders(self):  # pylint: disable=invalid-name
+        """Return a dict of header names to their last value."""
+        return {name: values[-1] for name, values in self.headers.items()}
+
+
+def _init_worker(config):
+    """Set up a worker process, logging as the configuration asks."""
+    writer = configure_logging(config)
+    if writer is not None:
+        # Worker processes exit without running atexit functions
+        Finalize(writer, writer.close, exitpriority=0)
+
+
+def _call_handle(handler, snapshot, content):
+    """Run a handler in a worker process."""
+    return handler.handle(snapshot, content)
+
+
+def _call_handle_batch(handler, events):
+    """Run a batching handler in a worker process."""
+    return handler.handle_batch(events)
+
+
+class ProcessPool:
+    """
+    A process pool whose workers are recycled after a number of tasks.
+
+    Results and exceptions are delivered via Deferreds, in the reactor thread.
+    """
+
+    def __init__(self, max_workers=None, max_tasks=None, config=None):
+        """
+        Configure the pool. Processes are started on first use.
+
+        :param int max_workers: The number of worker processes, defaults to
+            the number of CPUs.
+        :param int max_tasks: How many tasks each of the pool's processes may
+            run before being replaced with a fresh one. If None they're never
+            replaced. Before Python 3.11 all the processes are replaced at
+            once, after the pool has run this many tasks.
+        :param config: The ledge configuration, which workers configure
+            their logging with. If None they don't.
+        """
+        self.max_workers = max_workers
+        self.max_tasks = max_tasks
+        self.config = None if config is None else config_snapshot(config)
+        self._executor = None
+        self._tasks = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """Return the current executor, recycling it if it's worn out."""
+        with self._lock:
+            recycles = self.max_tasks is not None and not _MAX_TASKS_PER_CHILD
+            if self._executor is not None and recycles:
+                if self._tasks >= self.max_tasks:
+                    # Tasks already submitted to the old executor still finish
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+            if self._executor is None:
+                self._executor = self._new_executor()
+                self._tasks = 0
+            self._tasks += 1
+            return self._executor
+
+    def _new_executor(self):
+        """Create an executor, whose workers are replaced per max_tasks."""
+        kwargs = {}
+        if self.max_tasks is not None and _MAX_TASKS_PER_CHILD:
+            kwargs["max_tasks_per_child"] = self.max_tasks
+        if self.config is not None:
+            kwargs.update(initializer=_init_worker, initargs=(self.config,))
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context(_START_METHOD),
+            **kwargs,
+        )
+
+    def submit(self, func, *args):
+        """
+        Run a function in the pool.
+
+        :param callable func: A picklable function.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires with the function's return value,
+            or errbacks with the exception it raised.
+        """
+        from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+        result = defer.Deferred()
+        future = self._get_executor().submit(func, *args)
+        future.add_done_callback(
+            lambda future: reactor.callFromThread(self._deliver, result, future)
+        )
+        return result
+
+    @staticmethod
+    def _deliver(result, future):
+        """Fire a deferred with the outcome of a future (reactor thread)."""
+        if future.cancelled():
+            # By the pool being abandoned
+            result.errback(defer.CancelledError())
+            return
+        exc = future.exception()
+        if exc is not None:
+            result.errback(exc)
+        else:
+            result.callback(future.result())
+
+    def shutdown(self):
+        """Stop the worker processes, once their tasks are finished."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def abandon(self):
+        """Stop the worker processes now, cancelling their tasks."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        # Shutting down forgets the processes, which are still busy. They're
+        # killed, as forked workers inherit the reactor's SIGTERM handler
+        # pylint: disable=protected-access
+        processes = list((executor._processes or {}).values())
+        if sys.version_info >= (3, 9):
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            executor.shutdown(wait=False)
+        for process in processes:
+            process.kill()
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def shared_pool(config):
+    """
+    Return the process pool shared by all handlers, creating it if needed.
+
+    :param config: The ledge configuration.
+
+    :rtype: ProcessPool
+    """
+    global _POOL  # pylint: disable=global-statement
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPool(
+                max_workers=config.process_pool_size,
+                max_tasks=config.process_pool_max_tasks,
+                config=config,
+            )
+        return _POOL
+
+
+def shutdown_shared_pool():
+    """Shut down the shared process pool, if it was ever used."""
+    global _POOL  # pylint: disable=global-statement
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def abandon_shared_pool():
+    """Stop the shared process pool now, if it was ever used."""
+    global _POOL  # pylint: disable=global-statement
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.abandon()
+
+
+def run_in_pool(handler, request, content):
+    """
+    Run a handler's `handle` method in the shared process pool.
+
+    :param ledge.HandlerImplementation handler: The (picklable) handler.
+    :param twisted.web.http.Request request: The incoming request.
+    :param bytes content: The content of the incoming request.
+
+    :rtype: `twisted.internet.defer.Deferred`
+    """
+    snapshot = RequestSnapshot.from_request(request)
+    return shared_pool(handler.config).submit(
+        _call_handle, handler, snapshot, bytes(content)
+    )
+
+
+def run_batch_in_pool(handler, events):
+    """
+    Run a handler's `handle_batch` method in the shared process pool.
+
+    :param ledge.HandlerImplementation handler: The (picklable) handler.
+    :param list events: The :class:`ledge._batching.BatchEvent` to handle.
+
+    :rtype: `twisted.internet.defer.Deferred`
+    """
+    snapshots = [
+        BatchEvent(RequestSnapshot.from_request(event.request), bytes(event.content))
+        for event in events
+    ]
+    return shared_pool(handler.config).submit(_call_handle_batch, handler, snapshots)
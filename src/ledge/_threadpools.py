@@ -0,0 +1,148 @@
+"""Dedicated thread pools, so slow handlers can't starve the others."""
+
+import threading
+from functools import partial
+
+import environ
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+
+class HandlerQueueFull(RuntimeError):
+    """Raised when a handler already has its maximum number of jobs."""
+
+
+def thread_pool_subconfig(handler_cls):
+    """
+    Build the thread pool subconfig for a handler class.
+
+    The defaults are taken from the class' THREAD_POOL_MIN, THREAD_POOL_MAX
+    and MAX_QUEUED_JOBS attributes.
+
+    :param type handler_cls: The handler class.
+
+    :rtype: type
+    """
+
+    class ThreadPoolSubConfig:  # pylint: disable=too-few-public-methods
+        """Thread pool subconfig."""
+
+        min_threads = environ.var(
+            converter=int,
+            default=handler_cls.THREAD_POOL_MIN,
+            help=f"The minimum number of threads running {handler_cls.name}.",
+        )
+        max_threads = environ.var(
+            converter=int,
+            default=handler_cls.THREAD_POOL_MAX,
+            help=f"The maximum number of threads running {handler_cls.name}.",
+        )
+        max_jobs = environ.var(
+            converter=lambda a_str: None if a_str is None else int(a_str),
+            default=handler_cls.MAX_QUEUED_JOBS,
+            help=f"The maximum number of {handler_cls.name} jobs which may be "
+            "queued or running. Jobs beyond it are dropped. If not supplied "
+            "there is no limit.",
+        )
+
+    return environ.config(ThreadPoolSubConfig)
+
+
+class HandlerThreadPool:
+    """
+    A thread pool dedicated to a single handler.
+
+    The pool's threads are started on first use, and stopped when the
+    reactor shuts down. They're daemon threads, so if the pool is abandoned
+    (see :meth:`abandon`) a stuck handler can't keep the process alive.
+    """
+
+    def __init__(self, name, min_threads=0, max_threads=10, max_jobs=None):
+        """
+        Create the (unstarted) pool.
+
+        :param str name: The name of the pool, used to name its threads.
+        :param int min_threads: The minimum number of threads.
+        :param int max_threads: The maximum number of threads.
+        :param int max_jobs: The maximum number of queued or running jobs.
+        """
+        self.pool = ThreadPool(min_threads, max_threads, name=name)
+        self.pool.threadFactory = partial(threading.Thread, daemon=True)
+        self.max_jobs = max_jobs
+        #: The number of jobs submitted to the pool which haven't finished.
+        self.outstanding = 0
+        self._shutdown_trigger = None
+
+    def _start(self):
+        """Start the pool, arranging for it to stop with the reactor."""
+        from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+        self.pool.start()
+        self._shutdown_trigger = reactor.addSystemEventTrigger(
+            "during", "shutdown", self.pool.stop
+        )
+
+    def stop(self):
+        """Stop the pool now, rather than when the reactor shuts down."""
+        from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+        if self._shutdown_trigger is not None:
+            reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._shutdown_trigger = None
+            self.pool.stop()
+
+    def abandon(self):
+        """
+        Leave the pool's threads running when the reactor shuts down.
+
+        Rather than waiting for the jobs they're running to finish.
+        """
+        from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+        if self._shutdown_trigger is not None:
+            reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._shutdown_trigger = None
+
+    def _finished(self, result):
+        """Account for a finished job, passing its result through."""
+        self.outstanding -= 1
+        return result
+
+    def submit(self, func, *args):
+        """
+        Run a function in the pool.
+
+        :param callable func: The function to run.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires with the function's result. It
+            errbacks with :class:`HandlerQueueFull` if the pool already had
+            its maximum number of jobs.
+        """
+        if self.max_jobs is not None and self.outstanding >= self.max_jobs:
+            return defer.fail(
+                HandlerQueueFull(f"{self.pool.name} has {self.outstanding} jobs.")
+            )
+        if not self.pool.started:
+            self._start()
+        self.outstanding += 1
+        from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+        return threads.deferToThreadPool(reactor, self.pool, func, *args).addBoth(
+            self._finished
+        )
+
+    def stats(self):
+        """
+        Describe the current state of the pool.
+
+        :rtype: dict
+        :returns: The number of queued jobs, busy threads, total threads and
+            outstanding (queued or running) jobs.
+        """
+        return {
+            "queued": self.pool.q.qsize(),
+            "working": len(self.pool.working),
+            "threads": len(self.pool.threads),
+            "outstanding": self.outstanding,
+        }
@@ -1,11 +1,60 @@
 """Various internal uility functions for ledge."""
 
+import os
 import string
-from itertools import chain
+import time
+from itertools import chain, count
 from uuid import uuid4
 
 import structlog
 
+from ._context import RequestContext, get_context
+
+
+def _uuid_request_id():
+    """Return a random request id."""
+    return uuid4().hex
+
+
+class _MonotonicRequestIds:  # pylint: disable=too-few-public-methods
+    """
+    Cheap, increasing request ids.
+
+    They're unique to this process (and start time), so are prefixed with
+    both to remain unique between workers and restarts.
+    """
+
+    def __init__(self):
+        """Start counting."""
+        self._prefix = f"{os.getpid():x}-{int(time.time()):x}-"
+        self._counter = count(1)
+
+    def __call__(self):
+        """Return the next request id."""
+        return f"{self._prefix}{next(self._counter):x}"
+
+
+#: The request id generators which can be selected via LEDGE_REQUEST_IDS.
+REQUEST_ID_GENERATORS = {"uuid": _uuid_request_id, "monotonic": _MonotonicRequestIds}
+
+_next_request_id = _uuid_request_id
+
+
+def use_request_ids(name):
+    """
+    Select how request ids are generated.
+
+    :param str name: One of :data:`REQUEST_ID_GENERATORS`.
+    """
+    global _next_request_id  # pylint: disable=global-statement
+    if name not in REQUEST_ID_GENERATORS:
+        raise ValueError(
+            f"Unknown request ids {name!r}, "
+            f"expected one of {tuple(REQUEST_ID_GENERATORS)}"
+        )
+    generator = REQUEST_ID_GENERATORS[name]
+    _next_request_id = generator if name == "uuid" else generator()
+
 
 def inject_logger(request):
     """
@@ -13,15 +62,25 @@ def inject_logger(request):
 
     This logger contains some basic information about the request.
 
+    A :class:`ledge._context.RequestContext` is attached alongside it, so
+    helpers can memoize per-request work, unless one already was (by
+    :class:`ledge._web.LedgeRequest`, when the request was received).
+
     Mutates the provided request object. Returns it as a convenience.
     """
     logger = structlog.getLogger()
+    request_id = _next_request_id()
     request.logger = logger.new(
-        request_id=uuid4().hex,
+        request_id=request_id,
         method=request.method.decode("utf-8"),
         path=request.path.decode("utf-8"),
         client_ip=request.getClientIP(),
     )
+    context = get_context(request)
+    if context is None:
+        context = request.ledge_context = RequestContext()
+        context.mark("received")
+    context.request_id = request_id
     return request
 
 
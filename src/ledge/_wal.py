@@ -0,0 +1,369 @@
+"""A write-ahead log of accepted requests, so they survive restarts."""
+
+import json
+import os
+import struct
+import threading
+import zlib
+
+import structlog
+from twisted.internet import defer, reactor
+from twisted.web.http_headers import Headers
+
+from ledge.helpers import as_buffer
+
+_APPEND = 1
+_DONE = 2
+
+_HEADER = struct.Struct(">BQI")  # record kind, entry id, payload length
+_CHECKSUM = struct.Struct(">I")
+_META_LENGTH = struct.Struct(">I")
+
+_SUFFIX = ".wal"
+
+
+def _encode_request(request, content):
+    """Serialize the parts of a request handlers rely on."""
+    meta = {
+        "method": request.method.decode("latin-1"),
+        "uri": request.uri.decode("latin-1"),
+        "headers": [
+            [name.decode("latin-1"), [value.decode("latin-1") for value in values]]
+            for name, values in request.requestHeaders.getAllRawHeaders()
+        ],
+    }
+    meta_bytes = json.dumps(meta).encode("utf-8")
+    return b"".join(
+        (_META_LENGTH.pack(len(meta_bytes)), meta_bytes, as_buffer(content))
+    )
+
+
+def _decode_request(payload):
+    """Rebuild a request from its serialized form."""
+    (meta_length,) = _META_LENGTH.unpack_from(payload)
+    meta_start = _META_LENGTH.size
+    meta_end = meta_start + meta_length
+    meta = json.loads(payload[meta_start:meta_end].decode("utf-8"))
+    headers = Headers()
+    for name, values in meta["headers"]:
+        headers.setRawHeaders(
+            name.encode("latin-1"), [value.encode("latin-1") for value in values]
+        )
+    request = ReplayedRequest(
+        meta["method"].encode("latin-1"), meta["uri"].encode("latin-1"), headers
+    )
+    return request, payload[meta_end:]
+
+
+def _frame(kind, entry_id, payload=b""):
+    """Frame a record, so torn writes can be detected."""
+    header = _HEADER.pack(kind, entry_id, len(payload))
+    checksum = zlib.crc32(payload, zlib.crc32(header))
+    return b"".join((header, payload, _CHECKSUM.pack(checksum)))
+
+
+def _read_records(path):
+    """Yield the (kind, entry id, payload) of each intact record in a segment."""
+    with open(path, "rb") as segment:
+        data = segment.read()
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        kind, entry_id, length = _HEADER.unpack_from(data, offset)
+        start = offset + _HEADER.size
+        end = start + length
+        if end + _CHECKSUM.size > len(data):
+            return  # Torn write at the tail of the segment
+        (checksum,) = _CHECKSUM.unpack_from(data, end)
+        if checksum != zlib.crc32(data[offset:end]):
+            return
+        yield kind, entry_id, data[start:end]
+        offset = end + _CHECKSUM.size
+
+
+class ReplayedRequest:
+    """
+    A stand-in for a `twisted.web.http.Request` rebuilt from the log.
+
+    Replayed requests are only passed to handlers - the original request
+    was already responded to (or abandoned) - so responding is a no-op.
+    """
+
+    def __init__(self, method, uri, headers):
+        """
+        Store the request attributes.
+
+        :param bytes method: The request method.
+        :param bytes uri: The request URI (path and query string).
+        :param twisted.web.http_headers.Headers headers: The request headers.
+        """
+        self.method = method
+        self.uri = uri
+        self.path = uri.split(b"?", 1)[0]
+        self.requestHeaders = headers  # pylint: disable=invalid-name
+
+    def getHeader(self, key):  # pylint: disable=invalid-name
+        """Return the last value of the named header, or None."""
+        values = self.requestHeaders.getRawHeaders(key)
+        if values is None:
+            return None
+        return values[-1]
+
+    def getAllHeaders(self):  # pylint: disable=invalid-name
+        """Return a dict of header names to their last value."""
+        return {
+            name.lower(): values[-1]
+            for name, values in self.requestHeaders.getAllRawHeaders()
+        }
+
+    def getClientIP(self):  # pylint: disable=invalid-name,no-self-use
+        """Replayed requests have no client."""
+        return None
+
+    def setResponseCode(self, code, message=None):  # pylint: disable=invalid-name
+        """Do nothing, there is no one to respond to."""
+
+    def setHeader(self, name, value):  # pylint: disable=invalid-name
+        """Do nothing, there is no one to respond to."""
+
+    def write(self, data):
+        """Do nothing, there is no one to respond to."""
+
+    def finish(self):
+        """Do nothing, there is no one to respond to."""
+
+
+class WriteAheadLog:
+    """
+    An append-only, segmented log of accepted requests.
+
+    Requests are appended before they're responded to and marked done once
+    all of their handlers have finished. Writes are performed, and fsync-ed,
+    in batches by a dedicated thread (group commit), so the cost of an fsync
+    is shared by every request which arrived while the previous one ran.
+
+    On opening, requests which were appended but never marked done are
+    recovered so their handlers can be run again.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        """
+        Open the log, recovering any incomplete entries.
+
+        :param str directory: The directory to keep the log segments in.
+        :param int segment_size: The size, in bytes, beyond which a new
+            segment is started.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._closing = False
+        self._live = {}  # segment number -> ids of its incomplete entries
+        self._locations = {}  # entry id -> segment number
+        self._next_id = 0
+        self._segment_number = 0
+        self._segment = None
+        self.recovered = []
+        #: The error which stopped the writer thread, if it failed.
+        self.error = None
+
+        old_segments = self._segment_paths()
+        entries = self._scan(old_segments)
+        self._roll()
+        for request, content in entries:
+            entry_id = self._allocate_id()
+            self._write(_frame(_APPEND, entry_id, _encode_request(request, content)))
+            self.recovered.append((entry_id, request, content))
+        self._sync()
+        for _, path in old_segments:
+            os.remove(path)
+
+        self._thread = threading.Thread(
+            target=self._run, name="ledge-wal-writer", daemon=True
+        )
+        self._thread.start()
+
+    def _segment_paths(self):
+        """Return the (number, path) of the existing segments, in order."""
+        segments = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(_SUFFIX):
+                number = int(filename[: -len(_SUFFIX)])
+                segments.append((number, os.path.join(self.directory, filename)))
+        return sorted(segments)
+
+    def _scan(self, segments):
+        """Return the requests from the segments which were never marked done."""
+        appended = {}
+        for number, path in segments:
+            self._segment_number = max(self._segment_number, number)
+            for kind, entry_id, payload in _read_records(path):
+                self._next_id = max(self._next_id, entry_id + 1)
+                if kind == _APPEND:
+                    appended[entry_id] = payload
+                elif kind == _DONE:
+                    appended.pop(entry_id, None)
+        return [_decode_request(appended[entry_id]) for entry_id in sorted(appended)]
+
+    def _allocate_id(self):
+        """Return the next entry id."""
+        entry_id = self._next_id
+        self._next_id += 1
+        return entry_id
+
+    def _path(self, number):
+        """Return the path of the numbered segment."""
+        return os.path.join(self.directory, f"{number:020d}{_SUFFIX}")
+
+    def _roll(self):
+        """Start writing to a new segment."""
+        if self._segment is not None:
+            self._sync()
+            self._segment.close()
+        self._segment_number += 1
+        self._segment = open(  # pylint: disable=consider-using-with
+            self._path(self._segment_number), "ab"
+        )
+        self._live[self._segment_number] = set()
+        self._collect()
+
+    def _collect(self):
+        """
+        Delete the segments with no incomplete entries, oldest first.
+
+        A segment can hold the DONE records of entries appended to older
+        segments, so it's only deleted once every older segment has been.
+        """
+        for number in sorted(self._live):
+            if number == self._segment_number or self._live[number]:
+                return
+            self._delete(number)
+
+    def _delete(self, number):
+        """Delete a segment with no incomplete entries."""
+        self._live.pop(number, None)
+        try:
+            os.remove(self._path(number))
+        except FileNotFoundError:
+            pass
+
+    def _write(self, record):
+        """Write a record to the active segment (writer thread only)."""
+        kind, entry_id, _ = _HEADER.unpack_from(record)
+        if kind == _APPEND:
+            if self._segment.tell() >= self.segment_size:
+                self._roll()
+            self._live[self._segment_number].add(entry_id)
+            self._locations[entry_id] = self._segment_number
+        self._segment.write(record)
+        if kind == _DONE:
+            number = self._locations.pop(entry_id, None)
+            live = self._live.get(number)
+            if live is not None:
+                live.discard(entry_id)
+                if not live:
+                    self._collect()
+
+    def _sync(self):
+        """Flush the active segment to disk."""
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+
+    def _run(self):
+        """Write and fsync pending records in batches, until closed."""
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+                closing = self._closing
+            if batch:
+                try:
+                    for record, _ in batch:
+                        self._write(record)
+                    self._sync()
+                except Exception as exc:  # pylint: disable=broad-except
+                    self._failed(exc, batch)
+                    return
+                waiters = [waiter for _, waiter in batch if waiter is not None]
+                if waiters:
+                    reactor.callFromThread(self._fire, waiters)
+            elif closing:
+                return
+
+    @staticmethod
+    def _fire(waiters):
+        """Fire the deferreds waiting on a batch (reactor thread)."""
+        for entry_id, waiter in waiters:
+            waiter.callback(entry_id)
+
+    @staticmethod
+    def _fail(waiters, error):
+        """Fail the deferreds waiting on records never written (reactor thread)."""
+        for _, waiter in waiters:
+            waiter.errback(error)
+
+    def _failed(self, error, batch):
+        """Stop accepting records, after the writer thread fails."""
+        with self._cond:
+            self.error = error
+            batch = batch + self._pending
+            self._pending = []
+        structlog.getLogger().msg(
+            "Write-ahead log failed, rejecting new requests.", error=repr(error)
+        )
+        waiters = [waiter for _, waiter in batch if waiter is not None]
+        if waiters:
+            reactor.callFromThread(self._fail, waiters, error)
+
+    def _enqueue(self, record, waiter=None):
+        """
+        Hand a record to the writer thread.
+
+        :returns: False if the log has failed, so the record won't be written.
+        """
+        with self._cond:
+            if self.error is not None:
+                return False
+            self._pending.append((record, waiter))
+            self._cond.notify()
+        return True
+
+    def append(self, request, content):
+        """
+        Append a request to the log.
+
+        :param twisted.web.http.Request request: The incoming request.
+        :param bytes content: The content of the request.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires with the entry id once the entry
+            is durably on disk, or fails with the error if the log has failed
+            (see :attr:`error`).
+        """
+        entry_id = self._allocate_id()
+        durable = defer.Deferred()
+        if not self._enqueue(
+            _frame(_APPEND, entry_id, _encode_request(request, content)),
+            (entry_id, durable),
+        ):
+            durable.errback(self.error)
+        return durable
+
+    def mark_done(self, entry_id):
+        """
+        Mark an entry as complete, so it won't be recovered.
+
+        :param int entry_id: The id the entry was appended with.
+        """
+        self._enqueue(_frame(_DONE, entry_id))
+
+    def close(self):
+        """Write any pending records and stop the writer thread."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+        self._segment.close()
@@ -0,0 +1,115 @@
+"""Report the reactor stalling, eg: on a plugin blocking the reactor thread."""
+
+import sys
+import threading
+import time
+import traceback
+
+import structlog
+
+from ._bases import HandlerImplementation, ResponderImplementation
+from ._context import get_context
+
+
+def blame(frame):
+    """
+    Find the plugin, and the request, a stack of frames is working on.
+
+    The innermost plugin method, and request argument, are used.
+
+    :param frame: The innermost frame of the stack.
+
+    :rtype: Tuple[str, str]
+    :returns: The plugin's name and the request's id, either may be None.
+    """
+    plugin = request_id = None
+    while frame is not None and (plugin is None or request_id is None):
+        local_vars = frame.f_locals
+        candidate = local_vars.get("self")
+        if plugin is None and isinstance(
+            candidate, (HandlerImplementation, ResponderImplementation)
+        ):
+            plugin = candidate.name
+        context = get_context(local_vars.get("request"))
+        if request_id is None and context is not None:
+            request_id = context.request_id
+        frame = frame.f_back
+    return plugin, request_id
+
+
+class Watchdog:
+    """
+    Watch, from a thread of its own, for the reactor stalling.
+
+    The reactor is stalled if the periodic call measuring its lag (see
+    :meth:`ledge._metrics.Metrics.monitor_reactor`) is overdue by more than
+    the threshold. Each stall is logged once, while it's happening, with the
+    reactor thread's stack and the plugin and request it's stuck on.
+    """
+
+    def __init__(self, metrics, threshold, clock=time.monotonic):
+        """
+        Configure the watchdog, without starting it.
+
+        :param ledge._metrics.Metrics metrics: The metrics whose heartbeat is
+            watched, and whose stall count is incremented.
+        :param float threshold: How overdue, in seconds, the heartbeat may be.
+        :param callable clock: Returns the current `time.monotonic` time.
+        """
+        self.metrics = metrics
+        self.threshold = threshold
+        self.clock = clock
+        self.reactor_thread_id = None
+        # The heartbeat the last stall was reported after
+        self._reported = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def check(self):
+        """
+        Report the reactor if it's stalled, unless it already has been.
+
+        :rtype: bool
+        :returns: Whether a stall was reported.
+        """
+        from twisted.internet import reactor  # pylint: disable=import-outside-toplevel
+
+        last_beat = self.metrics.last_beat
+        if last_beat is None or last_beat == self._reported:
+            return False
+        overdue = self.clock() - last_beat - self.metrics.beat_interval
+        if overdue <= self.threshold:
+            return False
+        self._reported = last_beat
+        # pylint: disable=protected-access
+        frame = sys._current_frames().get(self.reactor_thread_id)
+        plugin, request_id = blame(frame)
+        structlog.getLogger().msg(
+            f"Reactor stalled for over {overdue:.3f}s.",
+            plugin=plugin,
+            request_id=request_id,
+            stack="".join(traceback.format_stack(frame)) if frame else None,
+        )
+        # Metrics are only updated from the reactor thread
+        reactor.callFromThread(self.metrics.reactor_stalls.inc)
+        return True
+
+    def _run(self):
+        """Check on the reactor until the watchdog is stopped."""
+        interval = min(self.threshold, self.metrics.beat_interval or self.threshold)
+        while not self._stopping.wait(interval / 2):
+            self.check()
+
+    def start(self):
+        """Start watching, must be called from the reactor thread."""
+        self.reactor_thread_id = threading.get_ident()
+        self._thread = threading.Thread(
+            target=self._run, name="ledge-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
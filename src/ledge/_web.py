@@ -1,12 +1,215 @@
 """Twisted web components of Ledge."""
 
+import socket
+import tempfile
+from io import BytesIO
 
+import structlog
 from twisted.internet import endpoints, reactor
-from twisted.web import resource, server
+from twisted.internet.interfaces import IProtocolNegotiationFactory
+from twisted.python.failure import Failure
+from twisted.web import http, resource, server
 from twisted.web.server import NOT_DONE_YET
+from zope.interface import implementer
 
+from ._body import Body
+from ._context import RequestContext, get_context
+from ._decoding import ENCODINGS, ContentDecoder, ContentTooLarge, MalformedContent
+from ._metrics import CONTENT_TYPE
 from ._utils import inject_logger
 
+#: The methods WebRoot renders, requests with any other method are rejected.
+ACCEPTED_METHODS = (b"GET", b"HEAD", b"POST")
+
+
+class LedgeRequest(server.Request):
+    """
+    A request which is screened before its content is buffered.
+
+    Requests are rejected as soon as their headers arrive if their method,
+    path or declared length mean they'd be rejected anyway, and as soon as
+    the content received exceeds the maximum content length otherwise. This
+    way unwanted content is never buffered.
+
+    If enabled, gzip and deflate encoded content is decoded as it arrives.
+
+    Content beyond its site's threshold is spooled to disk.
+
+    Its :class:`ledge._context.RequestContext` is attached as soon as the
+    request line arrives, so the time it was received excludes the time
+    spent buffering its content.
+    """
+
+    #: The HTTP status code the request was rejected with, if it was.
+    rejected = None
+
+    _received = 0
+    _decoder = None
+
+    def __init__(self, *args, **kwargs):
+        """Create the request, marking it received."""
+        super().__init__(*args, **kwargs)
+        self.ledge_context = RequestContext()
+        self.ledge_context.mark("received")
+
+    def _root(self):
+        """Return the site's :class:`WebRoot`, if it has one."""
+        root = getattr(getattr(self.channel, "site", None), "resource", None)
+        return root if isinstance(root, WebRoot) else None
+
+    def _request_line(self):
+        """
+        Return the request's method and URI, before it's fully received.
+
+        Until then (when `self.method` and `self.uri` are set) they're only
+        stored on the channel, which is an HTTP/1 channel or an HTTP/2 stream.
+        """
+        channel = self.channel
+        # pylint: disable=protected-access
+        method = getattr(channel, "_command", None) or getattr(channel, "command", None)
+        uri = getattr(channel, "_path", None) or getattr(channel, "path", None)
+        return method, uri
+
+    def gotLength(self, length):
+        """Choose where to buffer the content, given its length (if known)."""
+        root = self._root()
+        if root is not None:
+            method, uri = self._request_line()
+            if method is not None and uri is not None:
+                code = root.screen(method, uri.split(b"?", 1)[0], length)
+                if code is not None:
+                    self.reject(code)
+                    return
+            if root.app.config.decode_content:
+                try:
+                    self._decoder = root.content_decoder(
+                        self.getHeader(b"content-encoding")
+                    )
+                except KeyError:
+                    self.reject(415)
+                    return
+        # Encoded content is buffered by its declared (encoded) length, as
+        # its decoded length is capped at the maximum content length anyway
+        threshold = getattr(
+            getattr(self.channel, "site", None), "spool_threshold", None
+        )
+        if threshold is None:
+            super().gotLength(length)
+        elif length is not None and length < threshold:
+            self.content = BytesIO()
+        else:
+            self.content = tempfile.TemporaryFile()
+
+    def handleContentChunk(self, data):
+        """Buffer a chunk of content, unless there's too much of it."""
+        if self.rejected is not None:
+            return
+        self._received += len(data)
+        root = self._root()
+        if root is not None and self._received > root.max_content_length:
+            self.reject(413)
+            return
+        if self._decoder is not None:
+            try:
+                data = self._decoder.decode(data)
+            except ContentTooLarge:
+                self.reject(413)
+                return
+            except MalformedContent:
+                self.reject(400)
+                return
+        super().handleContentChunk(data)
+
+    def requestReceived(self, command, path, version):
+        """Process the request, unless it's already been rejected."""
+        if self.rejected is not None:
+            return
+        if self._decoder is not None:
+            try:
+                self._decoder.finish()
+            except MalformedContent:
+                self.reject(400)
+                return
+            # Plugins receive the decoded content
+            self.requestHeaders.removeHeader(b"content-encoding")
+        super().requestReceived(command, path, version)
+
+    def reject(self, code):
+        """
+        Reject the request, without reading any more of it.
+
+        A bare response is sent, then the connection (or over HTTP/2, just
+        the request's stream) is closed, since the request was never fully
+        received.
+
+        :param int code: The HTTP status code to respond with.
+        """
+        self.rejected = code
+        root = self._root()
+        if root is not None:
+            root.app.metrics.requests.inc((str(code),))
+        # Don't invite the client to send the content
+        self.requestHeaders.removeHeader(b"expect")
+        if self.content is not None:
+            self.content.close()
+            self.content = None
+        structlog.getLogger().msg(
+            "Rejecting request before reading its content.", code=code
+        )
+        method, _ = self._request_line()
+        if method is not None:
+            # So a HEAD request isn't sent a body
+            self.method = method
+        self.setResponseCode(code)
+        self.setHeader(b"content-length", b"0")
+        if isinstance(self.channel, http.HTTPChannel):
+            # pylint: disable=protected-access
+            self.clientproto = getattr(self.channel, "_version", b"HTTP/1.1")
+            self.setHeader(b"connection", b"close")
+            self.write(b"")
+            self.channel.loseConnection()
+        else:
+            # An HTTP/2 stream is only fully set up once the frame carrying its
+            # headers has been processed
+            reactor.callLater(0, self._reset_stream)
+
+    def _reset_stream(self):
+        """Respond to a rejected HTTP/2 request, and reset its stream."""
+        if self._disconnected:
+            return
+        self.write(b"")
+        # Tells the client to stop sending the content
+        self.channel.abortConnection()
+
+
+@implementer(IProtocolNegotiationFactory)
+class LedgeSite(server.Site):
+    """
+    The ledge site, which uses :class:`LedgeRequest`.
+
+    Over TLS it offers HTTP/2 via ALPN, if HTTP/2 support is installed.
+    """
+
+    requestFactory = LedgeRequest
+
+    def __init__(self, root, spool_threshold=None, **kwargs):
+        """
+        Set the root resource and the spooling threshold.
+
+        :param resource.Resource root: The root resource.
+        :param int spool_threshold: The content length, in bytes, beyond which
+            request content is spooled to a temporary file rather than held
+            in memory. If None Twisted's default is used.
+        """
+        super().__init__(root, **kwargs)
+        self.spool_threshold = spool_threshold
+
+    def acceptableProtocols(self):  # pylint: disable=invalid-name,no-self-use
+        """Return the protocols to offer via ALPN, most preferred first."""
+        if http.H2_ENABLED:
+            return [b"h2", b"http/1.1"]
+        return [b"http/1.1"]
+
 
 class WebRoot(resource.Resource):
     """Class which represents the root of the webserver."""
@@ -16,40 +219,190 @@ class WebRoot(resource.Resource):
     def __init__(self, app):
         """Embed the ledge application."""
         self.app = app
+        #: The ports the site is listening on, see :func:`configure_site`.
+        self.ports = []
+        #: Set when ledge starts shutting down, so new requests are refused.
+        self.draining = False
         super().__init__()
 
+    @property
+    def max_content_length(self):
+        """The maximum request content size to accept, in bytes."""
+        return self.app.config.max_content_length
+
+    def screen(self, method, path, length):
+        """
+        Decide whether to reject a request before its content is read.
+
+        :param bytes method: The request method.
+        :param bytes path: The request path.
+        :param int length: The declared content length, or None.
+
+        :rtype: int
+        :returns: The HTTP status code to reject the request with, or None
+            if it should be read.
+        """
+        if method not in ACCEPTED_METHODS:
+            return 405
+        if self.draining:
+            return 503
+        if length is not None and length > self.max_content_length:
+            return 413
+        if (
+            method == b"POST"
+            and self.app.config.reject_unmatched
+            and not self.app.could_match(method, path)
+        ):
+            return 404
+        return None
+
+    def content_decoder(self, encoding):
+        """
+        Build a decoder for content with the given Content-Encoding.
+
+        :param bytes encoding: The Content-Encoding header value, or None.
+
+        :rtype: ledge._decoding.ContentDecoder
+        :returns: The decoder, or None if the content isn't encoded.
+        :raises KeyError: If the encoding isn't supported.
+        """
+        if encoding is None:
+            return None
+        encoding = encoding.strip().lower()
+        if encoding == b"identity":
+            return None
+        if encoding not in ENCODINGS:
+            raise KeyError(encoding)
+        return ContentDecoder(
+            encoding,
+            self.max_content_length,
+            max_ratio=self.app.config.max_compression_ratio,
+        )
+
     def render(self, request):
         """Add a logger to each request + delegate."""
         inject_logger(request)
+        request.notifyFinish().addBoth(self._count_finished, request)
         return super().render(request)
 
+    def _count_finished(self, result, request):
+        """Count a finished (or abandoned) request by its status code."""
+        code = "disconnected" if isinstance(result, Failure) else str(request.code)
+        self.app.metrics.requests.inc((code,))
+
     def render_GET(self, request):  # pylint: disable=C0103,W0613,R0201
         """Debugging endpoint, so you can see when the server is running."""
+        config = self.app.config
+        if config.metrics_port is None and request.path == config.metrics_path.encode(
+            "utf-8"
+        ):
+            return render_metrics(self.app, request)
         return "<html>Ledge is listening!</html>".encode("utf-8")
 
+    def _read_content(self, request):
+        """
+        Take the request content, or None if it's too large.
+
+        Twisted doesn't like preserving access to content when we use
+        callLater - so we manually take it.
+        """
+        max_length = self.app.config.max_content_length
+        body_mode = self.app.config.body_mode
+        if body_mode in ("buffer", "memoryview"):
+            content = Body.from_file(request.content)
+            # Twisted closes the content once the response is finished, the
+            # body must outlive it.
+            request.content = BytesIO()
+            if len(content) > max_length:
+                return None
+            return content.view if body_mode == "memoryview" else content
+        if isinstance(request.content, BytesIO):
+            # Shares the buffer's bytes, rather than copying them, if it can
+            content = request.content.getvalue()
+        else:
+            # One byte over the maximum tells us the content is too large
+            content = request.content.read(max_length + 1)
+        return content if len(content) <= max_length else None
+
     def render_POST(self, request):  # pylint: disable=invalid-name
         """Provide the request to the Ledge instance."""
-        # Twisted doesn't like preserving access to content when
-        # we use callLater - so we manually read it.
-        content = request.content.read(self.app.config.max_content_length)
-        # Check to see if there is data left...
-        if request.content.read(1):
+        content = self._read_content(request)
+        context = get_context(request)
+        if context is not None:
+            context.mark("body_read")
+        if content is None:
             request.logger.msg("Request content too large - dropping.")
             request.setResponseCode(413)
             return b""
         content_len = len(content)
+        self.app.metrics.content_bytes.observe(content_len)
         request.logger.msg(f"Content length: {str(content_len)}")
+        if not self.app.admit(request, content):
+            request.logger.msg("Over capacity - shedding request.")
+            request.setResponseCode(self.app.config.shed_status_code)
+            request.setHeader("Retry-After", str(self.app.config.retry_after))
+            return b""
         reactor.callLater(0, self.app.handle_request, request, content)
         return NOT_DONE_YET
 
 
-def configure_site(app, port=8080):
+def render_metrics(app, request):
+    """
+    Render the application's metrics.
+
+    :param ledge._app.Ledge app: The application.
+    :param twisted.web.http.Request request: The request for them.
+
+    :rtype: bytes
+    """
+    request.setHeader(b"Content-Type", CONTENT_TYPE)
+    return app.metrics.render()
+
+
+class MetricsRoot(resource.Resource):
+    """Serves the metrics of the app embedded in a :class:`WebRoot`."""
+
+    isLeaf = True
+
+    def __init__(self, root):
+        """Embed the root, so the metrics are always the current app's."""
+        self.root = root
+        super().__init__()
+
+    def render_GET(self, request):  # pylint: disable=invalid-name
+        """Render the metrics, on any path."""
+        return render_metrics(self.root.app, request)
+
+
+def configure_site(app, port=8080, listen_fd=None, listen=None):
     """
     Configure the Webroot to listen on a TCP port.
 
+    If `listen_fd` is provided connections are instead accepted on that
+    (inherited, already listening) socket. Otherwise if `listen` is provided
+    the site listens on each of its Twisted endpoint descriptions, eg:
+    "unix:/run/ledge.sock", "tcp6:8080", "ssl:8443:privateKey=key.pem" or
+    "systemd:domain=INET:index=0" (for socket activation).
+
+    Metrics are served on their own port, if one is configured.
+
     This should be called before `reactor.run`.
+
+    :rtype: WebRoot
+    :returns: The site's root, whose `app` may be replaced to reload it. Its
+        `ports` are filled in once the site is listening.
     """
     # Configure twisted
-    site = server.Site(WebRoot(app))
-    endpoint = endpoints.TCP4ServerEndpoint(reactor, port)
-    endpoint.listen(site)
+    root = WebRoot(app)
+    site = LedgeSite(root, spool_threshold=app.config.body_spool_threshold)
+    if app.config.metrics_port is not None:
+        endpoints.TCP4ServerEndpoint(reactor, app.config.metrics_port).listen(
+            server.Site(MetricsRoot(root))
+        )
+    if listen_fd is not None:
+        root.ports.append(reactor.adoptStreamPort(listen_fd, socket.AF_INET, site))
+        return root
+    for description in listen or [f"tcp:{port}"]:
+        endpoint = endpoints.serverFromString(reactor, description)
+        endpoint.listen(site).addCallback(root.ports.append)
+    return root
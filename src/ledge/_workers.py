@@ -0,0 +1,130 @@
+"""Run several ledge worker processes sharing one listening socket."""
+
+import os
+import signal
+import socket
+import subprocess  # nosec
+import sys
+import time
+
+import structlog
+
+#: Workers which exit sooner than this (in seconds) after starting are
+#: considered to be crash looping, and are restarted with a delay.
+MIN_WORKER_LIFETIME = 1.0
+
+
+def _exit_code(status):
+    """Convert a status from `os.wait` to an exit code (negative if signalled)."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def worker_env(config, index, listen_fd, environ=None):
+    """
+    Build the environment for a worker process.
+
+    :param config: The ledge configuration.
+    :param int index: The worker's index, stable across restarts.
+    :param int listen_fd: The inherited listening socket's file descriptor.
+    :param dict environ: The environment to extend, defaults to `os.environ`.
+
+    :rtype: dict
+    """
+    env = dict(os.environ if environ is None else environ)
+    env["LEDGE_WORKERS"] = "1"
+    env["LEDGE_LISTEN_FD"] = str(listen_fd)
+    if config.wal_dir is not None:
+        # Each worker keeps (and replays) its own log.
+        env["LEDGE_WAL_DIR"] = os.path.join(config.wal_dir, f"worker-{index}")
+    if config.dedup_snapshot is not None:
+        env["LEDGE_DEDUP_SNAPSHOT"] = f"{config.dedup_snapshot}.worker-{index}"
+    return env
+
+
+class Supervisor:
+    """
+    Fork ledge worker processes, and keep them running.
+
+    The supervisor binds the listening socket and hands it down to each
+    worker, which accepts connections on it with its own reactor. Workers
+    which exit are restarted, and SIGINT/SIGTERM/SIGHUP are forwarded to
+    every worker.
+    """
+
+    def __init__(self, config):
+        """
+        Attach the config to the instance.
+
+        :param config: The ledge configuration.
+        """
+        self.config = config
+        self.logger = structlog.getLogger().new(supervisor_pid=os.getpid())
+        self.workers = {}  # pid -> (index, process, start time)
+        self.stopping = False
+        self.socket = None
+
+    def listen(self):
+        """Bind the shared listening socket."""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("", self.config.port))  # nosec
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.set_inheritable(True)
+        # Workers accept in their reactors, which must never block.
+        self.socket.setblocking(False)
+
+    def spawn(self, index):
+        """
+        Start a worker process.
+
+        :param int index: The worker's index.
+        """
+        fd = self.socket.fileno()
+        process = subprocess.Popen(  # pylint: disable=consider-using-with # nosec
+            [sys.executable, "-m", "ledge"],
+            env=worker_env(self.config, index, fd),
+            pass_fds=(fd,),
+        )
+        self.workers[process.pid] = (index, process, time.monotonic())
+        self.logger.msg(f"Started worker {index}.", worker_pid=process.pid)
+
+    def forward_signal(self, signum, frame):  # pylint: disable=unused-argument
+        """Forward a signal to every worker, stopping on SIGINT/SIGTERM."""
+        if signum in (signal.SIGINT, signal.SIGTERM):
+            self.stopping = True
+        for _, process, _ in self.workers.values():
+            process.send_signal(signum)
+
+    def run(self):
+        """
+        Start the workers and supervise them until they've all stopped.
+
+        :rtype: int
+        :returns: The exit status for the supervisor.
+        """
+        self.listen()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, self.forward_signal)
+        for index in range(self.config.workers):
+            self.spawn(index)
+        while self.workers:
+            pid, status = os.wait()
+            if pid not in self.workers:
+                continue
+            index, _, started = self.workers.pop(pid)
+            self.logger.msg(
+                f"Worker {index} exited with status {_exit_code(status)}.",
+                worker_pid=pid,
+            )
+            if self.stopping:
+                continue
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+                # A worker started now wouldn't be sent a signal caught asleep
+                if self.stopping:
+                    continue
+            self.spawn(index)
+        self.socket.close()
+        return 0
@@ -1,8 +1,14 @@
 """Handlers provided by ledge."""
 
-# flake8: noqa
+from .._lazy_imports import lazy_getattr
 
-from .demo_handler import DemoHandler
-from .echo_handler import EchoHandler
-from .threaded_blocking_handler import ThreadedBlockingHandler
-from .unthreaded_blocking_handler import UnThreadedBlockingHandler
+_ATTRIBUTES = {
+    "DemoHandler": ".demo_handler",
+    "EchoHandler": ".echo_handler",
+    "ThreadedBlockingHandler": ".threaded_blocking_handler",
+    "UnThreadedBlockingHandler": ".unthreaded_blocking_handler",
+}
+
+__all__ = list(_ATTRIBUTES)
+
+__getattr__ = lazy_getattr(__name__, _ATTRIBUTES)
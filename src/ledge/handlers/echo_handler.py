@@ -7,6 +7,7 @@ This moudle contains the handler itself and its associated subconfig.
 import environ
 
 from ledge import HandlerImplementation
+from ledge.helpers import content_to_text
 
 # pylint: disable=unused-argument,no-self-use
 
@@ -38,15 +39,17 @@ class EchoHandler(HandlerImplementation):
         if content is None:
             request.logger.msg("Request had no content.")
             return
+        max_chars = self.config.echo_handler.max_chars
         try:
-            request_content = content.decode("utf-8")
-            if (
-                len(request_content) > self.config.echo_handler.max_chars
-                and self.config.echo_handler.max_chars > 0
-            ):
+            # A character is at most 4 bytes, so there's no need to decode
+            # (and copy) more than enough of the content to fill the limit
+            request_content = content_to_text(
+                content, max_bytes=4 * (max_chars + 1) if max_chars > 0 else None
+            )
+            if len(request_content) > max_chars > 0:
                 request.logger.msg(
                     f"Truncated request content: "
-                    f"{request_content[0:self.config.echo_handler.max_chars]} "
+                    f"{request_content[0:max_chars]} "
                     f"[TRUNCATED]"
                 )
             else:
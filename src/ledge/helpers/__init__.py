@@ -5,29 +5,137 @@ These functions are meant to be used in plugin implementations
 to facilitate common workflows.
 """
 
+import codecs
 import json
+from functools import partial
+
+from ledge import _json
+from ledge._context import get_context
+from ledge._lazy_imports import lazy_getattr
+from ledge._lazy_json import LazyJSON
+
+
+def as_buffer(content):
+    """
+    Return request content as an object supporting the buffer protocol.
+
+    Useful for passing content to functions which accept bytes-like objects
+    (eg: `hmac.update`) without copying it.
+
+    :param content: The request content, bytes, a memoryview or a
+        :class:`ledge.Body`.
+    :rtype: Union[bytes, memoryview]
+    """
+    return getattr(content, "view", content)
+
+
+def content_to_text(content, encoding="utf-8", max_bytes=None):
+    """
+    Decode request content into a str, straight from its buffer.
+
+    :param content: The request content, bytes, a memoryview or a
+        :class:`ledge.Body`.
+    :param str encoding: The encoding to use to decode the request content.
+    :param int max_bytes: If provided, only decode (up to) this many bytes
+        from the start of the content. A character the limit splits is
+        left out.
+    :rtype: str
+    """
+    buffer = as_buffer(content)
+    if max_bytes is None:
+        return str(buffer, encoding)
+    view = memoryview(buffer)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    return decoder.decode(view[:max_bytes], final=max_bytes >= view.nbytes)
+
+
+def _loads(content, encoding):
+    """Parse the content, returning it alongside the parsed value."""
+    return content, _json.loads(as_buffer(content), encoding)
 
 
 def content_to_json(
-    content, json_loads_args=None, json_loads_kwargs=None, encoding="utf-8"
+    content,
+    json_loads_args=None,
+    json_loads_kwargs=None,
+    encoding="utf-8",
+    request=None,
 ):
     """
     Convert request content into JSON.
 
-    :param bytes content: The request content
+    Unless extra arguments for `json.loads` are provided the content is
+    parsed by the configured JSON backend (see LEDGE_JSON_BACKEND), directly
+    from bytes.
+
+    If the request is provided (and no extra arguments for `json.loads` are)
+    the content is only parsed once per request, no matter how many plugins
+    call this function. In that case the returned object is shared between
+    all of them and must not be mutated.
+
+    :param content: The request content, bytes, a memoryview or a
+        :class:`ledge.Body`.
     :param tuple json_loads_args: Arguments to pass through to the call
         to json.loads.
     :param dict json_loads_kwargs: Keyword argumetns to pass through to
         the call to json.loads.
     :param str encoding: The encoding to use to decode the request content.
+    :param twisted.web.http.Request request: The request the content belongs to.
     :rtype: dict
     :returns: The JSON content of the request.
     """
+    context = get_context(request)
+    if context is not None and not (json_loads_args or json_loads_kwargs):
+        parsed_content, parsed = context.memoize(
+            ("content_to_json", id(content), encoding), _loads, content, encoding
+        )
+        if parsed_content is content:
+            return parsed
+    if not (json_loads_args or json_loads_kwargs):
+        return _json.loads(as_buffer(content), encoding)
     if json_loads_args is None:
         json_loads_args = ()
     if json_loads_kwargs is None:
         json_loads_kwargs = {}
-    return json.loads(content.decode(encoding), *json_loads_args, **json_loads_kwargs)
+    return json.loads(
+        content_to_text(content, encoding), *json_loads_args, **json_loads_kwargs
+    )
+
+
+def _lazy(content, encoding, request):
+    """Wrap the content, returning it alongside its lazy view."""
+    load = partial(content_to_json, content, encoding=encoding, request=request)
+    return content, LazyJSON(content, encoding, load=load)
+
+
+def lazy_json(content, encoding="utf-8", request=None):
+    """
+    Return a lazy view of JSON request content, for cheap `handles` checks.
+
+    The view's `get` method returns the value at a dotted path (eg:
+    `lazy_json(content).get("event.channel")`), scanning the content only
+    as far as that value and parsing nothing else. So requests can be
+    rejected on a field or two without parsing all of their (possibly
+    large) content. The view's `load` method parses the whole document, as
+    :func:`content_to_json` would.
+
+    If the request is provided the view is shared by every plugin which
+    asks for one, so fields found by one plugin aren't searched for again.
+
+    :param bytes content: The request content.
+    :param str encoding: The encoding to use to decode the request content.
+    :param twisted.web.http.Request request: The request the content belongs to.
+    :rtype: ledge._lazy_json.LazyJSON
+    """
+    context = get_context(request)
+    if context is None:
+        return _lazy(content, encoding, request)[1]
+    view_content, view = context.memoize(
+        ("lazy_json", id(content), encoding), _lazy, content, encoding, request
+    )
+    if view_content is content:
+        return view
+    return _lazy(content, encoding, request)[1]
 
 
 def json_response(  # pylint: disable=too-many-arguments
@@ -41,6 +149,9 @@ def json_response(  # pylint: disable=too-many-arguments
     """
     Reply to the given request with a JSON object.
 
+    Unless extra arguments for `json.dumps` are provided the object is
+    serialized by the configured JSON backend.
+
     :param twisted.web.http.Request request: The request to respond to.
     :param dict dictionary: A JSON serializable dictionary to use as the response.
     :param tuple json_dumps_args: Arguments to pass through to the call
@@ -50,13 +161,12 @@ def json_response(  # pylint: disable=too-many-arguments
     :param str encoding: The encoding to use to encode the JSON obj to bytes.
     :param bool finish: If true, finish the request after writing the JSON.
     """
-    if json_dumps_args is None:
-        json_dumps_args = ()
-    if json_dumps_kwargs is None:
-        json_dumps_kwargs = {}
-    data = json.dumps(dictionary, *json_dumps_args, **json_dumps_kwargs).encode(
-        encoding
-    )
+    if not (json_dumps_args or json_dumps_kwargs):
+        data = _json.dumps(dictionary, encoding)
+    else:
+        data = json.dumps(
+            dictionary, *(json_dumps_args or ()), **(json_dumps_kwargs or {})
+        ).encode(encoding)
     request.write(data)
     if finish:
         request.finish()
@@ -77,10 +187,19 @@ def text_response(request, text, encoding="utf-8", finish=True):
         request.finish()
 
 
+def _decode_headers(request, encoding):
+    """Decode all of the request headers."""
+    raw_headers = request.getAllHeaders()
+    return {k.decode(encoding): raw_headers[k].decode(encoding) for k in raw_headers}
+
+
 def get_headers(request, encoding="utf-8"):
     """
     Wrap `twisted.web.http.Request.getAllHeaders` so it returns strs.
 
+    The headers are only decoded once per request, subsequent calls return
+    a copy of the already decoded headers.
+
     :param twisted.web.http.Request request: The request to get the headers from.
     :param str encoding: The encoding to use to decode the header bytes to text.
 
@@ -88,5 +207,13 @@ def get_headers(request, encoding="utf-8"):
     :return: A dictionary, whose keys and values are strs, representing the
         request headers.
     """
-    raw_headers = request.getAllHeaders()
-    return {k.decode(encoding): raw_headers[k].decode(encoding) for k in raw_headers}
+    context = get_context(request)
+    if context is None:
+        return _decode_headers(request, encoding)
+    return dict(
+        context.memoize(("get_headers", encoding), _decode_headers, request, encoding)
+    )
+
+
+# Submodules (eg: ledge.helpers.slack) are imported when they're first used
+__getattr__ = lazy_getattr(__name__, {})
@@ -0,0 +1,330 @@
+"""
+Helpers for making outbound HTTP requests (eg: to webhook APIs).
+
+Connections are pooled per host and kept alive between requests, so
+calling the same API for every event doesn't set up a new TCP (and TLS)
+connection every time. There are two flavors of client:
+
+- :class:`BlockingClient`, for handlers which run in a thread.
+- :class:`Client`, whose requests return deferreds, for handlers (and
+  responders) which run in the reactor thread.
+
+Plugins should usually use the shared instances returned by
+:func:`blocking_client` and :func:`client`, which are configured via the
+LEDGE_HTTP_POOL_SIZE and LEDGE_HTTP_TIMEOUT environmental variables.
+"""
+
+import http.client
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from ledge import _json
+
+#: Methods which are safe to retry, as repeating them has no further effect.
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+_settings = {"pool_size": 10, "timeout": 10.0}
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+class HTTPError(Exception):
+    """Raised by :meth:`Response.raise_for_status` for error responses."""
+
+
+class Response:  # pylint: disable=too-few-public-methods
+    """A response to an outbound request, with its body read in full."""
+
+    def __init__(self, code, headers, body):
+        """
+        Attach the response's parts.
+
+        :param int code: The HTTP status code.
+        :param dict headers: The headers, with lower cased str names and str
+            values. Repeated headers are joined with commas.
+        :param bytes body: The body.
+        """
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        """Parse the body as JSON, with the configured JSON backend."""
+        return _json.loads(self.body)
+
+    def raise_for_status(self):
+        """
+        Raise if the response has an error status code.
+
+        :raises HTTPError: If the status code is 400 or over.
+        """
+        if self.code >= 400:
+            raise HTTPError(f"HTTP {self.code}")
+
+
+def _encode_body(body, json, headers):
+    """Return the body to send, serializing `json` if it's provided."""
+    headers = dict(headers or {})
+    if json is not None:
+        body = _json.dumps(json)
+        if not any(name.lower() == "content-type" for name in headers):
+            headers["Content-Type"] = "application/json"
+    return body, headers
+
+
+class BlockingClient:
+    """
+    An HTTP/1.1 client with a pool of keep-alive connections per host.
+
+    Requests block the calling thread, so this must not be used in the
+    reactor thread. It's safe to share between threads.
+    """
+
+    def __init__(self, pool_size=10, timeout=10.0):
+        """
+        Configure the client, without connecting to anything.
+
+        :param int pool_size: The maximum number of idle connections kept
+            open to each host. Busier hosts get extra connections, which are
+            closed once used.
+        :param float timeout: The timeout, in seconds, for connecting and
+            for each read of the response.
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # (scheme, host, port) -> idle connections
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, key):
+        """Take an idle connection to the host, or make a new one."""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        """Return a connection to the pool, if there's room for it."""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def request(  # pylint: disable=too-many-arguments
+        self, method, url, body=None, headers=None, json=None
+    ):
+        """
+        Make a request, and read its response.
+
+        If a pooled connection turns out to have been closed by the server
+        the request is retried on another, or a new, connection. Unless it
+        may have reached the server, in which case only requests with
+        idempotent methods (see `IDEMPOTENT_METHODS`) are retried, so eg: a
+        POST is never sent twice.
+
+        :param str method: The HTTP method, eg: "POST".
+        :param str url: The URL, with an http or https scheme.
+        :param bytes body: The request body.
+        :param dict headers: Header names mapped to their (str) values.
+        :param json: An object to send as the JSON body, instead of `body`.
+
+        :rtype: Response
+        :raises OSError: If the connection fails or times out.
+        """
+        body, headers = _encode_body(body, json, headers)
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+        while True:
+            connection, reused = self._connection(key)
+            try:
+                try:
+                    connection.request(method, target, body=body, headers=headers)
+                except ConnectionError:
+                    # Not fully sent, so the server can't have acted on it
+                    connection.close()
+                    if reused:
+                        continue
+                    raise
+                try:
+                    response = connection.getresponse()
+                    data = response.read()
+                except ConnectionError:
+                    # The server may have acted on the request before closing
+                    connection.close()
+                    if reused and method.upper() in IDEMPOTENT_METHODS:
+                        continue
+                    raise
+            except Exception:
+                connection.close()
+                raise
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        response_headers = {}
+        for name, value in response.getheaders():
+            name = name.lower()
+            if name in response_headers:
+                value = f"{response_headers[name]}, {value}"
+            response_headers[name] = value
+        return Response(response.status, response_headers, data)
+
+    def get(self, url, headers=None):
+        """Make a GET request, see :meth:`request`."""
+        return self.request("GET", url, headers=headers)
+
+    def post(self, url, body=None, headers=None, json=None):
+        """Make a POST request, see :meth:`request`."""
+        return self.request("POST", url, body=body, headers=headers, json=json)
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class Client:
+    """
+    An HTTP/1.1 client with a pool of keep-alive connections per host.
+
+    Built on Twisted's `Agent`, requests return deferreds and must be made
+    from the reactor thread.
+    """
+
+    def __init__(self, pool_size=10, timeout=10.0, reactor=None):
+        """
+        Configure the client, without connecting to anything.
+
+        :param int pool_size: The maximum number of idle connections kept
+            open to each host.
+        :param float timeout: The timeout, in seconds, for connecting and
+            for the whole of each request.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        """
+        # pylint: disable=import-outside-toplevel
+        from twisted.web.client import Agent, HTTPConnectionPool
+
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.timeout = timeout
+        self._reactor = reactor
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = pool_size
+        self._agent = Agent(reactor, connectTimeout=timeout, pool=self._pool)
+
+    def request(  # pylint: disable=too-many-arguments
+        self, method, url, body=None, headers=None, json=None
+    ):
+        """
+        Make a request, and read its response.
+
+        :param str method: The HTTP method, eg: "POST".
+        :param str url: The URL, with an http or https scheme.
+        :param bytes body: The request body.
+        :param dict headers: Header names mapped to their (str) values.
+        :param json: An object to send as the JSON body, instead of `body`.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires with a :class:`Response`, or fails
+            if the request does (eg: with `defer.TimeoutError`).
+        """
+        # pylint: disable=import-outside-toplevel
+        from twisted.web.client import FileBodyProducer, readBody
+        from twisted.web.http_headers import Headers
+
+        body, headers = _encode_body(body, json, headers)
+        producer = None if body is None else FileBodyProducer(BytesIO(body))
+        request_headers = Headers()
+        for name, value in headers.items():
+            request_headers.addRawHeader(name, value)
+        result = self._agent.request(
+            method.encode("ascii"), url.encode("ascii"), request_headers, producer
+        )
+
+        def _read(response):
+            response_headers = {
+                name.decode("latin-1").lower(): b", ".join(values).decode("latin-1")
+                for name, values in response.headers.getAllRawHeaders()
+            }
+            return readBody(response).addCallback(
+                lambda data: Response(response.code, response_headers, data)
+            )
+
+        return result.addCallback(_read).addTimeout(self.timeout, self._reactor)
+
+    def get(self, url, headers=None):
+        """Make a GET request, see :meth:`request`."""
+        return self.request("GET", url, headers=headers)
+
+    def post(self, url, body=None, headers=None, json=None):
+        """Make a POST request, see :meth:`request`."""
+        return self.request("POST", url, body=body, headers=headers, json=json)
+
+    def close(self):
+        """
+        Close the idle connections.
+
+        :rtype: `twisted.internet.defer.Deferred`
+        :returns: A deferred which fires once they're closed.
+        """
+        return self._pool.closeCachedConnections()
+
+
+def configure(pool_size=10, timeout=10.0):
+    """
+    Configure the shared clients, before they're first used.
+
+    Called by ledge at startup, see LEDGE_HTTP_POOL_SIZE and
+    LEDGE_HTTP_TIMEOUT.
+
+    :param int pool_size: See :class:`BlockingClient`.
+    :param float timeout: See :class:`BlockingClient`.
+    """
+    _settings.update(pool_size=pool_size, timeout=timeout)
+
+
+def blocking_client():
+    """
+    Return the shared :class:`BlockingClient`, for use in threads.
+
+    :rtype: BlockingClient
+    """
+    with _shared_lock:
+        if "blocking" not in _shared:
+            _shared["blocking"] = BlockingClient(**_settings)
+        return _shared["blocking"]
+
+
+def client():
+    """
+    Return the shared :class:`Client`, for use in the reactor thread.
+
+    Its idle connections are closed when the reactor shuts down.
+
+    :rtype: Client
+    """
+    with _shared_lock:
+        if "deferred" not in _shared:
+            # pylint: disable=import-outside-toplevel
+            from twisted.internet import reactor
+
+            _shared["deferred"] = Client(**_settings)
+            reactor.addSystemEventTrigger(
+                "before", "shutdown", _shared["deferred"].close
+            )
+        return _shared["deferred"]
@@ -3,7 +3,7 @@
 import hashlib
 import hmac
 
-from ledge.helpers import get_headers
+from ledge.helpers import as_buffer, get_headers
 
 
 def verify_slack_request(request, content, secret):
@@ -11,7 +11,8 @@ def verify_slack_request(request, content, secret):
     Use Slacks hmac impl. to verify a request.
 
     :param twisted.web.http.Request request: The request
-    :param bytes content: The request content
+    :param content: The request content, bytes, a memoryview or a
+        :class:`ledge.Body`.
     :param str secret: Slack signing secret
 
     :rtype: bool
@@ -23,8 +24,11 @@ def verify_slack_request(request, content, secret):
     if timestamp is None or sig is None:
         return False
     # From the slack python sdk, slight alterations
-    req = str.encode("v0:" + str(timestamp) + ":") + content
-    request_hash = "v0=" + hmac.new(str.encode(secret), req, hashlib.sha256).hexdigest()
+    req_hash = hmac.new(
+        str.encode(secret), str.encode("v0:" + str(timestamp) + ":"), hashlib.sha256
+    )
+    req_hash.update(as_buffer(content))
+    request_hash = "v0=" + req_hash.hexdigest()
     if hmac.compare_digest(request_hash, sig):
         request.logger.msg("Received request with correct slack signature")
         return True
@@ -1,6 +1,12 @@
 """Responders provided by ledge."""
 
-# flake8: noqa
+from .._lazy_imports import lazy_getattr
 
-from .demo_responder import DemoResponder
-from .slack_url_verification_responder import SlackURLVerificationResponder
+_ATTRIBUTES = {
+    "DemoResponder": ".demo_responder",
+    "SlackURLVerificationResponder": ".slack_url_verification_responder",
+}
+
+__all__ = list(_ATTRIBUTES)
+
+__getattr__ = lazy_getattr(__name__, _ATTRIBUTES)
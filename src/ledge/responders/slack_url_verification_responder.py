@@ -8,7 +8,7 @@ import json
 import environ
 
 from ledge import ResponderImplementation
-from ledge.helpers import content_to_json, text_response
+from ledge.helpers import lazy_json, text_response
 from ledge.helpers.slack import verify_slack_request
 
 
@@ -26,33 +26,28 @@ class SlackURLVerificationResponder(ResponderImplementation):
 
     def handles(self, request, content):
         """Handle slack url verificatio requests."""
-        # Request is verified
-        if not verify_slack_request(
-            request,
-            content,
-            self.config.slack_url_verification_responder.signing_secret,
-        ):
-            return False
-
-        # Request is JSON
+        # Request is proper type, checked first as it's cheap
+        request_json = lazy_json(content, request=request)
         try:
-            request_json = content_to_json(content)
-        except json.JSONDecodeError:
-            return False
-
-        # Request has proper keys
-        for key in ["token", "challenge", "type"]:
-            if key not in request_json:
+            if request_json.get("type") != "url_verification":
                 return False
 
-        # Request is proper type
-        if request_json["type"] != "url_verification":
+            # Request has proper keys
+            for key in ["token", "challenge"]:
+                if key not in request_json:
+                    return False
+        except json.JSONDecodeError:
             return False
 
-        return True
+        # Request is verified
+        return verify_slack_request(
+            request,
+            content,
+            self.config.slack_url_verification_responder.signing_secret,
+        )
 
     def respond(self, request, content):
         """Return the url verification response."""
-        rjson = content_to_json(content)
-        text_response(request, rjson["challenge"])
+        challenge = lazy_json(content, request=request).get("challenge")
+        text_response(request, challenge)
         request.logger.msg("Slack url verification response sent!")
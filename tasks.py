@@ -2,6 +2,9 @@
 Development tasks for ledge
 """
 import os
+import statistics
+import sys
+import time
 from pathlib import Path
 from shutil import rmtree
 
@@ -92,6 +95,33 @@ def run_tests(c, autoformat=True, tox_args=None):
     echo("Testing complete")
 
 
+# What's timed by the startup benchmark, from a fresh interpreter each time.
+STARTUP_BENCHMARKS = {
+    "interpreter": "pass",
+    "import ledge": "import ledge",
+    "import a plugin": "from ledge.handlers import EchoHandler",
+    "load the config": "from ledge._config import get_config; get_config()",
+}
+
+
+@task(name="bench-startup")
+def bench_startup(c, runs=10):
+    """
+    Benchmark ledge's startup (cold import and configuration) time.
+    """
+    env = {
+        "LEDGE_HANDLERS": "ledge.handlers.EchoHandler,ledge.handlers.DemoHandler",
+        "LEDGE_RESPONDERS": "ledge.responders.DemoResponder",
+    }
+    for name, code in STARTUP_BENCHMARKS.items():
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            c.run(f'{sys.executable} -c "{code}"', env=env, hide=True)
+            timings.append(time.perf_counter() - start)
+        echo(f"{name}: {statistics.median(timings) * 1000:.0f}ms (median of {runs})")
+
+
 @task(name="docs")
 def build_docs(c, clean=True, buildername="html"):
     """
@@ -350,6 +380,7 @@ run_ns.add_task(run_black)
 run_ns.add_task(run_isort)
 run_ns.add_task(run_tests)
 run_ns.add_task(run_autoformatters)
+run_ns.add_task(bench_startup)
 
 
 # Define the "build" subcommand
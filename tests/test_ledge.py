@@ -1,15 +1,66 @@
 """Unit tests for ledge."""
+
+import gzip
 import hmac
+import http.client
+import http.server
 import json
 import os
+import signal
+import subprocess  # nosec
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
 from uuid import uuid4
 
 import pytest
 import pytest_twisted
+import structlog
+from twisted.internet import reactor, task
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.internet.error import ReactorAlreadyInstalledError
+from twisted.internet.testing import StringTransport
+from twisted.logger import Logger
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 
 import ledge
 
 
+class ProcessHandler(ledge.HandlerImplementation):
+    """A handler run in the process pool."""
+
+    name = "process_handler"
+    EXECUTION_MODE = ledge.HandlerImplementation.EXECUTION_PROCESS
+
+    def handles(self, request, content):
+        """Handle every request."""
+        return True
+
+    def handle(self, request, content):
+        """Return where (and with what) the handler ran."""
+        if content == b"raise":
+            raise ValueError("Raised in a worker process")
+        return (
+            os.getpid(),
+            request.getHeader("X-Foo"),
+            request.request_id,
+            content,
+            self.config.process_pool_max_tasks,
+        )
+
+
+def _log_in_worker():
+    """Log from a process pool worker."""
+    structlog.getLogger().msg("Logged in a worker.")
+    return os.getpid()
+
+
 @pytest.fixture
 def mock_config():
     """Mock minimally viable config object fixture."""
@@ -19,21 +70,67 @@ def mock_config():
 
         handlers = []
         responders = []
+        max_content_length = 50000
+        body_mode = "bytes"
+        body_spool_threshold = 100000
+        reject_unmatched = False
+        decode_content = False
+        max_compression_ratio = 100.0
+        max_queued_handler_jobs = None
+        max_inflight_bytes = None
+        shed_latency_target = None
+        shed_interval = 0.1
+        shed_status_code = 503
+        retry_after = 5
+        wal_dir = None
+        metrics_path = "/metrics"
+        metrics_port = None
+        idempotency_key = None
+        dedup_ttl = 3600.0
+        dedup_max_entries = 100000
+        dedup_snapshot = None
+        reload_env_file = None
+        wal_segment_size = 64 * 1024 * 1024
+        workers = 1
+        listen_fd = None
+        process_pool_size = None
+        process_pool_max_tasks = None
+        port = 8080
 
     return MockConfig
 
 
+@pytest.fixture
+def json_backend():
+    """Restore the default JSON backend after a test selects another."""
+    yield ledge._json
+    ledge._json.use_backend("stdlib")
+
+
 def test_version_available():
     """Test the module has a version dunder."""
     assert hasattr(ledge, "__version__") and isinstance(ledge.__version__, str)
 
 
-def test_start(mocker):
+def test_lazy_imports():
+    """Test importing ledge, or a plugin, neither imports nor installs the reactor."""
+    code = (
+        "import sys, ledge; from ledge.handlers import EchoHandler; "
+        "assert ledge.Match and 'twisted.internet.reactor' not in sys.modules"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)  # nosec
+
+
+def test_start(mocker, json_backend):  # pylint: disable=unused-argument
     """Confirm the start command runs the reactor."""
     mock_reactor = mocker.MagicMock()
-    mocker.patch("ledge._cmds.reactor", mock_reactor)
+    # Import the server first, so only start() itself sees the mock reactor
+    assert ledge._app and ledge._web
+    mocker.patch("twisted.internet.reactor", mock_reactor)
+    mock_signal = mocker.patch("signal.signal")
     ledge._cmds.start()
     mock_reactor.run.assert_called_once()
+    assert mock_signal.call_args[0][0] == signal.SIGHUP
 
 
 @pytest_twisted.inlineCallbacks
@@ -41,7 +138,6 @@ def test_simple(mocker, mock_config):
     """
     Test requests finish with no handlers or responders specified.
     """
-    mock_config = mocker.MagicMock()
     mock_config.handlers = []
     mock_config.responders = []
     app = ledge._app.Ledge(mock_config)
@@ -86,14 +182,13 @@ def test_process_false(mocker):
 
 
 @pytest_twisted.inlineCallbacks
-def test_handler(mocker):
+def test_handler(mocker, mock_config):
     """
     Test handlers get the correct args.
     """
     mock_handler = mocker.MagicMock()
     mock_handler.name = "Mock Handler"
 
-    mock_config = mocker.MagicMock()
     mock_config.handlers = []
     mock_config.responders = []
 
@@ -114,7 +209,7 @@ def test_handler(mocker):
 
 
 @pytest_twisted.inlineCallbacks
-def test_responder(mocker):
+def test_responder(mocker, mock_config):
     """
     Test responders get the correct args.
     """
@@ -122,7 +217,6 @@ def test_responder(mocker):
     mock_responder.name = "Mock Responder"
     mock_responder.handles = mocker.MagicMock(return_value=True)
 
-    mock_config = mocker.MagicMock()
     mock_config.handlers = []
     mock_config.responders = []
 
@@ -136,6 +230,1345 @@ def test_responder(mocker):
     mock_responder.respond.assert_called_once_with(request, content)
 
 
+def test_dispatch_index(mocker):
+    """Test only plugins whose match spec may match are candidates."""
+    plugins = [mocker.MagicMock() for _ in range(4)]
+    plugins[0].match = ledge.Match(path="/a", method="post")
+    plugins[1].match = ledge.Match(path="/b")
+    plugins[2].match = ledge.Match(headers={"X-Kind": "thing"})
+    plugins[3].match = None  # Always a candidate
+    index = ledge._dispatch.DispatchIndex(plugins)
+
+    request = mocker.MagicMock()
+    request.method = b"POST"
+    request.path = b"/a"
+    request.getHeader = mocker.MagicMock(return_value=None)
+    assert index.candidates(request, b"") == [plugins[0], plugins[3]]
+
+    request.path = b"/b"
+    request.getHeader = mocker.MagicMock(return_value=b"thing")
+    assert index.candidates(request, b"") == plugins[1:]
+
+
+def test_match_json_fields(mocker):
+    """Test top level JSON key/values are matched."""
+    match = ledge.Match(json_fields={"type": "url_verification"})
+    request = mocker.MagicMock()
+    assert match.matches_details(request, b'{"type": "url_verification"}')
+    assert not match.matches_details(request, b'{"type": "event_callback"}')
+    assert not match.matches_details(request, b"not json")
+    assert not match.matches_details(request, b"[]")
+
+
+@pytest_twisted.inlineCallbacks
+def test_match_spec_handler(mocker, mock_config):
+    """Test handlers with a match spec only process matching requests."""
+
+    class MatchingHandler(ledge.HandlerImplementation):
+        """A handler relying on its match spec."""
+
+        name = "matching_handler"
+        match = ledge.Match(path="/hook")
+        THREAD_SAFE = False
+        handle = mocker.MagicMock()
+
+    mock_config.handlers = [MatchingHandler]
+    app = ledge._app.Ledge(mock_config)
+    for path in (b"/other", b"/hook"):
+        request = mocker.MagicMock()
+        request.path = path
+        response_d, handler_ds = app.handle_request(request, b"")
+        yield response_d
+        for handler_deferred in handler_ds:
+            yield handler_deferred
+    MatchingHandler.handle.assert_called_once_with(request, b"")
+
+
+def test_admission_limits():
+    """Test requests are rejected beyond the job and byte limits."""
+    controller = ledge._admission.AdmissionController(max_jobs=2, max_bytes=100)
+    assert controller.admit(100)
+    assert not controller.admit(101)
+    controller.request_started(60, 2)
+    assert not controller.admit(1)
+    controller.job_finished()
+    assert controller.admit(40)
+    assert not controller.admit(41)
+    controller.job_finished()
+    controller.request_finished(60)
+    assert controller.admit(100)
+
+
+def test_admission_sheds_on_latency():
+    """Test load is shed once queueing delay stays above target."""
+    now = [0.0]
+    controller = ledge._admission.AdmissionController(
+        target=0.005, interval=0.1, clock=lambda: now[0]
+    )
+    controller.request_started(0, 3)
+    controller.record_sojourn(0.01)
+    assert controller.admit(0)
+    now[0] = 0.2
+    controller.record_sojourn(0.01)
+    assert not controller.admit(0)
+    # A job starting within target ends the dropping state
+    controller.record_sojourn(0.001)
+    assert controller.admit(0)
+    # As does the queue draining
+    controller.record_sojourn(0.01)
+    now[0] = 0.4
+    controller.record_sojourn(0.01)
+    assert not controller.admit(0)
+    for _ in range(3):
+        controller.job_finished()
+    assert controller.admit(0)
+
+
+@pytest_twisted.inlineCallbacks
+def test_admission_tracks_handlers(mocker, mock_config):
+    """Test outstanding handler jobs and bytes are accounted for."""
+
+    class Handler(ledge.HandlerImplementation):
+        """A handler which handles everything."""
+
+        name = "handler"
+        match = ledge.Match()
+        handle = mocker.MagicMock()
+
+    mock_config.handlers = [Handler]
+    app = ledge._app.Ledge(mock_config)
+    request = mocker.MagicMock()
+    request.ledge_context = ledge._context.RequestContext()
+    response_d, handler_ds = app.handle_request(request, b"123")
+    assert app.admission.queued_jobs == 1
+    assert app.admission.inflight_bytes == 3
+    yield response_d
+    for handler_deferred in handler_ds:
+        yield handler_deferred
+    assert app.admission.queued_jobs == 0
+    assert app.admission.inflight_bytes == 0
+    assert ("handler_started", "handler") in request.ledge_context.timings
+
+
+def test_render_post_sheds_load(mocker, mock_config):
+    """Test requests are rejected with a Retry-After when over capacity."""
+    mock_config.max_queued_handler_jobs = 0
+    app = ledge._app.Ledge(mock_config)
+    root = ledge._web.WebRoot(app)
+    request = mocker.MagicMock()
+    request.content.read = mocker.MagicMock(side_effect=[b"123", b""])
+    assert root.render_POST(request) == b""
+    request.setResponseCode.assert_called_once_with(503)
+    request.setHeader.assert_called_once_with("Retry-After", "5")
+
+
+def _wal_request(uri, headers):
+    """Build a request, as the write-ahead log sees it."""
+    return ledge._wal.ReplayedRequest(b"POST", uri, Headers(dict(headers)))
+
+
+@pytest_twisted.inlineCallbacks
+def test_wal_recovers_incomplete_entries(tmp_path):
+    """Test entries which were never marked done are recovered on reopening."""
+    wal = ledge._wal.WriteAheadLog(str(tmp_path))
+    first = yield wal.append(_wal_request(b"/a", {b"x-foo": [b"bar"]}), b"first")
+    second = yield wal.append(_wal_request(b"/b?c=d", {}), b"second")
+    wal.mark_done(first)
+    wal.close()
+
+    wal = ledge._wal.WriteAheadLog(str(tmp_path))
+    assert len(wal.recovered) == 1
+    entry_id, request, content = wal.recovered[0]
+    assert entry_id > second
+    assert content == b"second"
+    assert request.method == b"POST"
+    assert request.path == b"/b"
+    assert request.uri == b"/b?c=d"
+    wal.mark_done(entry_id)
+    wal.close()
+
+    wal = ledge._wal.WriteAheadLog(str(tmp_path))
+    assert wal.recovered == []
+    wal.close()
+
+
+@pytest_twisted.inlineCallbacks
+def test_wal_replay(mocker, mock_config, tmp_path):
+    """Test recovered requests are replayed to the handlers, and completed."""
+    wal = ledge._wal.WriteAheadLog(str(tmp_path))
+    yield wal.append(_wal_request(b"/", {b"x-foo": [b"bar"]}), b"123")
+    wal.close()
+
+    class Handler(ledge.HandlerImplementation):
+        """A handler which handles everything."""
+
+        name = "handler"
+        match = ledge.Match()
+        THREAD_SAFE = False
+        handle = mocker.MagicMock()
+
+    mock_config.handlers = [Handler]
+    mock_config.wal_dir = str(tmp_path)
+    app = ledge._app.Ledge(mock_config)
+    for handler_deferred in app.replay():
+        yield handler_deferred
+    request, content = Handler.handle.call_args[0]
+    assert content == b"123"
+    assert request.getHeader(b"x-foo") == b"bar"
+    app.wal.close()
+    wal = ledge._wal.WriteAheadLog(str(tmp_path))
+    assert wal.recovered == []
+    wal.close()
+
+
+@pytest_twisted.inlineCallbacks
+def test_wal_keeps_done_records_of_live_segments(tmp_path):
+    """Test a segment isn't deleted while an older one is still live."""
+    request = _wal_request(b"/", {})
+    record_size = len(
+        ledge._wal._frame(
+            ledge._wal._APPEND, 0, ledge._wal._encode_request(request, b"x")
+        )
+    )
+    # Two appends fill a segment, as do an append and a done record
+    wal = ledge._wal.WriteAheadLog(str(tmp_path), segment_size=record_size + 1)
+    first = yield wal.append(request, b"a")  # Segment 1
+    yield wal.append(request, b"c")  # Segment 1
+    second = yield wal.append(request, b"b")  # Segment 2
+    wal.mark_done(first)  # Segment 2
+    yield wal.append(request, b"d")  # Segment 3
+    wal.mark_done(second)
+    wal.close()
+
+    wal = ledge._wal.WriteAheadLog(str(tmp_path))
+    assert [content for _, _, content in wal.recovered] == [b"c", b"d"]
+    wal.close()
+
+
+@pytest_twisted.inlineCallbacks
+def test_wal_write_failure(mocker, mock_config, tmp_path):
+    """Test a failed write fails appends, and requests are rejected."""
+    mock_config.wal_dir = str(tmp_path)
+    app = ledge._app.Ledge(mock_config)
+    mocker.patch("ledge._wal.os.fsync", side_effect=OSError(28, "No space"))
+    with pytest.raises(OSError):
+        yield app.wal.append(_wal_request(b"/", {}), b"123")
+    assert isinstance(app.wal.error, OSError)
+    with pytest.raises(OSError):
+        yield app.wal.append(_wal_request(b"/", {}), b"123")
+
+    request = mocker.MagicMock()
+    app.handle_request(request, b"123")
+    request.setResponseCode.assert_called_once_with(503)
+    request.finish.assert_called_once()
+    app.wal.close()
+
+
+@pytest_twisted.inlineCallbacks
+def test_wal_append_failure_skips_handlers(mocker, mock_config, tmp_path):
+    """Test requests which couldn't be logged are rejected, and not handled."""
+
+    class Handler(ledge.HandlerImplementation):
+        """A handler which handles everything."""
+
+        name = "handler"
+        match = ledge.Match()
+        THREAD_SAFE = False
+        handle = mocker.MagicMock()
+
+    mock_config.handlers = [Handler]
+    mock_config.wal_dir = str(tmp_path)
+    app = ledge._app.Ledge(mock_config)
+    failed = Deferred()
+    mocker.patch.object(app.wal, "append", return_value=failed)
+    request = ledge._utils.inject_logger(mocker.MagicMock())
+    response_d, (handled_d,) = app.handle_request(request, b"payload")
+    failed.errback(OSError(28, "No space"))
+    yield response_d
+    with pytest.raises(OSError):
+        yield handled_d
+    request.setResponseCode.assert_called_once_with(503)
+    Handler.handle.assert_not_called()
+    app.wal.close()
+
+
+def test_worker_env(mock_config):
+    """Test workers inherit the socket, and get their own write-ahead log."""
+    mock_config.workers = 4
+    mock_config.wal_dir = "/var/lib/ledge"
+    env = ledge._workers.worker_env(mock_config, 2, 7, environ={"FOO": "bar"})
+    assert env == {
+        "FOO": "bar",
+        "LEDGE_WORKERS": "1",
+        "LEDGE_LISTEN_FD": "7",
+        "LEDGE_WAL_DIR": os.path.join("/var/lib/ledge", "worker-2"),
+    }
+
+
+def test_supervisor_restarts_workers(mocker, mock_config):
+    """Test exited workers are restarted, until the supervisor is stopping."""
+    mock_config.workers = 2
+    supervisor = ledge._workers.Supervisor(mock_config)
+    mocker.patch.object(supervisor, "listen")
+    supervisor.socket = mocker.MagicMock()
+    mocker.patch("ledge._workers.signal.signal")
+    mocker.patch("ledge._workers.time.sleep")
+    pids = iter(range(101, 110))
+    popen = mocker.patch(
+        "ledge._workers.subprocess.Popen",
+        side_effect=lambda *args, **kwargs: mocker.MagicMock(pid=next(pids)),
+    )
+
+    def _wait():
+        if popen.call_count == 2:
+            return (101, 256)  # Worker 0 crashes, and is restarted as 103
+        supervisor.stopping = True
+        return sorted(supervisor.workers)[0], 0
+
+    mocker.patch("ledge._workers.os.wait", side_effect=_wait)
+    assert supervisor.run() == 0
+    assert popen.call_count == 3
+    assert popen.call_args[1]["env"]["LEDGE_WORKERS"] == "1"
+
+
+def test_supervisor_stopped_during_backoff(mocker, mock_config):
+    """Test a worker crashing quickly isn't restarted if stopped meanwhile."""
+    mock_config.workers = 1
+    supervisor = ledge._workers.Supervisor(mock_config)
+    mocker.patch.object(supervisor, "listen")
+    supervisor.socket = mocker.MagicMock()
+    mocker.patch("ledge._workers.signal.signal")
+    # SIGTERM arrives while backing off, before the worker is restarted
+    mocker.patch(
+        "ledge._workers.time.sleep",
+        side_effect=lambda _: supervisor.forward_signal(signal.SIGTERM, None),
+    )
+    popen = mocker.patch(
+        "ledge._workers.subprocess.Popen", return_value=mocker.MagicMock(pid=101)
+    )
+    mocker.patch("ledge._workers.os.wait", return_value=(101, 256))
+    assert supervisor.run() == 0
+    assert popen.call_count == 1
+
+
+def test_configure_site_inherited_fd(mocker, mock_config):
+    """Test an inherited listening socket is adopted rather than a port bound."""
+    mock_reactor = mocker.patch("ledge._web.reactor")
+    mock_endpoints = mocker.patch("ledge._web.endpoints")
+    app = mocker.MagicMock()
+    app.config = mock_config
+    ledge._web.configure_site(app, listen_fd=5)
+    mock_reactor.adoptStreamPort.assert_called_once()
+    assert mock_reactor.adoptStreamPort.call_args[0][0] == 5
+    mock_endpoints.TCP4ServerEndpoint.assert_not_called()
+    mock_endpoints.serverFromString.assert_not_called()
+
+
+def test_configure_site_metrics_port(mocker, mock_config):
+    """Test metrics are served on their own port, if configured."""
+    mocker.patch("ledge._web.reactor")
+    mock_endpoints = mocker.patch("ledge._web.endpoints")
+    mock_config.metrics_port = 9100
+    app = mocker.MagicMock()
+    app.config = mock_config
+    ledge._web.configure_site(app, port=8080)
+    ports = [call[0][1] for call in mock_endpoints.TCP4ServerEndpoint.call_args_list]
+    assert ports == [9100]
+    assert mock_endpoints.serverFromString.call_args[0][1] == "tcp:8080"
+
+
+def test_configure_site_endpoints(mocker, mock_config, tmp_path):
+    """Test the site listens on each of the endpoint descriptions given."""
+    app = mocker.MagicMock()
+    app.config = mock_config
+    path = str(tmp_path / "ledge.sock")
+    root = ledge._web.configure_site(
+        app, listen=[f"unix:{path}", "tcp:0:interface=127.0.0.1"]
+    )
+    try:
+        unix_port, tcp_port = root.ports
+        assert unix_port.getHost().name.endswith(b"ledge.sock")
+        assert tcp_port.getHost().host == "127.0.0.1"
+        site = unix_port.factory
+        assert site.acceptableProtocols()[-1] == b"http/1.1"
+    finally:
+        for port in root.ports:
+            port.stopListening()
+
+
+@pytest_twisted.inlineCallbacks
+def test_process_pool_handler(mocker):
+    """Test process mode handlers run in a worker process, with a snapshot."""
+    mocker.patch.dict(
+        os.environ,
+        {"LEDGE_PROCESS_POOL_SIZE": "1", "LEDGE_PROCESS_POOL_MAX_TASKS": "2"},
+    )
+    handler = ProcessHandler(ledge._config.get_config())
+    request = ledge._wal.ReplayedRequest(b"POST", b"/", Headers({b"x-foo": [b"bar"]}))
+    request.logger = ledge._utils.structlog.getLogger()
+    request.ledge_context = ledge._context.RequestContext(request_id="abc")
+    try:
+        pid, *snapshot = yield handler.process(request, b"123")
+        assert pid != os.getpid()
+        # The handler's config is available in the worker process
+        assert snapshot == [b"bar", "abc", b"123", 2]
+        assert ("handler_started", "process_handler") in request.ledge_context.timings
+        with pytest.raises(ValueError):
+            yield handler.process(request, b"raise")
+        # The pool is recycled after process_pool_max_tasks
+        third_pid, *_ = yield handler.process(request, b"123")
+        assert third_pid != pid
+    finally:
+        ledge._process_pool.shutdown_shared_pool()
+
+
+@pytest_twisted.inlineCallbacks
+def test_process_pool_worker_logging(mocker, capfd):
+    """Test workers aren't forked, and log as configured."""
+    assert ledge._process_pool._START_METHOD != "fork"
+    # A fork server started by an earlier test has another test's stderr
+    mocker.patch("ledge._process_pool._START_METHOD", "spawn")
+    mocker.patch.dict(os.environ, {"LEDGE_LOG_FORMAT": "json"})
+    pool = ledge._process_pool.ProcessPool(
+        max_workers=1, config=ledge._config.get_config()
+    )
+    yield pool.submit(_log_in_worker)
+    pool.shutdown()
+    lines = [json.loads(line) for line in capfd.readouterr().err.splitlines()]
+    assert [line["event"] for line in lines] == ["Logged in a worker."]
+
+
+def test_dedup_cache(tmp_path):
+    """Test keys expire, are evicted in LRU order and survive snapshots."""
+    now = [0]
+    cache = ledge._dedup.DedupCache(10, 2, clock=lambda: now[0])
+    assert not cache.seen("a")
+    assert cache.seen("a")
+    assert not cache.seen("b")
+    assert cache.seen("a")
+    # b is now the least recently seen
+    assert not cache.seen("c")
+    assert not cache.seen("b")
+    now[0] = 5
+    assert cache.seen("b")
+    cache.forget("b")
+    assert not cache.seen("b")
+    cache.save(str(tmp_path / "keys"))
+    restored = ledge._dedup.DedupCache(10, 2, clock=lambda: now[0])
+    now[0] = 12
+    restored.load(str(tmp_path / "keys"))
+    assert len(restored) == 1
+    assert restored.seen("b")
+    restored.load(str(tmp_path / "missing"))
+
+
+def test_idempotency_key_extractor(mocker):
+    """Test keys are taken from the first source present."""
+    extract = ledge._dedup.key_extractor("header:X-GitHub-Delivery,json:event.id")
+    request = mocker.MagicMock()
+    request.getHeader.return_value = b"abc"
+    assert extract(request, b"") == "header:X-GitHub-Delivery=abc"
+    request.getHeader.return_value = None
+    assert extract(request, b'{"event": {"id": 1}}') == "json:event.id=1"
+    assert extract(request, b'{"event": "id"}') is None
+    assert extract(request, b"not json") is None
+    with pytest.raises(ValueError):
+        ledge._dedup.key_extractor("cookie:foo")
+
+
+def test_handle_request_deduplicates(mocker, mock_config):
+    """Test duplicates are responded to, without running the handlers."""
+    mock_config.idempotency_key = "json:event_id"
+    app = ledge._app.Ledge(mock_config)
+    handler = mocker.MagicMock()
+    app._handlers = [handler]
+    mocker.patch.object(app, "schedule_response")
+    failed = Deferred()
+    handler.process.return_value = failed
+    request = mocker.MagicMock()
+    content = b'{"event_id": "1"}'
+    assert len(app.handle_request(request, content)[1]) == 1
+    assert app.handle_request(request, content)[1] == []
+    assert app.schedule_response.call_count == 2
+    assert handler.process.call_count == 1
+    # Requests whose handlers fail are run again when redelivered
+    failed.errback(RuntimeError())
+    failed.addErrback(lambda _: None)
+    handler.process.return_value = None
+    assert len(app.handle_request(request, content)[1]) == 1
+    assert len(app.handle_request(request, b'{"event_id": "2"}')[1]) == 1
+
+
+def test_log_sampler():
+    """Test events are sampled and rate limited by their longest prefix."""
+    now = [0.0]
+    sampler = ledge._logging.Sampler(
+        sample_rates={"Handler": 0.0, "Handler important": 1.0},
+        rate_limits={"Content": 2},
+        clock=lambda: now[0],
+    )
+
+    def kept(event):
+        try:
+            sampler(None, "msg", {"event": event})
+        except structlog.DropEvent:
+            return False
+        return True
+
+    assert not kept("Handler foo handles this request.")
+    assert kept("Handler important handles this request.")
+    assert [kept("Content length: 1") for _ in range(3)] == [True, True, False]
+    now[0] = 1.0
+    assert kept("Content length: 1")
+    assert kept("Other")
+
+
+def test_batched_log_writer():
+    """Test JSON lines are written by the writer thread, and flushed on close."""
+    stream = BytesIO()
+    writer = ledge._logging.BatchedWriter(stream=stream, max_queued=10)
+    logger = ledge._logging.WriterLogger(writer)
+    for number in range(3):
+        logger.msg(ledge._logging.render_json(None, "msg", {"event": number}))
+    writer.close()
+    lines = stream.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == [{"event": n} for n in range(3)]
+
+
+def test_twisted_log_observer():
+    """Test Twisted's log events are written as JSON, with any traceback."""
+    stream = BytesIO()
+    writer = ledge._logging.BatchedWriter(stream=stream)
+    observer = ledge._logging.twisted_observer(writer)
+    log = Logger(namespace="test", observer=observer)
+    log.info("Site starting on {port}", port=8080)
+    try:
+        raise ValueError("Boom")
+    except ValueError:
+        log.failure("Unhandled error")
+    writer.close()
+    started, failed = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert started["event"] == "Site starting on 8080"
+    assert started["level"] == "info" and started["namespace"] == "test"
+    assert failed["level"] == "critical"
+    assert "ValueError: Boom" in failed["exception"]
+
+
+def test_batched_log_writer_drops_when_full():
+    """Test lines beyond the queue's bound are dropped, not blocked on."""
+    writer = ledge._logging.BatchedWriter(stream=BytesIO(), max_queued=1)
+    writer._queue.put(None)  # Stop the thread, leaving the queue full
+    writer._thread.join()
+    writer._queue.put(b"x\n")
+    writer.write(b"y\n")
+    assert writer.dropped == 1
+
+
+def test_monotonic_request_ids(mocker):
+    """Test monotonic request ids increase, and are used when selected."""
+    mocker.patch("ledge._utils._next_request_id")
+    ledge._utils.use_request_ids("monotonic")
+    first = ledge._utils.inject_logger(mocker.MagicMock()).ledge_context.request_id
+    second = ledge._utils.inject_logger(mocker.MagicMock()).ledge_context.request_id
+    assert first.rsplit("-", 1)[1] == "1"
+    assert second.rsplit("-", 1)[1] == "2"
+    with pytest.raises(ValueError):
+        ledge._utils.use_request_ids("sequential")
+
+
+def test_context_summary(mocker):
+    """Test the lifecycle summary separates queueing from running time."""
+    times = iter([10.0, 10.001, 10.003, 10.0105])
+    mocker.patch("ledge._context.time.monotonic", lambda: next(times))
+    context = ledge._context.RequestContext()
+    context.mark("received")
+    context.mark("handler_queued", "slow")
+    context.mark("handler_started", "slow")
+    context.mark("handler_finished", "slow")
+    summary = context.summary()
+    assert list(summary["timings_ms"]) == [
+        "received",
+        "handler_queued:slow",
+        "handler_started:slow",
+        "handler_finished:slow",
+    ]
+    assert summary["timings_ms"]["handler_finished:slow"] == 10.5
+    assert summary["handler_queued_ms"] == {"slow": 2.0}
+    assert summary["handler_running_ms"] == {"slow": 7.5}
+    assert ledge._context.RequestContext().summary() == {}
+
+
+def test_metrics_render():
+    """Test metrics are rendered in the Prometheus text format."""
+    metrics = ledge._metrics.Metrics(
+        thread_pool_stats=lambda: {"slow": {"queued": 2, "working": 1, "threads": 1}}
+    )
+    metrics.requests.inc(("200",))
+    metrics.requests.inc(("200",))
+    metrics.content_bytes.observe(150)
+    metrics.plugin_seconds.observe(0.003, ('say "hi"', "handle"))
+    lines = metrics.render().decode("utf-8").splitlines()
+    assert 'ledge_requests_total{code="200"} 2' in lines
+    assert 'ledge_request_content_bytes_bucket{le="100"} 0' in lines
+    assert 'ledge_request_content_bytes_bucket{le="1000"} 1' in lines
+    assert 'ledge_request_content_bytes_bucket{le="+Inf"} 1' in lines
+    assert "ledge_request_content_bytes_sum 150" in lines
+    assert (
+        'ledge_plugin_seconds_bucket{plugin="say \\"hi\\"",method="handle",'
+        'le="0.005"} 1'
+    ) in lines
+    assert 'ledge_thread_pool_queued{pool="slow"} 2' in lines
+    assert "# TYPE ledge_reactor_lag_seconds histogram" in lines
+
+
+def test_metrics_reactor_lag():
+    """Test the reactor's lag is measured."""
+    clock = task.Clock()
+    metrics = ledge._metrics.Metrics(clock=clock)
+    loop = metrics.monitor_reactor(interval=1)
+    clock.advance(1)
+    assert metrics.reactor_lag._values[()][0][0] == 1
+    assert metrics.last_beat is not None and metrics.beat_interval == 1
+    loop.stop()
+
+
+def test_watchdog_blame(mocker):
+    """Test a stack is blamed on the innermost plugin and request."""
+
+    class Responder(ledge.ResponderImplementation):
+        name = "stuck_responder"
+
+        def handles(self, request, content):
+            return ledge._watchdog.blame(sys._getframe())
+
+    request = ledge._utils.inject_logger(mocker.MagicMock())
+    responder = Responder(None)
+    assert responder.handles(request, b"") == (
+        "stuck_responder",
+        request.ledge_context.request_id,
+    )
+    assert ledge._watchdog.blame(None) == (None, None)
+
+
+def test_watchdog_reports_stalls(mocker):
+    """Test a stall is logged once, with the stack, and counted."""
+    metrics = ledge._metrics.Metrics(clock=task.Clock())
+    metrics.last_beat, metrics.beat_interval = 100.0, 0.5
+    now = [100.5]
+    watchdog = ledge._watchdog.Watchdog(metrics, 1.0, clock=lambda: now[0])
+    watchdog.reactor_thread_id = threading.get_ident()
+    logger = mocker.patch("structlog.getLogger").return_value
+    call_from_thread = mocker.patch.object(reactor, "callFromThread")
+    assert not watchdog.check()
+    now[0] = 102.0
+    assert watchdog.check()
+    assert not watchdog.check()
+    message, details = logger.msg.call_args[0][0], logger.msg.call_args[1]
+    assert message == "Reactor stalled for over 1.500s."
+    assert "test_watchdog_reports_stalls" in details["stack"]
+    call_from_thread.assert_called_once_with(metrics.reactor_stalls.inc)
+
+
+@pytest_twisted.inlineCallbacks
+def test_metrics_time_plugins(mocker, mock_config):
+    """Test plugin methods are timed, and served on the metrics path."""
+
+    class Handler(ledge.HandlerImplementation):
+        name = "timed_handler"
+        THREAD_SAFE = False
+
+        def handles(self, request, content):
+            return True
+
+        def handle(self, request, content):
+            return None
+
+    class Responder(ledge.ResponderImplementation):
+        name = "timed_responder"
+
+        def handles(self, request, content):
+            return True
+
+        def respond(self, request, content):
+            request.finish()
+
+    app = ledge._app.Ledge(mock_config)
+    app._handlers = [Handler(mock_config)]
+    app._responders = [Responder(mock_config)]
+    request = ledge._utils.inject_logger(mocker.MagicMock())
+    request.logger = mocker.MagicMock()
+    request.notifyFinish.return_value = Deferred()
+    response_d, handler_ds = app.handle_request(request, b"")
+    yield response_d
+    yield handler_ds[0]
+    # The summary is logged once the response is finished too
+    logged = [call[0] for call in request.logger.msg.call_args_list]
+    assert ("Request complete.",) not in logged
+    request.notifyFinish.return_value.callback(None)
+    summary = request.logger.msg.call_args[1]
+    assert request.logger.msg.call_args[0] == ("Request complete.",)
+    assert "respond_finished:timed_responder" in summary["timings_ms"]
+    assert "response_finished" in summary["timings_ms"]
+    assert list(summary["handler_running_ms"]) == ["timed_handler"]
+    seconds = app.metrics.plugin_seconds
+    for labels in (
+        ("timed_handler", "handles"),
+        ("timed_handler", "handle"),
+        ("timed_responder", "handles"),
+        ("timed_responder", "respond"),
+    ):
+        assert seconds.count(labels) == 1
+    root = ledge._web.WebRoot(app)
+    metrics_request = mocker.MagicMock()
+    metrics_request.path = b"/metrics"
+    assert b"ledge_plugin_seconds_count" in root.render_GET(metrics_request)
+    metrics_request.path = b"/"
+    assert b"listening" in root.render_GET(metrics_request)
+
+
+class BatchHandler(ledge.HandlerImplementation):
+    """A handler which handles requests in batches."""
+
+    name = "batch_handler"
+    BATCH_SIZE = 3
+    BATCH_INTERVAL = 5
+
+    def handles(self, request, content):
+        """Handle every request."""
+        return True
+
+    def handle_batch(self, events):
+        """Record the batch, failing requests whose content is 'fail'."""
+        self.batches = getattr(self, "batches", []) + [
+            [event.content for event in events]
+        ]
+        return [
+            ValueError(event.content) if event.content == b"fail" else event.content
+            for event in events
+        ]
+
+
+@pytest_twisted.inlineCallbacks
+def test_batching_handler_by_size(mocker):
+    """Test a batch is handled once it's full, with per-request results."""
+    handler = BatchHandler(None)
+    request = mocker.MagicMock()
+    first = handler.process(request, b"1")
+    failed = handler.process(request, b"fail")
+    assert not first.called
+    third = handler.process(request, b"3")
+    assert (yield first) == b"1"
+    assert (yield third) == b"3"
+    with pytest.raises(ValueError):
+        yield failed
+    assert handler.batches == [[b"1", b"fail", b"3"]]
+
+
+def test_batching_handler_by_interval(mocker):
+    """Test an incomplete batch is handled once its interval passes."""
+    clock = task.Clock()
+    handler = BatchHandler(None)
+    handler.THREAD_SAFE = False
+    handler.batcher._loop.clock = clock
+    mocker.patch("twisted.internet.reactor")
+    results = []
+    handler.process(mocker.MagicMock(), b"1").addCallback(results.append)
+    clock.advance(4)
+    assert results == []
+    clock.advance(1)
+    assert results == [b"1"]
+    assert not handler.batcher._loop.running
+
+
+def test_batching_handler_failure(mocker):
+    """Test every request in a batch fails if handle_batch raises."""
+    handler = BatchHandler(None)
+    handler.THREAD_SAFE = False
+    handler.handle_batch = mocker.MagicMock(side_effect=RuntimeError)
+    mocker.patch("twisted.internet.reactor")
+    failures = []
+    for content in (b"1", b"2"):
+        handler.process(mocker.MagicMock(), content).addErrback(failures.append)
+    assert failures == []
+    # Buffered requests are handled on shutdown
+    handler.batcher.shutdown()
+    assert [failure.type for failure in failures] == [RuntimeError, RuntimeError]
+
+
+def test_install_reactor_mismatch():
+    """Test asking for another reactor than the one installed is an error."""
+    # Any installed reactor will do for the default; the tests run on it
+    ledge._async.install_reactor("default")
+    with pytest.raises(ReactorAlreadyInstalledError, match="asyncio"):
+        ledge._async.install_reactor("asyncio")
+    with pytest.raises(ValueError):
+        ledge._async.install_reactor("nope")
+
+
+@pytest_twisted.inlineCallbacks
+def test_async_plugins(mocker, mock_config):
+    """Test coroutine handles/handle/respond methods are run and awaited."""
+    gate = Deferred()
+    calls = []
+
+    class AsyncHandler(ledge.HandlerImplementation):
+        """A handler implemented with coroutines."""
+
+        name = "async_handler"
+
+        async def handles(self, request, content):
+            """Handle every request."""
+            return True
+
+        async def handle(self, request, content):
+            """Wait on the gate."""
+            await gate
+            calls.append(content)
+            return content
+
+    class UninterestedResponder(ledge.ResponderImplementation):
+        """A responder which never handles requests."""
+
+        name = "uninterested_responder"
+
+        async def handles(self, request, content):
+            """Handle no requests."""
+            return False
+
+    class AsyncResponder(ledge.ResponderImplementation):
+        """A responder implemented with coroutines."""
+
+        name = "async_responder"
+
+        async def handles(self, request, content):
+            """Handle every request."""
+            return True
+
+        async def respond(self, request, content):
+            """Write the content back."""
+            request.write(content)
+            request.finish()
+
+    mock_config.handlers = [AsyncHandler]
+    mock_config.responders = [UninterestedResponder, AsyncResponder]
+    app = ledge._app.Ledge(mock_config)
+    request = mocker.MagicMock()
+    response_d, handler_ds = app.handle_request(request, b"123")
+    yield response_d
+    request.write.assert_called_once_with(b"123")
+    assert calls == []
+    gate.callback(None)
+    assert (yield handler_ds[0]) == b"123"
+    assert calls == [b"123"]
+
+
+@pytest_twisted.inlineCallbacks
+def test_async_handler_concurrency_limit(mocker):
+    """Test no more than MAX_CONCURRENCY coroutines run at once."""
+    gates = [Deferred() for _ in range(3)]
+    running = []
+
+    class LimitedHandler(ledge.HandlerImplementation):
+        """A handler which may only run one coroutine at a time."""
+
+        name = "limited_handler"
+        MAX_CONCURRENCY = 1
+
+        def handles(self, request, content):
+            """Handle every request."""
+            return True
+
+        async def handle(self, request, content):
+            """Wait on the gate for this request."""
+            running.append(content)
+            await gates[content]
+
+    handler = LimitedHandler(None)
+    handler_ds = [handler.process(mocker.MagicMock(), i) for i in range(3)]
+    yield task.deferLater(reactor, 0, lambda: None)
+    assert running == [0]
+    gates[0].callback(None)
+    yield handler_ds[0]
+    assert running == [0, 1]
+    for gate in gates[1:]:
+        gate.callback(None)
+    for handler_deferred in handler_ds[1:]:
+        yield handler_deferred
+    assert running == [0, 1, 2]
+
+
+@pytest_twisted.inlineCallbacks
+def test_handler_thread_pool_limits():
+    """Test dedicated pools run jobs, and drop them beyond max_jobs."""
+    pool = ledge._threadpools.HandlerThreadPool("test", max_threads=1, max_jobs=1)
+    release = threading.Event()
+    blocked = pool.submit(release.wait, 5)
+    assert pool.stats()["outstanding"] == 1
+    with pytest.raises(ledge._threadpools.HandlerQueueFull):
+        yield pool.submit(lambda: None)
+    release.set()
+    assert (yield blocked) is True
+    assert pool.stats()["outstanding"] == 0
+    pool.stop()
+
+
+def test_handler_thread_pools_configured(mocker):
+    """Test threaded handlers get their own pool, configured via env vars."""
+    mocker.patch.dict(
+        os.environ,
+        {
+            "LEDGE_HANDLERS": (
+                "ledge.handlers.DemoHandler,ledge.handlers.UnThreadedBlockingHandler"
+            ),
+            "LEDGE_DEMO_HANDLER_THREAD_POOL_MAX_THREADS": "3",
+        },
+    )
+    config = ledge._config.get_config()
+    app = ledge._app.Ledge(config)
+    demo_handler, unthreaded_handler = app._handlers
+    assert demo_handler.thread_pool.pool.max == 3
+    assert unthreaded_handler.thread_pool is None
+    assert app.thread_pool_stats() == {
+        "demo_handler": {"queued": 0, "working": 0, "threads": 0, "outstanding": 0}
+    }
+
+
+@pytest_twisted.inlineCallbacks
+def test_reload(mocker, tmp_path):
+    """Test reloading swaps in a freshly configured app, draining the old."""
+    mocker.patch.dict(os.environ)
+    env_file = tmp_path / "ledge.env"
+    env_file.write_text("# Handlers\n\nLEDGE_HANDLERS = ledge.handlers.DemoHandler\n")
+    os.environ["LEDGE_RELOAD_ENV_FILE"] = str(env_file)
+    old = ledge._app.Ledge(ledge._config.get_config())
+    pending = Deferred()
+    old._track_pending(mocker.MagicMock(), [("response", pending)])
+    root = ledge._web.WebRoot(old)
+
+    drained = ledge._cmds.reload(root)
+    app = root.app
+    assert app is not old
+    assert [handler.name for handler in app._handlers] == ["demo_handler"]
+    assert app.metrics is old.metrics and app.admission is old.admission
+    assert list(app.metrics.thread_pool_stats()) == ["demo_handler"]
+    assert not drained.called
+    pending.callback(None)
+    assert (yield drained) == 1
+
+    # A broken configuration leaves the running app in place
+    env_file.write_text("LEDGE_HANDLERS=ledge.handlers.NoSuchHandler\n")
+    assert ledge._cmds.reload(root) is None
+    assert root.app is app
+
+    # Subconfigs of plugins which are no longer configured are removed
+    os.environ["LEDGE_HANDLERS"] = ""
+    ledge._config.get_merged_conf_object()
+    assert not hasattr(ledge._config.Configuration, "demo_handler_thread_pool")
+
+
+@pytest_twisted.inlineCallbacks
+def test_reload_state_settings(mocker, tmp_path):
+    """Test state is only carried over if its settings are unchanged."""
+    mocker.patch.dict(
+        os.environ,
+        {
+            "LEDGE_IDEMPOTENCY_KEY": "header:X-Delivery",
+            "LEDGE_WAL_DIR": str(tmp_path / "wal"),
+        },
+    )
+    old = ledge._app.Ledge(ledge._config.get_config())
+    root = ledge._web.WebRoot(old)
+    yield ledge._cmds.reload(root)
+    assert root.app.dedup is old.dedup and root.app.wal is old.wal
+
+    del os.environ["LEDGE_IDEMPOTENCY_KEY"]
+    os.environ["LEDGE_MAX_INFLIGHT_BYTES"] = "1000"
+    os.environ["LEDGE_WAL_DIR"] = str(tmp_path / "other_wal")
+    old = root.app
+    yield ledge._cmds.reload(root)
+    app = root.app
+    assert app.dedup is None
+    assert app.idempotency_key(mocker.MagicMock(), b"") is None
+    assert app.admission is not old.admission
+    assert app.admission.max_bytes == 1000
+    assert app.wal is not old.wal and app.wal.directory == str(tmp_path / "other_wal")
+    # The replaced log is closed once the old app is drained
+    assert not old.wal._thread.is_alive()
+    app.wal.close()
+
+
+@pytest_twisted.inlineCallbacks
+def test_shutdown(mocker, mock_config):
+    """Test shutting down refuses new requests and waits for accepted ones."""
+    app = ledge._app.Ledge(mock_config)
+    root = ledge._web.WebRoot(app)
+    port = mocker.MagicMock()
+    root.ports.append(port)
+    request = ledge._utils.inject_logger(mocker.MagicMock())
+    assert app.admit(request, b"123")
+    pending = Deferred()
+    mocker.patch.object(app, "schedule_response", return_value=pending)
+
+    finished = ledge._cmds.shutdown(root, 10)
+    port.stopListening.assert_called_once()
+    assert root.screen(b"POST", b"/", 3) == 503
+    # The admitted request is still waited for
+    yield task.deferLater(reactor, 0, app.handle_request, request, b"123")
+    assert app.outstanding() == [("response", request.ledge_context.request_id)]
+    assert not finished.called
+    pending.callback(None)
+    yield finished
+    assert app.outstanding() == []
+
+
+@pytest_twisted.inlineCallbacks
+def test_shutdown_deadline(mocker, mock_config):
+    """Test work unfinished by the shutdown deadline is logged."""
+    app = ledge._app.Ledge(mock_config)
+    request = ledge._utils.inject_logger(mocker.MagicMock())
+    app._track_pending(request, [("handler demo", Deferred())])
+    logger = mocker.patch("structlog.getLogger").return_value
+    yield ledge._cmds.shutdown(ledge._web.WebRoot(app), 0.01)
+    logger.msg.assert_called_with(
+        "Abandoning unfinished handler demo.",
+        request_id=request.ledge_context.request_id,
+    )
+
+
+@pytest_twisted.inlineCallbacks
+def test_shutdown_abandons_stuck_handlers(mocker, mock_config):
+    """Test handlers outlasting the shutdown deadline don't hold it up."""
+    mock_config.handlers = [ledge.handlers.DemoHandler]
+    app = ledge._app.Ledge(mock_config)
+    pool = app._handlers[0].thread_pool = ledge._threadpools.HandlerThreadPool(
+        "ledge-demo_handler", max_threads=1
+    )
+    release = threading.Event()
+    try:
+        request = ledge._utils.inject_logger(mocker.MagicMock())
+        app._track_pending(
+            request, [("handler demo_handler", pool.submit(release.wait, 5))]
+        )
+        abandon_shared_pool = mocker.patch("ledge._app.abandon_shared_pool")
+        started = reactor.seconds()
+        yield ledge._cmds.shutdown(ledge._web.WebRoot(app), 0.1)
+        assert reactor.seconds() - started < 1
+        abandon_shared_pool.assert_called_once_with()
+        # The reactor won't join the pool's threads as it shuts down
+        assert pool._shutdown_trigger is None
+        assert all(thread.daemon for thread in pool.pool.threads)
+    finally:
+        release.set()
+        pool.pool.stop()
+
+
+@pytest_twisted.inlineCallbacks
+def test_process_pool_abandon():
+    """Test abandoning the process pool stops the workers mid-task."""
+    pool = ledge._process_pool.ProcessPool(max_workers=1)
+    yield pool.submit(os.getpid)
+    sleeping = pool.submit(time.sleep, 30)
+    started = reactor.seconds()
+    pool.abandon()
+    # Depending on whether the worker had started on it
+    with pytest.raises((BrokenProcessPool, CancelledError)):
+        yield sleeping
+    assert reactor.seconds() - started < 10
+
+
+def test_body_in_memory():
+    """Test in memory content is wrapped without copying."""
+    content = BytesIO(b"0123456789")
+    body = ledge.Body.from_file(content)
+    assert body == b"0123456789"
+    assert len(body) == 10
+    assert body.view.readonly
+    with pytest.raises(BufferError):
+        content.write(b"no copy was made")
+    assert [bytes(chunk) for chunk in body.chunks(4)] == [b"0123", b"4567", b"89"]
+    assert body.decode() == "0123456789"
+
+
+def test_body_memory_mapped():
+    """Test spooled content is memory mapped, and outlives its file."""
+    with tempfile.TemporaryFile() as content:
+        content.write(b'{"foo": "bar"}')
+        body = ledge.Body.from_file(content)
+    assert body._mapping is not None
+    assert bytes(body) == b'{"foo": "bar"}'
+    assert ledge.helpers.content_to_json(body) == {"foo": "bar"}
+    body.close()
+
+
+def test_read_content_modes(mocker, mock_config):
+    """Test content is taken without copying, in the configured form."""
+    mock_config.max_content_length = 10
+    root = ledge._web.WebRoot(ledge._app.Ledge(mock_config))
+    request = mocker.MagicMock()
+    request.content = BytesIO(b"0123456789")
+    assert root._read_content(request) == b"0123456789"
+    with tempfile.TemporaryFile() as content:
+        content.write(b"0123456789A")
+        content.seek(0)
+        request.content = content
+        assert root._read_content(request) is None
+    mock_config.body_mode = "memoryview"
+    request.content = BytesIO(b"0123456789")
+    view = root._read_content(request)
+    assert isinstance(view, memoryview) and view.readonly
+    assert ledge.helpers.content_to_json(view[2:4]) == 23
+
+
+def test_content_to_text():
+    """Test content is decoded from its buffer, optionally only in part."""
+    content = "h\u00e9llo".encode("utf-8")
+    assert ledge.helpers.content_to_text(memoryview(content)) == "h\u00e9llo"
+    # The limit splits the second character, so it's left out
+    assert ledge.helpers.content_to_text(content, max_bytes=2) == "h"
+    with pytest.raises(UnicodeError):
+        ledge.helpers.content_to_text(content[:2], max_bytes=2)
+
+
+def test_request_spool_threshold(mocker):
+    """Test content beyond the site's threshold is spooled to a file."""
+    channel = mocker.MagicMock()
+    channel.site.spool_threshold = 10
+    request = ledge._web.LedgeRequest(channel)
+    request.gotLength(9)
+    assert isinstance(request.content, BytesIO)
+    request.gotLength(10)
+    assert not isinstance(request.content, BytesIO)
+    request.content.close()
+
+
+def _site_connection(mocker, mock_config, protocol=b"http/1.1"):
+    """Connect a LedgeSite to a fake transport, which negotiated a protocol."""
+    mock_config.max_content_length = 10
+    app = mocker.MagicMock()
+    app.config = mock_config
+    site = ledge._web.LedgeSite(ledge._web.WebRoot(app))
+    channel = site.buildProtocol(None)
+    transport = StringTransport()
+    transport.negotiatedProtocol = protocol
+    channel.makeConnection(transport)
+    return app, channel, transport
+
+
+def test_request_rejected_by_content_length(mocker, mock_config):
+    """Test a request declaring too much content is rejected immediately."""
+    app, channel, transport = _site_connection(mocker, mock_config)
+    channel.dataReceived(
+        b"POST / HTTP/1.1\r\nContent-Length: 11\r\nExpect: 100-continue\r\n\r\n"
+    )
+    assert transport.value().startswith(b"HTTP/1.1 413 ")
+    assert b"100 Continue" not in transport.value()
+    assert transport.disconnecting
+    app.handle_request.assert_not_called()
+
+
+def test_request_rejected_while_streaming(mocker, mock_config):
+    """Test a chunked request is rejected once its content is too large."""
+    app, channel, transport = _site_connection(mocker, mock_config)
+    channel.dataReceived(
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" b"8\r\n12345678\r\n"
+    )
+    assert transport.value() == b""
+    channel.dataReceived(b"8\r\n12345678\r\n0\r\n\r\n")
+    assert transport.value().startswith(b"HTTP/1.1 413 ")
+    app.handle_request.assert_not_called()
+
+
+def test_request_received_before_content(mocker, mock_config):
+    """Test requests are marked received before their content is buffered."""
+    app, channel, _ = _site_connection(mocker, mock_config)
+    mocker.patch("ledge._web.reactor.callLater")
+    channel.dataReceived(b"POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\n12")
+    buffering = time.monotonic()
+    channel.dataReceived(b"34")
+    _, _, request, content = ledge._web.reactor.callLater.call_args[0]
+    assert content == b"1234"
+    context = request.ledge_context
+    assert context.timings[("received", None)] < buffering
+    assert context.request_id is not None
+
+
+def test_request_rejected_by_method(mocker, mock_config):
+    """Test requests with unsupported methods are rejected before reading."""
+    _, channel, transport = _site_connection(mocker, mock_config)
+    channel.dataReceived(b"PUT / HTTP/1.1\r\nContent-Length: 5\r\n\r\n")
+    assert transport.value().startswith(b"HTTP/1.1 405 ")
+
+
+def test_request_rejected_by_path(mocker, mock_config):
+    """Test requests no plugin could match are rejected, if configured."""
+    app, channel, transport = _site_connection(mocker, mock_config)
+    mock_config.reject_unmatched = True
+    app.could_match.return_value = False
+    channel.dataReceived(b"POST /nope?a=b HTTP/1.1\r\nContent-Length: 5\r\n\r\n")
+    assert transport.value().startswith(b"HTTP/1.1 404 ")
+    app.could_match.assert_called_once_with(b"POST", b"/nope")
+
+
+def _h2_post(mocker, channel, transport, headers, body):
+    """
+    Send a POST request over HTTP/2, or just its headers if body is None.
+
+    :returns: The client's events, for everything sent in response.
+    """
+    clock = task.Clock()
+    mocker.patch("ledge._web.reactor.callLater", clock.callLater)
+    h2_connection = pytest.importorskip("h2.connection")
+    h2_config = pytest.importorskip("h2.config")
+    client = h2_connection.H2Connection(h2_config.H2Configuration(client_side=True))
+    client.initiate_connection()
+    client.send_headers(
+        1,
+        [
+            (b":method", b"POST"),
+            (b":path", b"/"),
+            (b":authority", b"localhost"),
+            (b":scheme", b"https"),
+            *headers,
+        ],
+    )
+    if body is not None:
+        client.send_data(1, body, end_stream=True)
+    channel.dataReceived(client.data_to_send())
+    clock.advance(0)
+    return client.receive_data(transport.value())
+
+
+def test_h2_request(mocker, mock_config):
+    """Test requests are received over HTTP/2, which is offered."""
+    app, channel, transport = _site_connection(mocker, mock_config, protocol=b"h2")
+    _h2_post(mocker, channel, transport, [(b"content-length", b"5")], b"hello")
+    request, content = app.handle_request.call_args[0]
+    assert content == b"hello"
+    assert request.clientproto == b"HTTP/2"
+    # Which is offered via ALPN, as it's supported
+    assert channel.factory.acceptableProtocols() == [b"h2", b"http/1.1"]
+
+
+@pytest.mark.parametrize(
+    "headers,body",
+    [
+        # Rejected on its declared length, before any content is sent
+        ([(b"content-length", b"11")], None),
+        ([], b"x" * 11),
+    ],
+)
+def test_h2_request_rejected(mocker, mock_config, headers, body):
+    """Test requests over HTTP/2 are rejected, and their stream reset."""
+    app, channel, transport = _site_connection(mocker, mock_config, protocol=b"h2")
+    events = _h2_post(mocker, channel, transport, headers, body)
+    responses = [
+        event for event in events if type(event).__name__ == "ResponseReceived"
+    ]
+    assert dict(responses[0].headers)[b":status"] == b"413"
+    resets = [event for event in events if type(event).__name__ == "StreamReset"]
+    assert resets[0].error_code == 0
+    app.handle_request.assert_not_called()
+
+
+def _post(channel, headers, body):
+    """Send a POST request with a fixed length body."""
+    channel.dataReceived(
+        b"POST / HTTP/1.1\r\n"
+        + b"".join(b"%s: %s\r\n" % header for header in headers)
+        + b"Content-Length: %d\r\n\r\n" % len(body)
+        + body
+    )
+
+
+@pytest.mark.parametrize(
+    "encoding,compress",
+    [
+        (b"gzip", gzip.compress),
+        (b"deflate", zlib.compress),
+        (b"deflate", lambda data: zlib.compress(data, wbits=-zlib.MAX_WBITS)),
+    ],
+)
+def test_request_content_decoded(mocker, mock_config, encoding, compress):
+    """Test encoded content is decoded before being handed over."""
+    app, channel, _ = _site_connection(mocker, mock_config)
+    mock_config.max_content_length = 1000
+    mock_config.decode_content = True
+    mocker.patch("ledge._web.reactor.callLater")
+    _post(channel, [(b"Content-Encoding", encoding)], compress(b"hello" * 10))
+    _, _, request, content = ledge._web.reactor.callLater.call_args[0]
+    assert content == b"hello" * 10
+    assert request.getHeader(b"content-encoding") is None
+
+
+@pytest.mark.parametrize(
+    "body,in_memory",
+    [(b"hello" * 100, True), (os.urandom(200), False)],
+    ids=["small", "large"],
+)
+def test_request_encoded_content_spooling(mocker, mock_config, body, in_memory):
+    """Test encoded content is only spooled if its declared length is large."""
+    _, channel, _ = _site_connection(mocker, mock_config)
+    mock_config.max_content_length = 1000
+    mock_config.decode_content = True
+    channel.factory.spool_threshold = 100
+    mocker.patch("ledge._web.reactor.callLater")
+    _post(channel, [(b"Content-Encoding", b"gzip")], gzip.compress(body))
+    _, _, request, content = ledge._web.reactor.callLater.call_args[0]
+    assert content == body
+    assert isinstance(request.content, BytesIO) == in_memory
+
+
+@pytest.mark.parametrize("max_length,ratio", [(1000, None), (100000, 10.0)])
+def test_request_decompression_bomb(mocker, mock_config, max_length, ratio):
+    """Test content decoding beyond the size or ratio limits is rejected."""
+    app, channel, transport = _site_connection(mocker, mock_config)
+    mock_config.max_content_length = max_length
+    mock_config.decode_content = True
+    mock_config.max_compression_ratio = ratio
+    _post(channel, [(b"Content-Encoding", b"gzip")], gzip.compress(b"\0" * 50000))
+    assert transport.value().startswith(b"HTTP/1.1 413 ")
+    app.handle_request.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "encoding,body,code",
+    [(b"br", b"x", b"415"), (b"gzip", b"not gzip", b"400")],
+)
+def test_request_undecodable(mocker, mock_config, encoding, body, code):
+    """Test content which can't be decoded is rejected."""
+    _, channel, transport = _site_connection(mocker, mock_config)
+    mock_config.decode_content = True
+    _post(channel, [(b"Content-Encoding", encoding)], body)
+    assert transport.value().startswith(b"HTTP/1.1 " + code)
+
+
+def test_request_truncated_encoding(mocker, mock_config):
+    """Test content whose encoded stream is incomplete is rejected."""
+    _, channel, transport = _site_connection(mocker, mock_config)
+    mock_config.max_content_length = 1000
+    mock_config.decode_content = True
+    _post(channel, [(b"Content-Encoding", b"gzip")], gzip.compress(b"hello")[:-8])
+    assert transport.value().startswith(b"HTTP/1.1 400 ")
+
+
+def test_dispatch_index_could_match():
+    """Test the index can rule out requests by method and path alone."""
+
+    class Matched(ledge.ResponderImplementation):
+        name = "matched"
+        match = ledge.Match(path="/slack", method="POST")
+
+    class Unmatched(ledge.ResponderImplementation):
+        name = "unmatched"
+
+    index = ledge._dispatch.DispatchIndex([Matched(None)])
+    assert index.could_match(b"POST", b"/slack")
+    assert not index.could_match(b"POST", b"/other")
+    assert not index.could_match(b"GET", b"/slack")
+    index = ledge._dispatch.DispatchIndex([Matched(None), Unmatched(None)])
+    assert index.could_match(b"POST", b"/other")
+
+
 @pytest_twisted.inlineCallbacks
 def test_end_to_end(mocker):
     """End to end smoke test of very basic responder + handler."""
@@ -202,11 +1635,253 @@ def test_get_headers(mocker):
     assert ledge.helpers.get_headers(request) == {"foo": "bar"}
 
 
+def test_request_context_memoizes(mocker):
+    """Test the request context only computes each key once."""
+    context = ledge._context.RequestContext()
+    func = mocker.MagicMock(return_value="value")
+    assert context.memoize("key", func, 1) == "value"
+    assert context.memoize("key", func, 1) == "value"
+    func.assert_called_once_with(1)
+
+
+def test_request_context_memoizes_exceptions():
+    """Test exceptions raised while computing a value are memoized."""
+    context = ledge._context.RequestContext()
+    calls = []
+
+    def _fail():
+        calls.append(None)
+        raise ValueError("nope")
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            context.memoize("key", _fail)
+    assert len(calls) == 1
+
+
+def test_content_to_json_cached(mocker):
+    """Test request content is only parsed once per request."""
+    request = mocker.MagicMock()
+    request.ledge_context = ledge._context.RequestContext()
+    content = b'{"foo": "bar"}'
+    first = ledge.helpers.content_to_json(content, request=request)
+    second = ledge.helpers.content_to_json(content, request=request)
+    assert first == {"foo": "bar"}
+    assert first is second
+    # Other content on the same request isn't confused with the cached value
+    assert ledge.helpers.content_to_json(b"[]", request=request) == []
+
+
+def test_json_backend_selection(mocker, json_backend):
+    """Test backends fall back to the stdlib when they aren't installed."""
+    # Faster backends are opt in
+    assert json_backend.use_backend() == "stdlib"
+    assert ledge._config.get_config().json_backend == "stdlib"
+    assert json_backend.use_backend("orjson") == "orjson"
+    assert json_backend.use_backend("auto") == "orjson"
+    mocker.patch.dict("sys.modules", {"orjson": None, "simdjson": None, "ujson": None})
+    assert json_backend.use_backend("orjson") == "stdlib"
+    assert json_backend.use_backend("auto") == "stdlib"
+    with pytest.raises(ValueError):
+        json_backend.use_backend("yaml")
+
+
+def test_json_backend_helpers(mocker, json_backend):
+    """Test the helpers parse buffers, and raise JSONDecodeError, via orjson."""
+    json_backend.use_backend("orjson")
+    assert ledge.helpers.content_to_json(memoryview(b'{"a": [1]}')) == {"a": [1]}
+    assert ledge.helpers.content_to_json(
+        '{"a": 1}'.encode("utf-16"), encoding="utf-16"
+    ) == {"a": 1}
+    with pytest.raises(json.JSONDecodeError):
+        ledge.helpers.content_to_json(b"{")
+    request = mocker.MagicMock()
+    ledge.helpers.json_response(request, {"foo": "bar"})
+    request.write.assert_called_once_with(b'{"foo":"bar"}')
+
+
+@pytest.mark.parametrize("name", ["stdlib", "orjson", "simdjson", "ujson"])
+def test_json_backend_payloads(name, json_backend):
+    """Test each backend round trips the same payloads, like the stdlib."""
+    if name != "stdlib":
+        pytest.importorskip(name)
+    assert json_backend.use_backend(name) == name
+    payload = {"a": [1, 1.5, None, True], "s": "caf\u00e9 </b>", "n": {"x": -1}}
+    assert json_backend.loads(json_backend.dumps(payload)) == payload
+    assert json.loads(json_backend.dumps(payload)) == payload
+    assert json_backend.loads(json.dumps(payload).encode("utf-8")) == payload
+    # What the backends can't serialize is serialized by the stdlib
+    assert json_backend.dumps({1: "a"}) in (b'{"1": "a"}', b'{"1":"a"}')
+    assert json_backend.dumps(10**30) == b"1" + b"0" * 30
+    with pytest.raises(json.JSONDecodeError):
+        json_backend.loads(b'{"a": ')
+    if name != "orjson":
+        # Which parses integers beyond 64 bits as floats
+        assert json_backend.loads(b"123456789012345678901234567890") == (
+            123456789012345678901234567890
+        )
+
+
+def test_lazy_json():
+    """Test lazy JSON views find fields, stopping as soon as they're found."""
+    content = (
+        b' {"skip": {"a": "}\\"]", "b": [1, {"c": 2}]}, "a\\u002eb": true,'
+        b' "event": {"channel": "C1", "items": [{"id": 7}]}, "type": "x", TRUNCATED'
+    )
+    view = ledge.helpers.lazy_json(memoryview(content))
+    assert view.get("event.channel") == "C1"
+    assert view.get("event.items.0.id") == 7
+    assert view.get(["a.b"]) is True
+    assert view.get("skip.b.1") == {"c": 2}
+    assert view.get("event.missing", "default") == "default"
+    assert view.get("event.channel.nested") is None
+    assert "type" in view
+    # Values nested too deeply to skip in one go are skipped all the same
+    deep = ledge.helpers.lazy_json(b'{"d": ' + b"[" * 12 + b"]" * 12 + b', "k": 1}')
+    assert deep.get("k") == 1
+    # The content is only malformed beyond the fields found so far
+    with pytest.raises(json.JSONDecodeError):
+        view.get("absent")
+    with pytest.raises(json.JSONDecodeError):
+        view.load()
+
+
+def test_lazy_json_shared(mocker):
+    """Test lazy views are shared per request, and load via content_to_json."""
+    request = mocker.MagicMock()
+    request.ledge_context = ledge._context.RequestContext()
+    content = b'{"a": {"b": [1, 2]}}'
+    view = ledge.helpers.lazy_json(content, request=request)
+    assert ledge.helpers.lazy_json(content, request=request) is view
+    assert view.load() is ledge.helpers.content_to_json(content, request=request)
+    assert view.get("a.b.1") == 2
+    assert "a.c" not in view
+    assert ledge.helpers.lazy_json(b"[]", request=request).get("a") is None
+
+
+class _EchoHTTPHandler(http.server.BaseHTTPRequestHandler):
+    """Echo request bodies, over keep-alive connections."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Reply with the body, and the port the client connected from."""
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Client-Port", str(self.client_address[1]))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keep quiet."""
+
+
+def test_http_blocking_client():
+    """Test the blocking client reuses its connections to a host."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _EchoHTTPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/echo"
+    client = ledge.helpers.http.BlockingClient(pool_size=1, timeout=5)
+    try:
+        first = client.post(url, json={"a": 1})
+        second = client.post(url, body=b"second")
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    assert first.code == 200
+    assert first.json() == {"a": 1}
+    assert second.body == b"second"
+    assert first.headers["x-client-port"] == second.headers["x-client-port"]
+
+
+class _DroppingHTTPHandler(_EchoHTTPHandler):
+    """Echo request bodies, but drop the connection on /drop requests."""
+
+    dropped = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Drop the connection without replying."""
+        self.dropped.append(self.command)
+        self.close_connection = True
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Echo the body, unless the request is to be dropped."""
+        if self.path != "/drop":
+            super().do_POST()
+            return
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.do_GET()
+
+
+def test_http_blocking_client_retries():
+    """Test only idempotent requests are retried once they've been sent."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _DroppingHTTPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    client = ledge.helpers.http.BlockingClient(pool_size=1, timeout=5)
+    try:
+        client.post(f"{url}/echo", body=b"connect")
+        with pytest.raises(http.client.RemoteDisconnected):
+            client.post(f"{url}/drop", body=b"once")
+        assert _DroppingHTTPHandler.dropped == ["POST"]
+        client.post(f"{url}/echo", body=b"reconnect")
+        with pytest.raises(http.client.RemoteDisconnected):
+            client.get(f"{url}/drop")
+        # Retried on a new connection, which failed too
+        assert _DroppingHTTPHandler.dropped == ["POST", "GET", "GET"]
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+class _EchoResource(Resource):
+    """Echo request bodies, with the port the client connected from."""
+
+    isLeaf = True
+
+    def render_POST(self, request):  # pylint: disable=invalid-name,no-self-use
+        """Reply with the body."""
+        request.setHeader(b"X-Client-Port", str(request.getClientAddress().port))
+        return request.content.read()
+
+
+@pytest_twisted.inlineCallbacks
+def test_http_client():
+    """Test the deferred client reuses its connections to a host."""
+    port = reactor.listenTCP(0, Site(_EchoResource()), interface="127.0.0.1")
+    url = f"http://127.0.0.1:{port.getHost().port}/echo"
+    client = ledge.helpers.http.Client(pool_size=1, timeout=5)
+    try:
+        first = yield client.post(url, json={"a": 1})
+        second = yield client.post(url, body=b"second")
+        assert first.code == 200
+        assert first.json() == {"a": 1}
+        assert second.body == b"second"
+        assert first.headers["x-client-port"] == second.headers["x-client-port"]
+    finally:
+        yield client.close()
+        yield port.stopListening()
+
+
+def test_get_headers_cached(mocker):
+    """Test headers are only decoded once per request."""
+    request = mocker.MagicMock()
+    request.ledge_context = ledge._context.RequestContext()
+    request.getAllHeaders = mocker.MagicMock(return_value={b"foo": b"bar"})
+    assert ledge.helpers.get_headers(request) == {"foo": "bar"}
+    assert ledge.helpers.get_headers(request) == {"foo": "bar"}
+    request.getAllHeaders.assert_called_once()
+
+
 def test_inject_logger(mocker):
     """Test loggers are injected onto each request."""
     request = mocker.MagicMock()
     ledge._utils.inject_logger(request)
     request.logger.msg("Doesn't raise an exception!")
+    assert isinstance(request.ledge_context, ledge._context.RequestContext)
 
 
 def test_make_name_safe():
@@ -242,9 +1917,9 @@ def test_two_handlers(mocker):
     """
     Test multiple handlers can be specified via env vars.
     """
-    os.environ[
-        "LEDGE_HANDLERS"
-    ] = "ledge.handlers.EchoHandler,ledge.handlers.DemoHandler"
+    os.environ["LEDGE_HANDLERS"] = (
+        "ledge.handlers.EchoHandler,ledge.handlers.DemoHandler"
+    )
     config = ledge._config.get_config()
     app = ledge._app.Ledge(config)
     assert len(app._handlers) == 2
@@ -283,6 +1958,9 @@ def test_slack_verification(mocker):
         }
     )
     assert ledge.helpers.slack.verify_slack_request(mock_request, content, secret)
+    body = ledge.Body.from_file(BytesIO(content))
+    assert ledge.helpers.slack.verify_slack_request(mock_request, body, secret)
+    assert ledge.helpers.slack.verify_slack_request(mock_request, body.view, secret)
 
 
 def test_bad_slack_verification(mocker):